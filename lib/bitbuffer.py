@@ -0,0 +1,154 @@
+from typing import Iterable, List
+
+from lib import util
+
+
+REVERSED_BYTES = bytes(util.reverse(b, 8) for b in range(256))
+
+
+class BitBuffer:
+    "Growable FIFO of bits packed msb first into a bytearray"
+
+    __slots__ = ("_data", "_wpos", "_rpos")
+
+    def __init__(self):
+        self._data = bytearray()
+        self._wpos = 0  # bit position of the next write
+        self._rpos = 0  # bit position of the next read
+
+    def __len__(self):
+        return self._wpos - self._rpos
+
+    def append(self, bit: int) -> None:
+        shift = self._wpos & 7
+        if not shift:
+            self._data.append(0x80 if bit else 0)
+        elif bit:
+            self._data[-1] |= 0x80 >> shift
+        self._wpos += 1
+
+    __call__ = append  # a fetch callback, extend_packed takes bits in bulk
+
+    def extend(self, bits: Iterable[int]) -> None:
+        for bit in bits:
+            self.append(bit)
+
+    def extend_packed(self, data: bytes, n_bits: int) -> None:
+        """
+        Appends the first n_bits of the msb first packed data.
+
+        :param data: packed bits
+        :type data: bytes
+        :param n_bits: number of valid bits in data
+        :type n_bits: int
+        """
+        assert 0 <= n_bits <= len(data) * 8
+        n_bytes = (n_bits + 7) >> 3
+        if not self._wpos & 7 and not n_bits & 7:
+            self._data += data[:n_bytes]
+            self._wpos += n_bits
+            return
+        value = int.from_bytes(data[:n_bytes], "big")
+        value >>= (n_bytes << 3) - n_bits
+        total = n_bits
+        if shift := self._wpos & 7:
+            value |= (self._data.pop() >> (8 - shift)) << n_bits
+            total += shift
+        pad = -total & 7
+        self._data += (value << pad).to_bytes((total + pad) >> 3, "big")
+        self._wpos += n_bits
+
+    def pop_bits(self, n_bits: int) -> bytes:
+        """
+        Removes n_bits from the buffer.
+
+        :param n_bits: number of bits to remove
+        :type n_bits: int
+
+        :return: the removed bits packed msb first, padded with zeros
+        :rtype: bytes
+        """
+        assert 0 <= n_bits <= len(self)
+        start = self._rpos >> 3
+        end = (self._rpos + n_bits + 7) >> 3
+        if not self._rpos & 7 and not n_bits & 7:
+            result = bytes(self._data[start:end])
+        else:
+            value = int.from_bytes(self._data[start:end], "big")
+            value >>= (end << 3) - self._rpos - n_bits
+            value &= (1 << n_bits) - 1
+            pad = -n_bits & 7
+            result = (value << pad).to_bytes((n_bits + pad) >> 3, "big")
+        self._rpos += n_bits
+        self._compact()
+        return result
+
+    def pop(self,
+            n_bits: int = 8,
+            n_values: int = -1,
+            lsb: bool = False) -> List[int]:
+        """
+        Removes complete n_bits long values from the buffer.
+
+        :param n_bits: length of the ints to produce, defaults to 8
+        :type n_bits: int
+        :param n_values: max number of ints to produce, defaults to -1 (all)
+        :type n_values: int
+        :param lsb: least-significant-bit first order, defaults to False (msb)
+        :type lsb: bool, optional
+
+        :return: list of ints
+        :rtype: [int]
+        """
+        count = self._count(n_bits, n_values)
+        raw = self.pop_bits(count * n_bits)
+        if n_bits == 8:
+            return list(raw.translate(REVERSED_BYTES) if lsb else raw)
+        if n_bits % 8 == 0:
+            n_bytes, order = n_bits // 8, "big"
+            if lsb:
+                raw, order = raw.translate(REVERSED_BYTES), "little"
+            return [int.from_bytes(raw[i:i + n_bytes], order)
+                    for i in range(0, len(raw), n_bytes)]
+
+        mask = (1 << n_bits) - 1
+        result = []
+        for pos in range(0, count * n_bits, n_bits):
+            start, end = pos >> 3, (pos + n_bits + 7) >> 3
+            value = int.from_bytes(raw[start:end], "big")
+            value = (value >> ((end << 3) - pos - n_bits)) & mask
+            result.append(util.reverse(value, n_bits) if lsb else value)
+        return result
+
+    def pop_bytes(self, n_values: int = -1, lsb: bool = False) -> bytes:
+        """
+        Removes complete octets from the buffer.
+
+        :param n_values: max number of octets to produce, defaults to -1 (all)
+        :type n_values: int
+        :param lsb: least-significant-bit first order, defaults to False (msb)
+        :type lsb: bool, optional
+
+        :return: the octets
+        :rtype: bytes
+        """
+        raw = self.pop_bits(self._count(8, n_values) * 8)
+        return raw.translate(REVERSED_BYTES) if lsb else raw
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._wpos = self._rpos = 0
+
+    def _count(self, n_bits, n_values):
+        assert n_bits > 0
+        count = len(self) // n_bits
+        if n_values >= 0:
+            count = min(count, n_values)
+        return count
+
+    def _compact(self):
+        consumed = self._rpos >> 3
+        if consumed:
+            del self._data[:consumed]
+            self._rpos -= consumed << 3
+            self._wpos -= consumed << 3
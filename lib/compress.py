@@ -0,0 +1,68 @@
+from typing import Iterator, Sequence, Tuple
+
+
+def find_repeats(data: bytes, starts: Sequence[int], max_distance: int,
+                 max_block: int, max_count: int,
+                 repeat_length: int) -> Iterator[Tuple[int, int, int, int]]:
+    """
+    Finds the op sequences repeating recent ones, for the "replay block
+    bytes from distance bytes back, count times" op of the links. Matches
+    are op aligned and never reach back over an earlier match, so the
+    receiver only has to look back at literally sent bytes. A block right
+    before pos repeated count times is a run.
+
+    :param data: the op stream
+    :type data: bytes
+    :param starts: offset of every op in data, ascending
+    :type starts: Sequence[int]
+    :param max_distance: farthest the receiver can look back
+    :type max_distance: int
+    :param max_block: longest block of a repeat op
+    :type max_block: int
+    :param max_count: most repetitions of a repeat op
+    :type max_count: int
+    :param repeat_length: length of the repeat op, a match must save more
+    :type repeat_length: int
+
+    :return: (pos, distance, block, count) of the matches, replacing
+        data[pos:pos + block * count]
+    :rtype: Iterator[Tuple[int, int, int, int]]
+    """
+    boundaries = list(starts) + [len(data)]
+    ops = [bytes(data[boundaries[i]:boundaries[i + 1]])
+           for i in range(len(boundaries) - 1)]
+    seen = {}  # op: indices of its literal occurrences, ascending
+    floor = 0  # index of the first op a match may reach back to
+    i = 0
+    while i < len(ops):
+        pos = boundaries[i]
+        best_saving, best = 0, None
+        for j in reversed(seen.get(ops[i], ())):
+            distance = pos - boundaries[j]
+            if j < floor or distance > max_distance:
+                break
+            period = i - j  # in ops
+            k = 0  # matching ops, overlapping the block for runs
+            while i + k < len(ops) and ops[j + k % period] == ops[i + k]:
+                k += 1
+            length = boundaries[i + k] - pos
+            if length >= distance:  # run
+                block = distance
+                count = min(length // distance, max_count)
+            else:
+                block, count = length, 1
+                while block > max_block:
+                    k -= 1
+                    block = boundaries[i + k] - pos
+            if block > max_block:
+                continue
+            saving = block * count - repeat_length
+            if saving > best_saving:
+                best_saving, best = saving, (distance, block, count)
+        if best is None:
+            seen.setdefault(ops[i], []).append(i)
+            i += 1
+            continue
+        distance, block, count = best
+        yield pos, distance, block, count
+        i = floor = boundaries.index(pos + block * count, i)
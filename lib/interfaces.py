@@ -1,11 +1,60 @@
 from abc import ABC, abstractmethod
-from typing import Callable, Dict, Iterator, List, Set, TextIO, TypeVar
+import contextlib
+import dataclasses
+from typing import (Any, Callable, Container, Dict, FrozenSet, Iterator, List,
+                    Optional, Sequence, Set, TextIO, Tuple, TypeVar, Union)
 
 
 Mem = Dict[int, int]
 Pin = TypeVar("Pin", int, str)
 PinState = TypeVar("PinState", bool, int)
 
+# Batch op kinds, see BaseLoader.run_batch(). Each op is a tuple of the kind
+# followed by the arguments of the corresponding BaseLoader method.
+OP_SET_PIN = 0  # (OP_SET_PIN, pin, new_state)
+OP_SET_PINS = 1  # (OP_SET_PINS, ((pin, new_state), ...))
+OP_FETCH_PIN = 2  # (OP_FETCH_PIN, pin, callback)
+OP_WAIT = 3  # (OP_WAIT, seconds)
+# (OP_SHIFT, clock, data_out, data_in, bits, sample, callback, half_period,
+#  sample_late)
+OP_SHIFT = 4
+Op = Tuple[Any, ...]
+
+
+def shift_ops(clock, data_out, data_in, bits, sample, callback, half_period,
+              sample_late) -> Iterator[Op]:
+    """
+    Emulates BaseLoader.shift() with per-bit pin ops.
+    """
+    for i, bit in enumerate(bits):
+        if data_out is not None:
+            yield (OP_SET_PIN, data_out, bit)
+        if half_period:
+            yield (OP_WAIT, half_period)
+        yield (OP_SET_PIN, clock, True)
+        if half_period:
+            yield (OP_WAIT, half_period)
+        sampled = data_in is not None and i in sample
+        if sampled and not sample_late:
+            yield (OP_FETCH_PIN, data_in, callback)
+        yield (OP_SET_PIN, clock, False)
+        if sampled and sample_late:
+            yield (OP_FETCH_PIN, data_in, callback)
+
+
+def op_callbacks(ops: Sequence[Op]) -> List[Callable[[PinState], None]]:
+    """
+    The callbacks of the fetches in ops, one per fetched bit, in order.
+    """
+    result = []
+    for op in ops:
+        if op[0] == OP_FETCH_PIN:
+            result.append(op[2])
+        elif op[0] == OP_SHIFT and op[3] is not None:
+            n_samples = sum(i in op[5] for i in range(len(op[4])))
+            result += [op[6]] * n_samples
+    return result
+
 
 class PinProxy(ABC):
     @abstractmethod
@@ -13,7 +62,8 @@ class PinProxy(ABC):
                     tpin: Pin,
                     n_bits: int = 8,
                     n_values: int = -1,
-                    lsb: bool = False) -> List[int]:
+                    lsb: bool = False,
+                    as_bytes: bool = False) -> Union[List[int], bytes]:
         """
         Flushes the output buffer and retrieves incoming bits from
         the input buffer forming octets (default).
@@ -26,8 +76,10 @@ class PinProxy(ABC):
         :type n_values: int
         :param lsb: least-significant-bit first order, defaults to False (msb)
         :type lsb: bool, optional
+        :param as_bytes: return bytes instead of a list, n_bits must be 8
+        :type as_bytes: bool, optional
 
-        :return: list of ints produced from the input bitbuffer
+        :return: list of ints (or bytes) produced from the input bitbuffer
         :rtype: [int]
 
         """
@@ -53,6 +105,22 @@ class PinProxy(ABC):
         """
         pass
 
+    @abstractmethod
+    def pin(self, tpin: Pin) -> Any:
+        """
+        Returns the handle of a target pin, which has been set up with
+        set_as_output() or set_as_input(). Output handles provide set(state)
+        and reset(), input handles provide fetch(). Handles are resolved
+        once, so they are cheaper than the pin name based methods.
+
+        :param tpin: target pin
+        :type tpin: Pin
+
+        :return: the pin handle
+        :rtype: OutputPin or InputPin
+        """
+        pass
+
     @abstractmethod
     def set_pin(self, tpin: Pin, new_state: PinState = True) -> None:
         """
@@ -65,6 +133,17 @@ class PinProxy(ABC):
         """
         pass
 
+    @abstractmethod
+    def set_pins(self, new_states: Dict[Pin, PinState]) -> None:
+        """
+        Sets the logical output values of multiple target_pins at once.
+        Loaders supporting it change the pins simultaneously.
+
+        :param new_states: target pin: state pairs
+        :type new_states: Dict[Pin, PinState]
+        """
+        pass
+
     def reset_pin(self, tpin: Pin) -> None:
         """
         Sets the logical output value of the target_pin to low(False)
@@ -85,6 +164,39 @@ class PinProxy(ABC):
         """
         pass
 
+    @abstractmethod
+    def shift(self,
+              clock: Pin,
+              bits: Sequence[int],
+              data_out: Optional[Pin] = None,
+              data_in: Optional[Pin] = None,
+              sample: Container[int] = (),
+              half_period: float = 0.0,
+              sample_late: bool = False) -> None:
+        """
+        Clocks bits out (and in) serially. For each bit: sets data_out,
+        waits half_period, raises clock, waits half_period, lowers clock.
+        The data_in pin is fetched before lowering the clock (or after it, if
+        sample_late) for the indices of the bits listed in sample. The clock
+        must be low beforehand, and is low afterwards.
+
+        :param clock: target pin of the clock
+        :type clock: Pin
+        :param bits: bits to shift out, in order
+        :type bits: Sequence[int]
+        :param data_out: target pin of the outgoing data, defaults to None
+        :type data_out: Optional[Pin]
+        :param data_in: target pin of the incoming data, defaults to None
+        :type data_in: Optional[Pin]
+        :param sample: indices of the bits to fetch data_in at, defaults to ()
+        :type sample: Container[int]
+        :param half_period: minimal length of a clock phase, defaults to 0
+        :type half_period: float
+        :param sample_late: fetch after the falling edge, defaults to False
+        :type sample_late: bool
+        """
+        pass
+
     @abstractmethod
     def wait(self, seconds: float) -> None:
         """
@@ -103,6 +215,51 @@ class PinProxy(ABC):
         """
         pass
 
+    @abstractmethod
+    def begin(self) -> None:
+        """
+        Starts a transaction. Until the matching commit(), pin changes, waits
+        and fetches are queued and handed over to the Loader in one batch.
+        Transactions can be nested, the outermost commit() sends the batch.
+        """
+        pass
+
+    @abstractmethod
+    def commit(self) -> None:
+        """
+        Closes the transaction opened by the last begin().
+        """
+        pass
+
+    @abstractmethod
+    def compile(self, fn: Callable[..., None],
+                **widths: int) -> Callable[..., None]:
+        """
+        Records the pin activity of fn once into a template, which can be
+        replayed later with different field values. fn is called with int
+        keyword arguments named after widths, and must only issue pin ops and
+        waits, whose structure does not depend on the field values.
+
+        :param fn: function to record
+        :type fn: Callable[..., None]
+        :param \\**widths: bit widths of the fields passed to fn
+
+        :return: callable taking the field values as keyword arguments
+        :rtype: Callable[..., None]
+        """
+        pass
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Context manager wrapping begin() and commit().
+        """
+        self.begin()
+        try:
+            yield
+        finally:
+            self.commit()
+
 
 class ProgressIndicator(ABC):
     @abstractmethod
@@ -128,7 +285,20 @@ class BaseFileFormat(ABC):
         pass
 
 
+@dataclasses.dataclass(frozen=True)
+class Capabilities:
+    "What the device behind a loader reported at open()"
+    version: int  # of the protocol
+    buffer_size: int  # the send window, in the unit of the marks
+    mark_chunksize: int  # progress mark sent per this many
+    ext_ops: FrozenSet[int]  # EXT_* codes implemented
+    loop_time: float  # per op overhead in seconds, waits are shortened by it
+
+
 class BaseLoader(ABC):
+    # set by open() of the loaders with a handshake
+    capabilities: Optional[Capabilities] = None
+
     def open(self) -> None:
         pass
 
@@ -155,6 +325,10 @@ class BaseLoader(ABC):
     def set_pin(self, pin: Pin, new_state: PinState) -> None:
         pass
 
+    def set_pins(self, new_states: Sequence[Tuple[Pin, PinState]]) -> None:
+        for pin, new_state in new_states:
+            self.set_pin(pin, new_state)
+
     @abstractmethod
     def fetch_pin(self, pin, callback: Callable[[PinState], None]) -> None:
         pass
@@ -166,3 +340,66 @@ class BaseLoader(ABC):
     @abstractmethod
     def flush(self) -> None:
         pass
+
+    def shift(self,
+              clock: Pin,
+              data_out: Optional[Pin],
+              data_in: Optional[Pin],
+              bits: Sequence[int],
+              sample: Container[int],
+              callback: Callable[[PinState], None],
+              half_period: float,
+              sample_late: bool) -> None:
+        """
+        Clocked serial transfer, see PinProxy.shift(). Loaders able to
+        run it natively should override it, the default implementation
+        emulates it bit by bit.
+        """
+        self.run_batch(list(shift_ops(clock, data_out, data_in, bits, sample,
+                                      callback, half_period, sample_late)))
+
+    def run_batch(self, ops: List[Op]) -> None:
+        """
+        Executes a batch of ops (see OP_* kinds) in order. Loaders able to
+        process a batch more efficiently than op by op should override it.
+
+        :param ops: ops to execute
+        :type ops: List[Op]
+        """
+        dispatch = {
+            OP_SET_PIN: self.set_pin,
+            OP_SET_PINS: self.set_pins,
+            OP_FETCH_PIN: self.fetch_pin,
+            OP_WAIT: self.wait,
+            OP_SHIFT: self.shift,
+        }
+        for kind, *args in ops:
+            dispatch[kind](*args)
+
+    def encode_batch(self, ops: List[Op]) -> Optional[bytes]:
+        """
+        Encodes ops into the loader-native op stream for send_encoded().
+        The encoding must neither depend on, nor change the loader state.
+
+        :param ops: ops to encode
+        :type ops: List[Op]
+
+        :return: the encoded ops, None if not supported by the loader
+        :rtype: Optional[bytes]
+        """
+        return None
+
+    def send_encoded(self,
+                     data: bytes,
+                     callbacks: Sequence[Callable[[PinState], None]]) -> None:
+        """
+        Sends an op stream produced by encode_batch(). A callback having an
+        extend_packed(data, n_bits) method (BitBuffer) may be handed many
+        bits at once through it.
+
+        :param data: encoded ops
+        :type data: bytes
+        :param callbacks: callbacks of the fetches in data, in order
+        :type callbacks: Sequence[Callable[[PinState], None]]
+        """
+        raise NotImplementedError
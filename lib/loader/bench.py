@@ -0,0 +1,66 @@
+import collections
+import logging
+import time
+
+from lib.interfaces import BaseLoader
+
+
+class Loader(BaseLoader):
+    """Null loader (40 pin) for measuring the host side. Waits advance a
+    virtual clock, ops are only counted, every fetch reads level (a pulled up
+    line by default). Targets checking the read data need the sim loader."""
+
+    def __init__(self, level=1):
+        self.level = int(level)
+        self.counts = collections.Counter()
+        self.virtual_time = 0.0
+        self._open_cpu = self._open_ts = None
+
+    def get_output_pins(self):
+        return set(range(40))
+
+    def get_input_pins(self):
+        return set(range(40))
+
+    @property
+    def ops(self):
+        return sum(self.counts.values())
+
+    def open(self):
+        self._open_cpu = time.process_time()
+        self._open_ts = time.monotonic()
+
+    def close(self):
+        if self._open_ts is None:
+            return
+        cpu = time.process_time() - self._open_cpu
+        wall = time.monotonic() - self._open_ts
+        counts = ", ".join(f"{n} {kind}" for kind, n in
+                           sorted(self.counts.items()))
+        logging.info(f"bench: {self.ops} ops ({counts})")
+        logging.info(f"bench: {self.virtual_time:.6f}s device time, "
+                     f"{cpu:.3f}s host cpu time, {wall:.3f}s wall time, "
+                     f"{self.ops / max(cpu, 1e-9):.0f} ops/s")
+
+    def set_as_output(self, pin):
+        self.counts["set_as_output"] += 1
+
+    def set_as_input(self, pin):
+        self.counts["set_as_input"] += 1
+
+    def set_pin(self, pin, new_state):
+        self.counts["set_pin"] += 1
+
+    def set_pins(self, new_states):
+        self.counts["set_pins"] += 1
+
+    def fetch_pin(self, pin, callback):
+        self.counts["fetch_pin"] += 1
+        callback(self.level)
+
+    def wait(self, seconds):
+        self.counts["wait"] += 1
+        self.virtual_time += seconds
+
+    def flush(self):
+        self.counts["flush"] += 1
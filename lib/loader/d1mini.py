@@ -1,4 +1,5 @@
 import collections
+import itertools
 import logging
 import math
 import time
@@ -6,7 +7,9 @@ import time
 # TODO import hibakezeles
 import serial
 
-from lib.interfaces import BaseLoader
+from lib.compress import find_repeats
+from lib.interfaces import (BaseLoader, Capabilities, OP_FETCH_PIN,
+                            OP_SET_PIN, OP_SET_PINS, OP_SHIFT, OP_WAIT)
 
 
 OP_SETPIN_HIGH = 0x00
@@ -15,24 +18,62 @@ OP_WAIT_US = 0x40
 OP_READ = 0x60
 OP_SET_AS_OUTPUT = 0x80
 OP_SET_AS_INPUT = 0xA0
+OP_EXT = 0xE0  # low 5 bits: EXT_* code, followed by its arguments
+# clock, data_out, data_in, flags, half_period_us, n_bits, data, sample mask
+EXT_SHIFT = 0x01
+# replies HELLO_REPLY, length, version, 16 bit rx buffer size, mark
+# chunksize, 32 bit mask of the EXT_* codes, loop time in us
+EXT_HELLO = 0x02
+EXT_WAIT_US = 0x10  # 16 bit delay, msb first
+# pin masks, bits in PORT_PINS order
+EXT_PORT_SET = 0x18  # mask
+EXT_PORT_CLEAR = 0x19  # mask
+EXT_PORT_WRITE = 0x1a  # set mask, clear mask
+# distance, block, count: replays the block bytes received distance bytes
+# before it count times
+EXT_REPEAT = 0x1b
+REPEAT_LENGTH = 4
+MAX_REPEAT_DISTANCE = 256 - REPEAT_LENGTH  # the firmware keeps 256 bytes
+MAX_REPEAT_BLOCK = MAX_REPEAT_DISTANCE
+MAX_REPEAT_COUNT = 255
+NO_PIN = 0xff
+SHIFT_SAMPLE_LATE = 0x01
+SHIFT_MAX_BITS = 248
 # D4 == 2, LED_BUILTIN, used by the bootloader
 PINS = {"D0": 16, "D1": 5, "D2": 4, "D3": 0,
         "D5": 14, "D6": 12, "D7": 13, "D8": 15}
+PORT_PINS = ("D0", "D1", "D2", "D3", "D5", "D6", "D7", "D8")  # mask bit 0-7
+# the defaults for firmwares without EXT_HELLO
 LOOP_TIME_US = 15
 PROGRESS_CHUNKSIZE = 32
+RX_BUFFER_SIZE = 1024  # serial rx buffer of the firmware, the send window
 PROGRESS_MARK = 0x11
+HELLO_REPLY = 0x33
+HELLO_TIMEOUT = 0.5
+WRITE_CHUNKSIZES = 4  # per rx buffer
 
 
 class Loader(BaseLoader):
-    "D1 Mini driver"
+    """D1 Mini driver. The send window, the marks, the wait compensation
+    and the ext ops used follow what the firmware reports at open(), a
+    firmware not answering EXT_HELLO gets the plain ops only. Op sequences
+    repeating recent ones are sent as EXT_REPEAT ops unless compress=0."""
 
-    def __init__(self, device="/dev/ttyUSB0", baudrate=921600):
+    def __init__(self, device="/dev/ttyUSB0", baudrate=921600, compress=1):
         self._baudrate = baudrate
         self._device = device
+        self._compress = bool(compress)
         self._port = None
         self._read_callbacks = collections.deque()
-        self._unprocessed = 0
-        self._pin_state = {k: None for k in PINS}
+        self._out_ops = []  # (op, callbacks) queued
+        self._out_size = 0
+        self._unprocessed = 0  # bytes sent, not yet acknowledged
+        self._rx_buffer_size = RX_BUFFER_SIZE  # until the firmware tells
+        self._write_chunksize = RX_BUFFER_SIZE // WRITE_CHUNKSIZES
+        self._mark_chunksize = PROGRESS_CHUNKSIZE
+        self._loop_time_us = LOOP_TIME_US
+        self.op_bytes = 0
+        self.link_bytes = 0
 
     def get_output_pins(self):
         return set(PINS.keys())
@@ -43,6 +84,7 @@ class Loader(BaseLoader):
     def open(self):
         self._port = serial.Serial(self._device, self._baudrate)
         self._reset()
+        self._hello()
 
     def _reset(self):
         self._port.setDTR(False)
@@ -53,56 +95,286 @@ class Loader(BaseLoader):
         self._port.reset_input_buffer()
         logging.debug("Reset done")
 
+    def _hello(self):
+        "Asks for the capabilities, firmwares without EXT_HELLO skip it"
+        self._port.write(bytes([OP_EXT | EXT_HELLO]))
+        self._link_sent(1)  # received either way
+        self._port.timeout = HELLO_TIMEOUT
+        try:
+            head = self._port.read(2)
+            caps = self._port.read(head[1]) if len(head) == 2 else b""
+        finally:
+            self._port.timeout = None
+        if len(head) < 2 or head[0] != HELLO_REPLY or len(caps) < head[1]:
+            time.sleep(HELLO_TIMEOUT)  # a late reply must not be parsed
+            self._port.reset_input_buffer()  # as responses to the ops
+            logging.warning("d1mini: no reply to EXT_HELLO, update the "
+                            "firmware, using the defaults without ext ops")
+            self._compress = False
+            return
+        self.capabilities = _parse_caps(caps)
+        logging.debug(f"d1mini: {self.capabilities}")
+        self._rx_buffer_size = self.capabilities.buffer_size
+        self._write_chunksize = self._rx_buffer_size // WRITE_CHUNKSIZES
+        self._mark_chunksize = self.capabilities.mark_chunksize
+        self._loop_time_us = math.ceil(self.capabilities.loop_time * 1e6)
+        if self._compress and not self._supports(EXT_REPEAT):
+            logging.warning("d1mini: the firmware can not decompress, "
+                            "compress ignored")
+            self._compress = False
+
+    def _supports(self, ext_code):
+        "Only the ext ops the firmware reported are sent"
+        return self.capabilities is not None \
+            and ext_code in self.capabilities.ext_ops
+
     def close(self):
         if self._port:
             self.flush()
             self._reset()
             self._port.close()
             self._port = None
+            logging.info(f"d1mini: {self.op_bytes} op bytes sent as "
+                         f"{self.link_bytes} bytes "
+                         f"({self.compression_ratio:.2f}x)")
+
+    @property
+    def compression_ratio(self):
+        return self.op_bytes / max(self.link_bytes, 1)
 
     def set_as_input(self, pin):
-        self._send(OP_SET_AS_INPUT | PINS[pin])
-        self._pin_state[pin] = None
+        self._send(bytes([OP_SET_AS_INPUT | PINS[pin]]))
 
     def set_as_output(self, pin):
-        self._send(OP_SET_AS_OUTPUT | PINS[pin])
-        self._pin_state[pin] = None
+        self._send(bytes([OP_SET_AS_OUTPUT | PINS[pin]]))
 
     def set_pin(self, pin, new_state=True):
-        if self._pin_state[pin] != new_state:
-            self._send(
-                (OP_SETPIN_HIGH if new_state else OP_SETPIN_LOW) | PINS[pin])
-            self._pin_state[pin] = new_state
+        self._send(bytes([_encode_set_pin(pin, new_state)]))
+
+    def set_pins(self, new_states):
+        if not self._supports(EXT_PORT_WRITE):
+            return super().set_pins(new_states)
+        self._send(_encode_set_pins(new_states))
 
     def fetch_pin(self, pin, callback):
-        self._read_callbacks.append(callback)
-        self._send(OP_READ | PINS[pin])
+        self._send(bytes([OP_READ | PINS[pin]]), [callback])
 
     def wait(self, seconds):
-        usec = math.ceil(seconds * 1e6)
-        while usec > LOOP_TIME_US:
-            usec -= LOOP_TIME_US
-            n = min(usec, 31)
-            usec -= n
-            self._send(OP_WAIT_US | n)
+        self._send(_encode_wait(seconds, self._loop_time_us,
+                                self._supports(EXT_WAIT_US)))
+
+    def shift(self, clock, data_out, data_in, bits, sample, callback,
+              half_period, sample_late):
+        op = (OP_SHIFT, clock, data_out, data_in, bits, sample, callback,
+              half_period, sample_late)
+        if (data := self.encode_batch([op])) is None:
+            return super().shift(*op[1:])
+        n_samples = sum(i in sample for i in range(len(bits))) \
+            if data_in is not None else 0
+        self.send_encoded(data, [callback] * n_samples)
+
+    def encode_batch(self, ops):
+        data = bytearray()
+        for kind, *args in ops:
+            if kind == OP_SET_PIN:
+                data.append(_encode_set_pin(*args))
+            elif kind == OP_SET_PINS:
+                if not self._supports(EXT_PORT_WRITE):
+                    return None
+                data += _encode_set_pins(args[0])
+            elif kind == OP_FETCH_PIN:
+                data.append(OP_READ | PINS[args[0]])
+            elif kind == OP_WAIT:
+                data += _encode_wait(*args, self._loop_time_us,
+                                     self._supports(EXT_WAIT_US))
+            elif kind == OP_SHIFT:
+                if not self._supports(EXT_SHIFT) \
+                        or (shift := _encode_shift(*args)) is None:
+                    return None
+                data += shift
+            else:
+                return None
+        return bytes(data)
+
+    def send_encoded(self, data, callbacks):
+        callbacks = iter(callbacks)
+        pos = 0
+        while pos < len(data):
+            length, n_reads = _op_info(data, pos)
+            self._send(data[pos:pos + length],
+                       [next(callbacks) for _ in range(n_reads)])
+            pos += length
 
     def flush(self):
         self.fetch_pin("D0", lambda _: 0)
+        self._write_out()
         self._port.flush()
-        self._handle_read()
+        while self._read_callbacks:
+            self._handle_read()
+
+    def _send(self, op, callbacks=()):
+        "Queues one op, written out in frames of a part of the rx buffer"
+        self._out_ops.append((op, callbacks))
+        self._out_size += len(op)
+        if self._out_size >= self._write_chunksize:
+            self._write_out()
+
+    def _write_out(self):
+        "Writes the queued ops once they fit into the firmware's rx buffer"
+        if self._out_ops:
+            frame = self._frame()
+            while self._unprocessed > self._rx_buffer_size:
+                self._handle_read()
+            self._port.write(frame)
+        self._handle_read(block=False)
 
-    def _send(self, cmd):
-        self._unprocessed += self._port.write([cmd])
-        if self._unprocessed % PROGRESS_CHUNKSIZE == 0:
+    def _frame(self):
+        """Encodes the queued ops with the repeats compressed, queues the
+        expected responses in the order the firmware sends them"""
+        ops, self._out_ops, self._out_size = self._out_ops, [], 0
+        data = b"".join(op for op, _ in ops)
+        starts = list(itertools.accumulate(
+            (len(op) for op, _ in ops[:-1]), initial=0))
+        repeats = find_repeats(
+            data, starts, MAX_REPEAT_DISTANCE, MAX_REPEAT_BLOCK,
+            MAX_REPEAT_COUNT, REPEAT_LENGTH) if self._compress else ()
+        frame = bytearray()
+        i = 0
+        end = [(len(data), 0, 0, 0)]
+        for pos, distance, block, count in itertools.chain(repeats, end):
+            while i < len(ops) and starts[i] < pos:
+                op, callbacks = ops[i]
+                frame += op
+                self._read_callbacks.extend(callbacks)
+                self._link_sent(len(op))
+                i += 1
+            if not count:
+                continue
+            frame += bytes([OP_EXT | EXT_REPEAT, distance, block, count])
+            self._link_sent(REPEAT_LENGTH)  # marked before the replay
+            while i < len(ops) and starts[i] < pos + block * count:
+                self._read_callbacks.extend(ops[i][1])
+                i += 1
+        self.op_bytes += len(data)
+        self.link_bytes += len(frame)
+        return frame
+
+    def _link_sent(self, length):
+        "The firmware marks every mark chunksize bytes received"
+        before = self._unprocessed
+        self._unprocessed += length
+        marks = self._unprocessed // self._mark_chunksize \
+            - before // self._mark_chunksize
+        for _ in range(marks):
             self._read_callbacks.append(self._progress_mark_received)
-        while self._unprocessed >= PROGRESS_CHUNKSIZE * 8:
-            self._handle_read(1)
 
     def _progress_mark_received(self, x):
         assert x == PROGRESS_MARK
-        self._unprocessed -= PROGRESS_CHUNKSIZE
+        self._unprocessed -= self._mark_chunksize
 
-    def _handle_read(self, n=None):
-        n = n or len(self._read_callbacks)
-        for b in self._port.read(n):
+    def _handle_read(self, block=True):
+        "Dispatches every response received so far"
+        n = self._port.in_waiting or int(block)
+        for b in self._port.read(n) if n else ():
             self._read_callbacks.popleft()(b)
+
+
+def _encode_set_pin(pin, new_state):
+    return (OP_SETPIN_HIGH if new_state else OP_SETPIN_LOW) | PINS[pin]
+
+
+def _encode_set_pins(new_states):
+    "Changes more than one pin simultaneously by a single port write"
+    if len(new_states) == 1:
+        return bytes([_encode_set_pin(*new_states[0])])
+    set_mask = clear_mask = 0
+    for pin, new_state in new_states:
+        bit = 1 << PORT_PINS.index(pin)
+        if new_state:
+            set_mask, clear_mask = set_mask | bit, clear_mask & ~bit
+        else:
+            set_mask, clear_mask = set_mask & ~bit, clear_mask | bit
+    if not clear_mask:
+        return bytes([OP_EXT | EXT_PORT_SET, set_mask])
+    if not set_mask:
+        return bytes([OP_EXT | EXT_PORT_CLEAR, clear_mask])
+    return bytes([OP_EXT | EXT_PORT_WRITE, set_mask, clear_mask])
+
+
+def _parse_caps(caps):
+    "Decodes the payload of the EXT_HELLO reply"
+    ext_mask = int.from_bytes(caps[4:8], "big")
+    return Capabilities(
+        version=caps[0],
+        buffer_size=int.from_bytes(caps[1:3], "big"),
+        mark_chunksize=caps[3],
+        ext_ops=frozenset(code for code in range(32) if ext_mask >> code & 1),
+        loop_time=caps[8] / 1e6)
+
+
+def _encode_wait(seconds, loop_time_us=LOOP_TIME_US, long_wait=True):
+    result = bytearray()
+    usec = math.ceil(seconds * 1e6)
+    while long_wait and usec > loop_time_us + 31:
+        usec -= loop_time_us
+        n = min(usec, 0xffff)
+        usec -= n
+        result += bytes([OP_EXT | EXT_WAIT_US, n >> 8, n & 0xff])
+    while usec > loop_time_us:
+        usec -= loop_time_us
+        n = min(usec, 31)
+        usec -= n
+        result.append(OP_WAIT_US | n)
+    return result
+
+
+def _encode_shift(clock, data_out, data_in, bits, sample, _callback,
+                  half_period, sample_late):
+    half_us = math.ceil(half_period * 1e6)
+    if half_us > 0xff:
+        return None
+    flags = SHIFT_SAMPLE_LATE if sample_late else 0
+    header = bytes([
+        PINS[clock],
+        NO_PIN if data_out is None else PINS[data_out],
+        NO_PIN if data_in is None else PINS[data_in],
+        flags,
+        half_us,
+    ])
+    result = bytearray()
+    for start in range(0, len(bits), SHIFT_MAX_BITS):
+        chunk = bits[start:start + SHIFT_MAX_BITS]
+        mask = [start + i in sample for i in range(len(chunk))]
+        result.append(OP_EXT | EXT_SHIFT)
+        result += header
+        result.append(len(chunk))
+        result += _pack_bits(chunk)
+        result += _pack_bits(mask)
+    return result
+
+
+def _pack_bits(bits):
+    value = 0
+    for bit in bits:
+        value = value << 1 | bool(bit)
+    pad = -len(bits) % 8
+    return (value << pad).to_bytes((len(bits) + pad) // 8, "big")
+
+
+def _op_info(data, pos):
+    "Returns the length and the number of responses of the op at pos"
+    cmd = data[pos]
+    if cmd & 0xe0 == OP_READ:
+        return 1, 1
+    if cmd in (OP_EXT | EXT_WAIT_US, OP_EXT | EXT_PORT_WRITE):
+        return 3, 0
+    if cmd in (OP_EXT | EXT_PORT_SET, OP_EXT | EXT_PORT_CLEAR):
+        return 2, 0
+    if cmd == OP_EXT | EXT_SHIFT:
+        n_bytes = (data[pos + 6] + 7) // 8
+        mask = data[pos + 7 + n_bytes:pos + 7 + 2 * n_bytes]
+        n_reads = 0
+        if data[pos + 3] != NO_PIN:
+            n_reads = sum(bin(b).count("1") for b in mask)
+        return 7 + 2 * n_bytes, n_reads
+    return 1, 0
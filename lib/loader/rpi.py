@@ -1,5 +1,6 @@
+import contextlib
+import logging
 import sys
-from time import monotonic
 
 try:
     import RPi.GPIO as GPIO
@@ -9,6 +10,7 @@ except ModuleNotFoundError:
     raise ModuleNotFoundError("install module 'RPi'")
 
 from lib.interfaces import BaseLoader
+from misc.waiter import parse_cpus, realtime, Waiter
 
 
 NON_GPIO = {1, 2, 4, 6, 9, 14, 17, 20, 25, 30, 34, 39, 27, 28}
@@ -17,6 +19,17 @@ LOOP_TIME = 1e-6
 
 
 class Loader(BaseLoader):
+    """RPi.GPIO driver. Long waits sleep and spin only at their end. The
+    session may run with SCHED_FIFO priority, pinned to cpus (3 or 2+3) and
+    with mlockall, jitter logs the lateness of the waits at close."""
+
+    def __init__(self, priority=None, cpus=None, mlock=False, spin_us=None,
+                 jitter=False):
+        spin_time = None if spin_us is None else int(spin_us) / 1e6
+        self._waiter = Waiter(spin_time, jitter)
+        self._realtime_args = (priority, parse_cpus(cpus), mlock)
+        self._session = contextlib.ExitStack()
+
     def get_output_pins(self):
         return PINS
 
@@ -24,10 +37,14 @@ class Loader(BaseLoader):
         return PINS
 
     def open(self):
+        self._session.enter_context(realtime(*self._realtime_args))
         GPIO.setmode(GPIO.BOARD)
 
     def close(self):
         GPIO.cleanup()
+        self._session.close()
+        if self._waiter.stats is not None:
+            logging.info(f"rpi: {self._waiter.stats}")
 
     def set_as_input(self, pin):
         GPIO.setup(pin, GPIO.IN)
@@ -43,9 +60,22 @@ class Loader(BaseLoader):
 
     def wait(self, seconds):
         if seconds > LOOP_TIME:
-            wake_ts = monotonic() + seconds
-            while wake_ts > monotonic():
-                pass
+            self._waiter.wait(seconds)
+
+    def shift(self, clock, data_out, data_in, bits, sample, callback,
+              half_period, sample_late):
+        for i, bit in enumerate(bits):
+            sampled = data_in is not None and i in sample
+            if data_out is not None:
+                output(data_out, HIGH if bit else LOW)
+            self.wait(half_period)
+            output(clock, HIGH)
+            self.wait(half_period)
+            if sampled and not sample_late:
+                callback(input(data_in))
+            output(clock, LOW)
+            if sampled and sample_late:
+                callback(input(data_in))
 
     def flush(self):
         pass
@@ -0,0 +1,142 @@
+import contextlib
+import logging
+import mmap
+import os
+
+from lib.interfaces import BaseLoader, OP_FETCH_PIN
+from misc.waiter import parse_cpus, realtime, Waiter
+
+
+# board pin: BCM gpio, the numbering of the rpi loader
+BOARD_TO_BCM = {3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27,
+                15: 22, 16: 23, 18: 24, 19: 10, 21: 9, 22: 25, 23: 11,
+                24: 8, 26: 7, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19, 36: 16,
+                37: 26, 38: 20, 40: 21}
+PINS = set(BOARD_TO_BCM)
+BLOCK_SIZE = 4096
+# 32 bit register indices of the BCM283x GPIO block
+GPFSEL0 = 0x00 // 4
+GPSET0 = 0x1c // 4
+GPCLR0 = 0x28 // 4
+GPLEV0 = 0x34 // 4
+FSEL_INPUT = 0b000
+FSEL_OUTPUT = 0b001
+LOOP_TIME = 1e-7
+
+
+class Loader(BaseLoader):
+    """RPi driver writing the GPIO registers through /dev/gpiomem,
+    any file of BLOCK_SIZE bytes can stand in for the register block. The
+    waits and realtime options are the ones of the rpi loader."""
+
+    def __init__(self, device="/dev/gpiomem", priority=None, cpus=None,
+                 mlock=False, spin_us=None, jitter=False):
+        self._device = device
+        self._mmap = None
+        self._regs = None
+        self._used = set()
+        spin_time = None if spin_us is None else int(spin_us) / 1e6
+        self._waiter = Waiter(spin_time, jitter)
+        self._realtime_args = (priority, parse_cpus(cpus), mlock)
+        self._session = contextlib.ExitStack()
+
+    def get_output_pins(self):
+        return PINS
+
+    def get_input_pins(self):
+        return PINS
+
+    def open(self):
+        self._session.enter_context(realtime(*self._realtime_args))
+        fd = os.open(self._device, os.O_RDWR | os.O_SYNC)
+        try:
+            self._mmap = mmap.mmap(fd, BLOCK_SIZE)
+        finally:
+            os.close(fd)
+        self._regs = memoryview(self._mmap).cast("I")
+
+    def close(self):
+        if self._mmap:
+            for pin in self._used:  # like GPIO.cleanup()
+                self._set_function(pin, FSEL_INPUT)
+            self._regs.release()
+            self._mmap.close()
+            self._mmap = self._regs = None
+        self._session.close()
+        if self._waiter.stats is not None:
+            logging.info(f"rpi_gpiomem: {self._waiter.stats}")
+
+    def set_as_input(self, pin):
+        self._set_function(pin, FSEL_INPUT)
+
+    def set_as_output(self, pin):
+        self._set_function(pin, FSEL_OUTPUT)
+
+    def set_pin(self, pin, new_state):
+        self._regs[GPSET0 if new_state else GPCLR0] = 1 << BOARD_TO_BCM[pin]
+
+    def set_pins(self, new_states):
+        "Changes every pin with at most one set and one clear access"
+        set_mask = clear_mask = 0
+        for pin, new_state in new_states:
+            if new_state:
+                set_mask |= 1 << BOARD_TO_BCM[pin]
+            else:
+                clear_mask |= 1 << BOARD_TO_BCM[pin]
+        if set_mask:
+            self._regs[GPSET0] = set_mask
+        if clear_mask:
+            self._regs[GPCLR0] = clear_mask
+
+    def fetch_pin(self, pin, callback):
+        callback(self._regs[GPLEV0] >> BOARD_TO_BCM[pin] & 1)
+
+    def wait(self, seconds):
+        if seconds > LOOP_TIME:
+            self._waiter.wait(seconds)
+
+    def shift(self, clock, data_out, data_in, bits, sample, callback,
+              half_period, sample_late):
+        regs = self._regs
+        clock_mask = 1 << BOARD_TO_BCM[clock]
+        dout_mask = din_shift = None
+        if data_out is not None:
+            dout_mask = 1 << BOARD_TO_BCM[data_out]
+        if data_in is not None:
+            din_shift = BOARD_TO_BCM[data_in]
+        for i, bit in enumerate(bits):
+            sampled = din_shift is not None and i in sample
+            if dout_mask is not None:
+                regs[GPSET0 if bit else GPCLR0] = dout_mask
+            self.wait(half_period)
+            regs[GPSET0] = clock_mask
+            self.wait(half_period)
+            if sampled and not sample_late:
+                callback(regs[GPLEV0] >> din_shift & 1)
+            regs[GPCLR0] = clock_mask
+            if sampled and sample_late:
+                callback(regs[GPLEV0] >> din_shift & 1)
+
+    def run_batch(self, ops):
+        "Consecutive fetches are served from a single level access"
+        start = 0
+        for i, op in enumerate(ops):
+            if op[0] != OP_FETCH_PIN:
+                continue
+            if i == 0 or ops[i - 1][0] != OP_FETCH_PIN:
+                super().run_batch(ops[start:i])
+                levels = self._regs[GPLEV0]
+            _, pin, callback = op
+            callback(levels >> BOARD_TO_BCM[pin] & 1)
+            start = i + 1
+        super().run_batch(ops[start:])
+
+    def flush(self):
+        pass
+
+    def _set_function(self, pin, function):
+        bcm = BOARD_TO_BCM[pin]
+        index, shift = GPFSEL0 + bcm // 10, bcm % 10 * 3
+        self._regs[index] = \
+            self._regs[index] & ~(0b111 << shift) | function << shift
+        self._used.add(pin)
@@ -1,30 +1,90 @@
 import collections
+import logging
 import math
 import socket
+import time
 
-from lib.interfaces import BaseLoader
+from lib.compress import find_repeats
+from lib.interfaces import (BaseLoader, Capabilities, OP_FETCH_PIN,
+                            OP_SET_PIN, OP_SET_PINS, OP_SHIFT, OP_WAIT)
 import misc.rpi_tcpserver as RT
 
 
 NON_GPIO = {1, 2, 4, 6, 9, 14, 17, 20, 25, 27, 28, 30, 34, 39}
 PINS = set(range(1, 41)) - NON_GPIO
-LOOP_TIME_100NS = 10
+LOOP_TIME_100NS = 10  # until the server tells
+SEND_CHUNKSIZE = 4096
+MAX_WINDOW_OPS = 16 * RT.PROGRESS_CHUNKSIZE
+REPEAT_LENGTH = 8
+MAX_REPEAT_COUNT = 0xffff
+HELLO_TIMEOUT = 5.0
 
 
 class Loader(BaseLoader):
-    def __init__(self, host='localhost', port=30456):
+    """Client of misc/rpi_tcpserver.py. The credit window, the marks and
+    the wait compensation follow what the server reports at open(). With
+    compress=1 op sequences repeating recent ones are sent as EXT_REPEAT
+    ops."""
+
+    def __init__(self, host='localhost', port=30456, compress=0):
         self._remote_address = (host, port)
-        self._read_callbacks = collections.deque()
+        self._compress = bool(compress)
+        self._read_callbacks = collections.deque()  # [callback, n_reads]
         self._s = socket.socket()
-        self._pin_state = {k: None for k in PINS}
-        self._unprocessed = 0
+        self._out_buffer = bytearray()
+        self._out_starts = []  # of the queued ops
+        self._in_buffer = bytearray()
+        self._unprocessed = 0  # ops queued or sent, not yet acknowledged
+        self._pending_flushes = 0
+        self._window = RT.PROGRESS_CHUNKSIZE  # until the server tells
+        self._mark_chunksize = RT.PROGRESS_CHUNKSIZE
+        self._loop_time_100ns = LOOP_TIME_100NS
+        self._hello_pending = False
+        self._open_ts = None
+        self.ops_sent = 0
+        self.bytes_sent = 0
+        self.op_bytes = 0
 
     def open(self):
         self._s.connect(self._remote_address)
+        self._s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        self._open_ts = time.monotonic()
+        self._hello_pending = True
+        self._send(bytes([RT.OP_EXT | RT.EXT_HELLO, 1,
+                          RT.PROTOCOL_VERSION]))
+        self._write_out()
+        self._s.settimeout(HELLO_TIMEOUT)
+        try:
+            while self._hello_pending:
+                self._handle_recv()
+        except socket.timeout:
+            raise Exception("rpi_remote: no reply to EXT_HELLO, is it "
+                            "rpi_tcpserver listening?") from None
+        finally:
+            self._s.settimeout(None)
+        logging.debug(f"credit window: {self._window} ops, "
+                      f"{self.capabilities}")
+        if self._compress and (self.capabilities is None
+                               or RT.EXT_REPEAT
+                               not in self.capabilities.ext_ops):
+            logging.warning("rpi_remote: the server can not decompress, "
+                            "compress ignored")
+            self._compress = False
 
     def close(self):
         self.flush()
         self._s.close()
+        logging.info(f"rpi_remote: {self.ops_per_second:.0f} ops/s, "
+                     f"{self.bytes_per_second:.0f} bytes/s, "
+                     f"{self.op_bytes} op bytes sent as {self.bytes_sent}")
+
+    @property
+    def ops_per_second(self):
+        return self.ops_sent / self._elapsed()
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes_sent / self._elapsed()
 
     def get_output_pins(self):
         return PINS
@@ -33,55 +93,266 @@ class Loader(BaseLoader):
         return PINS
 
     def set_as_input(self, pin):
-        self._send(RT.OP_SET_AS_INPUT, pin)
-        self._pin_state[pin] = None
+        self._send(bytes([RT.OP_SET_AS_INPUT, pin]))
 
     def set_as_output(self, pin):
-        self._send(RT.OP_SET_AS_OUTPUT, pin)
-        self._pin_state[pin] = None
+        self._send(bytes([RT.OP_SET_AS_OUTPUT, pin]))
 
     def set_pin(self, pin, new_state):
-        if self._pin_state[pin] != new_state:
-            self._send(
-                RT.OP_SETPIN_HIGH if new_state else RT.OP_SETPIN_LOW,
-                pin)
-            self._pin_state[pin] = new_state
+        self._send(_encode_set_pin(pin, new_state))
 
     def fetch_pin(self, pin, callback):
-        self._read_callbacks.append(callback)
-        self._send(RT.OP_READPIN, pin)
+        self._send(bytes([RT.OP_READPIN, pin]), [callback])
 
     def wait(self, seconds):
-        ns100 = math.ceil(seconds * 1e7)
-        while ns100 > LOOP_TIME_100NS:
-            n = min(ns100, 2**13)
-            ns100 -= n
-            n -= 1
-            self._send(RT.OP_WAIT_100NS | (n >> 8), n & 0xff)
+        self.send_encoded(_encode_wait(seconds, self._loop_time_100ns), ())
 
-    def flush(self):
-        self._read_callbacks.append(lambda _: 0)
-        self._send(RT.OP_FLUSH, 0)
-        self._handle_recv(block=True)
+    def shift(self, clock, data_out, data_in, bits, sample, callback,
+              half_period, sample_late):
+        op = (OP_SHIFT, clock, data_out, data_in, bits, sample, callback,
+              half_period, sample_late)
+        if (data := self.encode_batch([op])) is None:
+            return super().shift(*op[1:])
+        n_samples = sum(i in sample for i in range(len(bits))) \
+            if data_in is not None else 0
+        self.send_encoded(data, [callback] * n_samples)
 
-    def _progress_mark_received(self, x):
-        assert x == int.from_bytes(RT.PROGRESS_MARK, 'big')
-        self._unprocessed -= RT.PROGRESS_CHUNKSIZE
+    def encode_batch(self, ops):
+        data = bytearray()
+        for kind, *args in ops:
+            if kind == OP_SET_PIN:
+                data += _encode_set_pin(*args)
+            elif kind == OP_SET_PINS:
+                for pin, new_state in args[0]:
+                    data += _encode_set_pin(pin, new_state)
+            elif kind == OP_FETCH_PIN:
+                data += bytes([RT.OP_READPIN, args[0]])
+            elif kind == OP_WAIT:
+                data += _encode_wait(*args, self._loop_time_100ns)
+            elif kind == OP_SHIFT:
+                if (shift := _encode_shift(*args)) is None:
+                    return None
+                data += shift
+            else:
+                return None
+        return bytes(data)
+
+    def send_encoded(self, data, callbacks):
+        callbacks = iter(callbacks)
+        pos = 0
+        while pos < len(data):
+            length, n_reads = _op_info(data, pos)
+            self._send(data[pos:pos + length],
+                       [next(callbacks) for _ in range(n_reads)])
+            pos += length
+
+    def flush(self):
+        self._pending_flushes += 1
+        self._send(bytes([RT.OP_FLUSH, 0]))
+        self._write_out()
+        while self._pending_flushes:
+            self._handle_recv()
 
-    def _send(self, cmd, arg):
-        self._s.send(bytes([cmd, arg]))  # TODO handle exception
+    def _send(self, op, callbacks=()):
+        "Queues one op, the server marks every PROGRESS_CHUNKSIZE ops"
+        expected = self._read_callbacks
+        for callback in callbacks:
+            if expected and expected[-1][0] == callback:
+                expected[-1][1] += 1
+            else:
+                expected.append([callback, 1])
+        self._out_starts.append(len(self._out_buffer))
+        self._out_buffer += op
         self._unprocessed += 1
-        if self._unprocessed % RT.PROGRESS_CHUNKSIZE == 0:
-            self._read_callbacks.append(self._progress_mark_received)
-        if self._unprocessed >= RT.PROGRESS_CHUNKSIZE * 8 \
-                or len(self._read_callbacks) >= 512:
+        self.ops_sent += 1
+        if len(self._out_buffer) >= SEND_CHUNKSIZE \
+                or self._unprocessed >= self._window:
+            self._write_out()
+
+    def _write_out(self):
+        "Sends the queued ops, waits for credit while the window is full"
+        if self._out_buffer:
+            data = self._out_buffer
+            if self._compress:
+                data = _compress(data, self._out_starts)
+            self._s.sendall(data)  # TODO handle exception
+            self.op_bytes += len(self._out_buffer)
+            self.bytes_sent += len(data)
+            self._out_buffer.clear()
+            self._out_starts.clear()
+        while self._unprocessed >= self._window:
             self._handle_recv()
+        self._handle_recv(block=False)
 
-    def _handle_recv(self, block=False):
-        while self._read_callbacks:
-            if not (resp := self._s.recv(512)):
+    def _handle_recv(self, block=True):
+        "Processes the received responses, waits for one chunk if block"
+        flags = 0 if block else socket.MSG_DONTWAIT
+        while True:
+            try:
+                resp = self._s.recv(2 ** 16, flags)
+            except BlockingIOError:
+                return
+            if not resp:
                 raise Exception("Connection lost.")  # TODO
-            for b in resp:
-                self._read_callbacks.popleft()(b)
-            if not block:
+            self._in_buffer += resp
+            self._parse_responses()
+            if block:
                 return
+
+    def _parse_responses(self):
+        data = self._in_buffer
+        pos = 0
+        while pos < len(data):
+            kind = data[pos:pos + 1]
+            if kind == RT.PROGRESS_MARK:
+                self._unprocessed -= self._mark_chunksize
+                pos += 1
+            elif kind == RT.FLUSH_DONE:
+                self._pending_flushes -= 1
+                pos += 1
+            elif kind == RT.READ_BITS:
+                if pos + 5 > len(data):
+                    break
+                n_bits = int.from_bytes(data[pos + 1:pos + 5], 'big')
+                end = pos + 5 + (n_bits + 7) // 8
+                if end > len(data):
+                    break
+                self._dispatch_bits(data[pos + 5:end], n_bits)
+                pos = end
+            elif kind == RT.CAPS_REPLY:
+                if pos + 2 > len(data) or pos + 2 + data[pos + 1] > len(data):
+                    break
+                end = pos + 2 + data[pos + 1]
+                self._apply_capabilities(_parse_caps(data[pos + 2:end]))
+                self._hello_pending = False
+                pos = end
+            else:  # its length is unknown, the rest can not be parsed
+                raise Exception(f"rpi_remote: invalid response {kind.hex()}"
+                                f", server protocol mismatch?")
+        del data[:pos]
+
+    def _apply_capabilities(self, caps):
+        self.capabilities = caps
+        self._window = _window(caps.buffer_size, caps.mark_chunksize)
+        self._mark_chunksize = caps.mark_chunksize
+        self._loop_time_100ns = math.ceil(caps.loop_time * 1e7)
+
+    def _dispatch_bits(self, packed, n_bits):
+        "Hands the read bits to the callbacks, in bulk where they take it"
+        value = int.from_bytes(packed, 'big')
+        remaining = len(packed) * 8
+        while n_bits:
+            entry = self._read_callbacks[0]
+            callback, n = entry[0], min(entry[1], n_bits)
+            remaining -= n
+            bits = (value >> remaining) & ((1 << n) - 1)
+            if extend_packed := getattr(callback, "extend_packed", None):
+                pad = -n % 8
+                extend_packed(
+                    (bits << pad).to_bytes((n + pad) // 8, 'big'), n)
+            else:
+                for i in reversed(range(n)):
+                    callback(bits >> i & 1)
+            n_bits -= n
+            entry[1] -= n
+            if not entry[1]:
+                self._read_callbacks.popleft()
+
+    def _elapsed(self):
+        return max(time.monotonic() - (self._open_ts or 0), 1e-9)
+
+
+def _window(buffer_size, mark_chunksize):
+    "The credit window, a mark must arrive before it is full"
+    return max(min(buffer_size, MAX_WINDOW_OPS), mark_chunksize)
+
+
+def _encode_set_pin(pin, new_state):
+    return bytes([RT.OP_SETPIN_HIGH if new_state else RT.OP_SETPIN_LOW, pin])
+
+
+def _parse_caps(caps):
+    "Decodes the payload of a CAPS_REPLY"
+    ext_mask = int.from_bytes(caps[5:9], "big")
+    return Capabilities(
+        version=caps[0],
+        buffer_size=int.from_bytes(caps[1:3], "big"),
+        mark_chunksize=int.from_bytes(caps[3:5], "big"),
+        ext_ops=frozenset(code for code in range(32) if ext_mask >> code & 1),
+        loop_time=int.from_bytes(caps[9:11], "big") / 1e7)
+
+
+def _encode_wait(seconds, loop_time_100ns=LOOP_TIME_100NS):
+    result = bytearray()
+    ns100 = math.ceil(seconds * 1e7)
+    if ns100 > 2**13:
+        payload = min(ns100, 2**32 - 1).to_bytes(4, "big")
+        result += bytes([RT.OP_EXT | RT.EXT_WAIT_100NS, 4]) + payload
+        ns100 -= int.from_bytes(payload, "big")
+    while ns100 > loop_time_100ns:
+        n = min(ns100, 2**13)
+        ns100 -= n
+        n -= 1
+        result += bytes([RT.OP_WAIT_100NS | (n >> 8), n & 0xff])
+    return result
+
+
+def _encode_shift(clock, data_out, data_in, bits, sample, _callback,
+                  half_period, sample_late):
+    half = math.ceil(half_period * 1e7)
+    if half > 0xffff:
+        return None
+    flags = RT.SHIFT_SAMPLE_LATE if sample_late else 0
+    header = bytes([
+        clock,
+        RT.NO_PIN if data_out is None else data_out,
+        RT.NO_PIN if data_in is None else data_in,
+        flags,
+    ]) + half.to_bytes(2, "big")
+    result = bytearray()
+    for start in range(0, len(bits), RT.SHIFT_MAX_BITS):
+        chunk = bits[start:start + RT.SHIFT_MAX_BITS]
+        mask = [start + i in sample for i in range(len(chunk))]
+        payload = header + len(chunk).to_bytes(2, "big") \
+            + _pack_bits(chunk) + _pack_bits(mask)
+        result += bytes([RT.OP_EXT | RT.EXT_SHIFT, len(payload)]) + payload
+    return result
+
+
+def _pack_bits(bits):
+    value = 0
+    for bit in bits:
+        value = value << 1 | bool(bit)
+    pad = -len(bits) % 8
+    return (value << pad).to_bytes((len(bits) + pad) // 8, "big")
+
+
+def _compress(data, starts):
+    "Replaces the op sequences repeating recent ones with EXT_REPEAT ops"
+    result = bytearray()
+    pos = 0
+    for start, distance, block, count in find_repeats(
+            data, starts, RT.MAX_REPEAT_DISTANCE, RT.MAX_REPEAT_DISTANCE,
+            MAX_REPEAT_COUNT, REPEAT_LENGTH):
+        result += data[pos:start]
+        result += bytes([RT.OP_EXT | RT.EXT_REPEAT, REPEAT_LENGTH - 2]) \
+            + distance.to_bytes(2, "big") + block.to_bytes(2, "big") \
+            + count.to_bytes(2, "big")
+        pos = start + block * count
+    return result + data[pos:]
+
+
+def _op_info(data, pos):
+    "Returns the length and the number of responses of the op at pos"
+    op = data[pos]
+    if op == RT.OP_READPIN:
+        return 2, 1
+    if op & 0xe0 != RT.OP_EXT:
+        return 2, 0
+    length = 2 + data[pos + 1]
+    n_reads = 0
+    if op == RT.OP_EXT | RT.EXT_SHIFT and data[pos + 4] != RT.NO_PIN:
+        n_bytes = (length - 10) // 2
+        mask = data[pos + length - n_bytes:pos + length]
+        n_reads = sum(bin(b).count("1") for b in mask)
+    return length, n_reads
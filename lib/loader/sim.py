@@ -0,0 +1,95 @@
+import logging
+import os
+import time
+
+from lib.interfaces import BaseLoader
+from lib.sim.avr import AvrJtag, AvrSpi, CHIPS
+from lib.sim.ee25lc040 import Ee25lc040, SIZE as EE25LC040_SIZE
+from lib.sim.ee93lcx6 import Ee93lcx6, MODEL_TO_SIZE
+
+
+def create_device(device):
+    "Memory and pin models of a simulated device"
+    if device.startswith("ee93lc") and device[6:].isdigit():
+        model = int(device[6:])
+        if model in MODEL_TO_SIZE:
+            memory = bytearray(b"\xff" * MODEL_TO_SIZE[model])
+            return memory, [Ee93lcx6(memory, model)]
+    elif device == "ee25lc040":
+        memory = bytearray(b"\xff" * EE25LC040_SIZE)
+        return memory, [Ee25lc040(memory)]
+    elif device in CHIPS:
+        chip = CHIPS[device]
+        memory = bytearray(b"\xff" * chip.flash_size)
+        models = [AvrSpi(memory, chip)]
+        if chip.jtag_partno:
+            models.append(AvrJtag(memory, chip))
+        return memory, models
+    raise ValueError(f"Unknown simulated device ({device})")
+
+
+class Loader(BaseLoader):
+    """Simulated device, no hardware needed. The pins are named after the
+    device pins (CS, SCK, ...), waits only advance a virtual clock. The memory
+    is kept in the optional raw image file between runs."""
+
+    def __init__(self, device="ee25lc040", image=None):
+        self._memory, self._models = create_device(device)
+        self._image = image
+        self._inputs = {}  # pin: models listening to it
+        self._outputs = {}  # pin: model driving it
+        for model in self._models:
+            for pin in model.inputs:
+                self._inputs.setdefault(pin, []).append(model)
+            for pin in model.outputs:
+                self._outputs[pin] = model
+        self.pin_writes = 0
+        self.fetches = 0
+        self.virtual_time = 0.0
+        self._open_ts = None
+
+    def get_output_pins(self):
+        return set(self._inputs)
+
+    def get_input_pins(self):
+        return set(self._outputs)
+
+    def open(self):
+        if self._image and os.path.exists(self._image):
+            with open(self._image, "rb") as f:
+                data = f.read(len(self._memory))
+            self._memory[:len(data)] = data
+        self._open_ts = time.monotonic()
+
+    def close(self):
+        if self._image:
+            with open(self._image, "wb") as f:
+                f.write(self._memory)
+        if self._open_ts is not None:
+            logging.info(f"sim: {self.pin_writes} pin writes, "
+                         f"{self.fetches} fetches, "
+                         f"{self.virtual_time:.6f}s device time, "
+                         f"{time.monotonic() - self._open_ts:.3f}s wall time")
+
+    def set_as_output(self, pin):
+        pass
+
+    def set_as_input(self, pin):
+        pass
+
+    def set_pin(self, pin, new_state):
+        self.pin_writes += 1
+        for model in self._inputs[pin]:
+            model.set_pin(pin, new_state)
+
+    def fetch_pin(self, pin, callback):
+        self.fetches += 1
+        callback(self._outputs[pin].get_pin(pin))
+
+    def wait(self, seconds):
+        self.virtual_time += seconds
+        for model in self._models:
+            model.now = self.virtual_time
+
+    def flush(self):
+        pass
@@ -0,0 +1,305 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+from typing import Optional
+
+from lib.interfaces import (BaseLoader, Capabilities, Mem, op_callbacks,
+                            OP_FETCH_PIN, OP_SET_PIN, OP_SET_PINS, OP_SHIFT,
+                            OP_WAIT, ProgressIndicator, shift_ops)
+from lib.optimizer import OpOptimizer
+from lib.pinproxy import IGNORED, IGNORED_MARK, ThePinProxy
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+SEGMENT_SIZE = 2 ** 16  # max bytes per send_encoded() of a replay
+SUFFIX = ".ops"
+# target args making the op stream follow what the chip answers
+READ_DEPENDENT_ARGS = ("incremental", "poll")
+
+
+class CacheMismatchError(Exception):
+    "The device answered differently than at the recording"
+
+
+class Recorder(BaseLoader):
+    """Sends the ops through encode_batch() and send_encoded() of the
+    loader and records the encoded stream, the directions set in between
+    and the fetched bits. A send fetching bits ends its segment, the replay
+    checks them before the ops following it go out."""
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._records = []  # ["out"|"in", pin], ["ops", offset, size, reads]
+        self._data = bytearray()
+        self._reads = []  # the fetched bits
+        self._wrappers = {}  # callback: recording callback
+        self.complete = True  # every op is in the recording
+
+    @property
+    def capabilities(self):
+        return self._loader.capabilities
+
+    def open(self):
+        self._loader.open()
+
+    def close(self):
+        self._loader.close()
+
+    def get_output_pins(self):
+        return self._loader.get_output_pins()
+
+    def get_input_pins(self):
+        return self._loader.get_input_pins()
+
+    def set_as_output(self, pin):
+        self._records.append(["out", pin])
+        self._loader.set_as_output(pin)
+
+    def set_as_input(self, pin):
+        self._records.append(["in", pin])
+        self._loader.set_as_input(pin)
+
+    def set_pin(self, pin, new_state):
+        self.run_batch([(OP_SET_PIN, pin, new_state)])
+
+    def set_pins(self, new_states):
+        self.run_batch([(OP_SET_PINS, tuple(new_states))])
+
+    def fetch_pin(self, pin, callback):
+        self.run_batch([(OP_FETCH_PIN, pin, callback)])
+
+    def wait(self, seconds):
+        self.run_batch([(OP_WAIT, seconds)])
+
+    def shift(self, *args):
+        self.run_batch([(OP_SHIFT, *args)])
+
+    def flush(self):
+        self._loader.flush()
+
+    def run_batch(self, ops):
+        if (data := self._loader.encode_batch(ops)) is not None:
+            self.send_encoded(data, op_callbacks(ops))
+        elif len(ops) > 1:
+            for op in ops:
+                self.run_batch([op])
+        elif ops[0][0] == OP_SHIFT:
+            self.run_batch(list(shift_ops(*ops[0][1:])))
+        elif ops[0][0] == OP_SET_PINS:
+            self.run_batch([(OP_SET_PIN, *state) for state in ops[0][1]])
+        else:
+            self.complete = False
+            self._loader.run_batch(ops)
+
+    def encode_batch(self, ops):
+        return self._loader.encode_batch(ops)
+
+    def send_encoded(self, data, callbacks):
+        last = self._records[-1] if self._records else None
+        if not last or last[0] != "ops" or last[2] >= SEGMENT_SIZE \
+                or last[3]:
+            last = ["ops", len(self._data), 0, 0]
+            self._records.append(last)
+        self._data += data
+        last[2] += len(data)
+        last[3] += len(callbacks)
+        self._loader.send_encoded(data, [self._recording(callback)
+                                         for callback in callbacks])
+
+    def save(self, path, capabilities):
+        "Writes the recording, a JSON header line followed by the data"
+        header = {
+            "records": self._records,
+            "size": len(self._data),
+            "loop_time": capabilities and capabilities.loop_time,
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as writer:
+            writer.write(json.dumps(header).encode() + b"\n")
+            writer.write(self._data)
+            writer.write(_pack_bits(self._reads))
+        os.replace(tmp_path, path)
+
+    def _recording(self, callback):
+        if (wrapper := self._wrappers.get(callback)) is None:
+            def wrapper(bit):
+                self._reads.append(bit)
+                callback(bit)
+            self._wrappers[callback] = wrapper
+        return wrapper
+
+
+def cache_key(job, capabilities: Optional[Capabilities], mem: Mem) -> str:
+    """
+    Name of the recording of a job. The loader args (device, host) are
+    left out, a recording serves every loader of the kind.
+
+    :param job: the job, see lib.runner.Job
+    :type job: Job
+    :param capabilities: reported by the loader, None if it has none
+    :type capabilities: Optional[Capabilities]
+    :param mem: the image to write
+    :type mem: Mem
+
+    :return: hex digest of the fields the op stream depends on
+    :rtype: str
+    """
+    protocol = None
+    if capabilities is not None:
+        protocol = [capabilities.version, sorted(capabilities.ext_ops)]
+    fields = {
+        "cache": CACHE_VERSION,
+        "loader": job.loader,
+        "protocol": protocol,
+        "target": job.target,
+        "target_args": dict(job.target_args),
+        "pinmap": dict(job.pinmap),
+        "image": hashlib.sha256(
+            json.dumps(sorted(mem.items())).encode()).hexdigest(),
+    }
+    return hashlib.sha256(json.dumps(
+        fields, sort_keys=True,
+        default=lambda o: IGNORED_MARK if o is IGNORED else str(o),
+    ).encode()).hexdigest()
+
+
+def replay(loader: BaseLoader, path: str,
+           progressbar: ProgressIndicator) -> None:
+    """
+    Streams a recording to the opened loader straight from the mmapped
+    file. The fetched bits are compared to the recorded ones after every
+    segment fetching any, nothing recorded after a mismatching fetch is
+    sent.
+
+    :param loader: the loader, opened
+    :type loader: BaseLoader
+    :param path: the recording
+    :type path: str
+    :param progressbar: progress of the replay
+    :type progressbar: ProgressIndicator
+
+    :raises CacheMismatchError: if a fetched bit differs
+    """
+    with open(path, "rb") as reader, \
+            mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        header = json.loads(m.readline())
+        start, size = m.tell(), header["size"]
+        view = memoryview(m)
+        checker = _ReadChecker(view[start + size:])
+        for kind, *args in header["records"]:
+            if kind == "out":
+                loader.set_as_output(args[0])
+            elif kind == "in":
+                loader.set_as_input(args[0])
+            else:
+                offset, length, n_reads = args
+                loader.send_encoded(
+                    view[start + offset:start + offset + length],
+                    [checker] * n_reads)
+                if n_reads:
+                    loader.flush()
+                    if checker.mismatches:
+                        break
+                progressbar.update(offset + length, size)
+        loader.flush()
+        checker.release()
+        view.release()
+    if checker.mismatches:
+        raise CacheMismatchError(
+            f"{checker.mismatches} of {checker.count} fetched bits differ "
+            f"from the recording {path}")
+
+
+def run_cached(job, target, loader: BaseLoader,
+               progressbar: ProgressIndicator,
+               mem: Mem) -> Optional[Mem]:
+    """
+    Runs a write target op of a job, replaying the recording of an earlier
+    run from job.cache_dir if there is one, recording it otherwise.
+
+    :param job: the job, see lib.runner.Job
+    :type job: Job
+    :param target: the target op of the job
+    :type target: TargetOp
+    :param loader: the loader of the job, not opened yet
+    :type loader: BaseLoader
+    :param progressbar: progress of the run
+    :type progressbar: ProgressIndicator
+    :param mem: the image to write
+    :type mem: Mem
+
+    :return: what the target op returned, None when replayed
+    :rtype: Optional[Mem]
+    """
+    target_args = target.args(**job.target_args)
+    reason = None
+    if follows := [name for name in READ_DEPENDENT_ARGS
+                   if target_args.get(name)]:
+        reason = f"{job.target} with {', '.join(follows)} acts on what " \
+            f"the chip answers"
+    elif loader.encode_batch([]) is None:
+        reason = f"{job.loader} has no encoded op stream"
+    if reason:
+        logger.warning(f"{reason}, not cached")
+        with ThePinProxy(OpOptimizer(loader), job.pinmap) as pinproxy:
+            return target(pinproxy, progressbar, mem, **job.target_args)
+
+    recorder = Recorder(loader)
+    with ThePinProxy(OpOptimizer(recorder), job.pinmap) as pinproxy:
+        capabilities = loader.capabilities
+        path = os.path.join(job.cache_dir,
+                            cache_key(job, capabilities, mem) + SUFFIX)
+        if _is_usable(path, capabilities):
+            logger.info(f"replaying {path}")
+            replay(loader, path, progressbar)
+            return None
+        mem_out = target(pinproxy, progressbar, mem, **job.target_args)
+        pinproxy.flush()
+        if recorder.complete:
+            os.makedirs(job.cache_dir, exist_ok=True)
+            recorder.save(path, capabilities)
+            logger.info(f"recorded {path}")
+        else:
+            logger.warning(f"{job.loader} can not encode every op, "
+                           f"not cached")
+    return mem_out
+
+
+def _is_usable(path, capabilities):
+    "Waits shortened by more than the loop time would be too short"
+    try:
+        with open(path, "rb") as reader:
+            header = json.loads(reader.readline())
+    except FileNotFoundError:
+        return False
+    return capabilities is None \
+        or capabilities.loop_time >= header["loop_time"]
+
+
+class _ReadChecker:
+    "Callback of the replayed fetches, counts the bits not as recorded"
+
+    def __init__(self, packed):
+        self._packed = packed
+        self.count = 0
+        self.mismatches = 0
+
+    def __call__(self, bit):
+        i = self.count
+        expected = self._packed[i >> 3] >> (7 - (i & 7)) & 1
+        if bool(bit) != expected:
+            self.mismatches += 1
+        self.count += 1
+
+    def release(self):
+        self._packed.release()
+
+
+def _pack_bits(bits):
+    digits = "".join("1" if bit else "0" for bit in bits)
+    digits += "0" * (-len(digits) % 8)
+    return int(digits or "0", 2).to_bytes(len(digits) // 8, "big")
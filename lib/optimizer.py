@@ -0,0 +1,161 @@
+import logging
+
+from lib.interfaces import (BaseLoader, OP_SET_PIN, OP_SET_PINS, OP_SHIFT,
+                            OP_WAIT, shift_ops)
+
+
+logger = logging.getLogger(__name__)
+
+
+class OpOptimizer(BaseLoader):
+    """Wraps a loader, drops the writes not changing a pin's state and merges
+    consecutive waits (even across the dropped writes). Waits are only summed,
+    never shortened, the wrapped loader rounds the merged wait up to its own
+    resolution once instead of rounding every part. Shifts not supported
+    natively by the loader are emulated here, so they get optimized too."""
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._native_shift = \
+            getattr(type(loader), "shift", BaseLoader.shift) \
+            is not BaseLoader.shift
+        self._pin_state = {}  # pin: last written state
+        self._pending_wait = 0.0
+        self.removed_writes = 0
+        self.merged_waits = 0
+
+    @property
+    def removed_ops(self):
+        return self.removed_writes + self.merged_waits
+
+    @property
+    def capabilities(self):
+        return self._loader.capabilities
+
+    def get_output_pins(self):
+        return self._loader.get_output_pins()
+
+    def get_input_pins(self):
+        return self._loader.get_input_pins()
+
+    def open(self):
+        self._loader.open()
+
+    def close(self):
+        self._emit_wait()
+        self._loader.close()
+        logger.info(f"optimizer: {self.removed_ops} ops removed "
+                    f"({self.removed_writes} writes, "
+                    f"{self.merged_waits} waits)")
+
+    def set_as_output(self, pin):
+        self._emit_wait()
+        self._pin_state.pop(pin, None)
+        self._loader.set_as_output(pin)
+
+    def set_as_input(self, pin):
+        self._emit_wait()
+        self._pin_state.pop(pin, None)
+        self._loader.set_as_input(pin)
+
+    def set_pin(self, pin, new_state):
+        new_state = bool(new_state)
+        if self._pin_state.get(pin) == new_state:
+            self.removed_writes += 1
+            return
+        self._pin_state[pin] = new_state
+        self._emit_wait()
+        self._loader.set_pin(pin, new_state)
+
+    def set_pins(self, new_states):
+        if new_states := self._changed(new_states):
+            self._emit_wait()
+            self._loader.set_pins(new_states)
+
+    def fetch_pin(self, pin, callback):
+        self._emit_wait()
+        self._loader.fetch_pin(pin, callback)
+
+    def wait(self, seconds):
+        if seconds <= 0:
+            self.merged_waits += 1
+            return
+        if self._pending_wait:
+            self.merged_waits += 1
+        self._pending_wait += seconds
+
+    def flush(self):
+        self._emit_wait()
+        self._loader.flush()
+
+    def shift(self, *args):
+        self.run_batch([(OP_SHIFT, *args)])
+
+    def run_batch(self, ops):
+        result = []
+        self._optimize(ops, result)
+        if result:
+            self._loader.run_batch(result)
+
+    def _optimize(self, ops, result):
+        for op in ops:
+            kind = op[0]
+            if kind == OP_WAIT:
+                if op[1] <= 0 or self._pending_wait:
+                    self.merged_waits += 1
+                self._pending_wait += max(op[1], 0)
+                continue
+            if kind == OP_SET_PIN:
+                new_state = bool(op[2])
+                if self._pin_state.get(op[1]) == new_state:
+                    self.removed_writes += 1
+                    continue
+                self._pin_state[op[1]] = new_state
+                op = (OP_SET_PIN, op[1], new_state)
+            elif kind == OP_SET_PINS:
+                if not (new_states := self._changed(op[1])):
+                    continue
+                op = (OP_SET_PINS, new_states)
+            elif kind == OP_SHIFT:
+                if not self._native_shift:
+                    self._optimize(shift_ops(*op[1:]), result)
+                    continue
+                _, clock, data_out, _, bits, *_ = op
+                self._pin_state[clock] = False
+                if data_out is not None:
+                    self._pin_state[data_out] = bool(bits[-1])
+            if self._pending_wait:
+                result.append((OP_WAIT, self._pending_wait))
+                self._pending_wait = 0.0
+            result.append(op)
+
+    def encode_batch(self, ops):
+        # the pin state at replay time is unknown, only merge the waits
+        result = []
+        for op in ops:
+            if op[0] == OP_WAIT and result and result[-1][0] == OP_WAIT:
+                result[-1] = (OP_WAIT, result[-1][1] + op[1])
+            else:
+                result.append(op)
+        return self._loader.encode_batch(result)
+
+    def send_encoded(self, data, callbacks):
+        self._emit_wait()
+        self._pin_state.clear()
+        self._loader.send_encoded(data, callbacks)
+
+    def _changed(self, new_states):
+        result = []
+        for pin, new_state in new_states:
+            new_state = bool(new_state)
+            if self._pin_state.get(pin) == new_state:
+                self.removed_writes += 1
+            else:
+                self._pin_state[pin] = new_state
+                result.append((pin, new_state))
+        return tuple(result)
+
+    def _emit_wait(self):
+        if self._pending_wait:
+            self._loader.wait(self._pending_wait)
+            self._pending_wait = 0.0
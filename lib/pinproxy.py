@@ -1,12 +1,15 @@
-from collections import defaultdict, deque
+from collections import Counter, defaultdict
 import enum
 import re
 
-from lib.interfaces import PinProxy
+from lib.bitbuffer import BitBuffer
+from lib.interfaces import (op_callbacks, OP_FETCH_PIN, OP_SET_PIN,
+                            OP_SET_PINS, OP_SHIFT, OP_WAIT, PinProxy)
 
 
-RE_PINMAP = r'(?P<key>\w+)' r'\s*=\s*' r'(?P<value>\w+)'
+RE_PINMAP = r'(?P<key>\w+)' r'\s*=\s*' r'(?P<value>\w+(?:\+\w+)*)'
 IGNORED_MARK = "_"
+GANG_SEPARATOR = "+"
 IGNORED = object()
 
 
@@ -21,35 +24,345 @@ def parse_pinmap(pinmap_args):
         return result
     for m in pinmap_args:
         for k, v in re.findall(RE_PINMAP, m):
-            if v.isdigit():
-                v = int(v)
-            elif v == IGNORED_MARK:
-                v = IGNORED
+            if GANG_SEPARATOR in v:
+                v = tuple(_parse_lpin(p) for p in v.split(GANG_SEPARATOR))
+                if IGNORED in v:
+                    raise ValueError(f"ganged pin '{k}' cannot be ignored")
+            else:
+                v = _parse_lpin(v)
             result[k] = v
     return result
 
 
+def _parse_lpin(value):
+    if value.isdigit():
+        return int(value)
+    if value == IGNORED_MARK:
+        return IGNORED
+    return value
+
+
+class GangMismatchError(Exception):
+    "Ganged targets returned different data"
+
+    def __init__(self, tpin, chips):
+        super().__init__(f"'{tpin}' of chips {chips} differs from the rest")
+        self.tpin = tpin
+        self.chips = chips  # indices of the deviating targets
+
+
+class OutputPin:
+    "Handle of an output target pin, bound to the current op sink"
+
+    __slots__ = ("tpin", "lpin", "_set_pin")
+
+    def __init__(self, tpin, lpin, sink):
+        self.tpin = tpin
+        self.lpin = lpin
+        self._bind(sink)
+
+    def set(self, new_state=True):
+        self._set_pin(self.lpin, new_state)
+
+    def reset(self):
+        self._set_pin(self.lpin, False)
+
+    def _bind(self, sink):
+        self._set_pin = sink.set_pin
+
+    def _invalidate(self):
+        self._set_pin = _direction_changed(self.tpin)
+
+
+class InputPin:
+    "Handle of an input target pin, bound to the current op sink"
+
+    __slots__ = ("tpin", "lpin", "_fetch_pin", "_callback")
+
+    def __init__(self, tpin, lpin, sink, callback):
+        self.tpin = tpin
+        self.lpin = lpin
+        self._callback = callback
+        self._bind(sink)
+
+    def fetch(self):
+        self._fetch_pin(self.lpin, self._callback)
+
+    def _bind(self, sink):
+        self._fetch_pin = sink.fetch_pin
+
+    def _invalidate(self):
+        self._fetch_pin = _direction_changed(self.tpin)
+
+
+class IgnoredPin:
+    "Handle of a target pin not connected to the loader"
+
+    __slots__ = ("tpin",)
+    lpin = IGNORED
+
+    def __init__(self, tpin):
+        self.tpin = tpin
+
+    def set(self, new_state=True):
+        pass
+
+    def reset(self):
+        pass
+
+    def fetch(self):
+        pass
+
+    def _bind(self, sink):
+        pass
+
+    def _invalidate(self):
+        pass
+
+
+class GangOutputPin:
+    "Handle of an output target pin driving the same pin of every chip"
+
+    __slots__ = ("tpin", "lpin", "_set_pins")
+
+    def __init__(self, tpin, lpins, sink):
+        self.tpin = tpin
+        self.lpin = lpins
+        self._bind(sink)
+
+    def set(self, new_state=True):
+        self._set_pins(tuple((lpin, new_state) for lpin in self.lpin))
+
+    def reset(self):
+        self.set(False)
+
+    def _bind(self, sink):
+        self._set_pins = sink.set_pins
+
+    def _invalidate(self):
+        self._set_pins = _direction_changed(self.tpin)
+
+
+class GangInputPin:
+    "Handle of an input target pin read from every chip separately"
+
+    __slots__ = ("tpin", "lpin", "_fetch_pin", "_callbacks")
+
+    def __init__(self, tpin, lpins, sink, callbacks):
+        self.tpin = tpin
+        self.lpin = lpins
+        self._callbacks = callbacks
+        self._bind(sink)
+
+    def fetch(self):
+        for lpin, callback in zip(self.lpin, self._callbacks):
+            self._fetch_pin(lpin, callback)
+
+    def _bind(self, sink):
+        self._fetch_pin = sink.fetch_pin
+
+    def _invalidate(self):
+        self._fetch_pin = _direction_changed(self.tpin)
+
+
+def _direction_changed(tpin):
+    def fail(*_):
+        raise ValueError(f"direction of '{tpin}' has changed")
+    return fail
+
+
+class Batch:
+    "Records the loader calls of a transaction as ops for run_batch()"
+
+    def __init__(self):
+        self.ops = []
+
+    def set_pin(self, pin, new_state):
+        self.ops.append((OP_SET_PIN, pin, new_state))
+
+    def set_pins(self, new_states):
+        self.ops.append((OP_SET_PINS, tuple(new_states)))
+
+    def fetch_pin(self, pin, callback):
+        self.ops.append((OP_FETCH_PIN, pin, callback))
+
+    def wait(self, seconds):
+        self.ops.append((OP_WAIT, seconds))
+
+    def shift(self, *args):
+        self.ops.append((OP_SHIFT, *args))
+
+    def run_batch(self, ops):
+        self.ops.extend(ops)
+
+
+class Template:
+    """Recorded pin activity of a function, replayed as a loader-native op
+    stream. Each field bit flips a fixed set of bits in the encoded stream,
+    so a replay is the XOR of the precomputed masks of the set field bits."""
+
+    def __init__(self, pinproxy, fn, widths):
+        self._pinproxy = pinproxy
+        self._fn = fn
+        self._widths = widths
+        self._encoded = None  # (base, {field: [mask per bit]}, callbacks)
+        self._compile()
+
+    def __call__(self, **fields):
+        if fields.keys() != self._widths.keys():
+            raise KeyError(f"fields {set(self._widths)} are expected")
+        for k, v in fields.items():
+            if not 0 <= v < 1 << self._widths[k]:
+                raise ValueError(f"'{k}' is out of bounds")
+        if not self._encoded:
+            self._fn(**fields)
+            return
+
+        value, masks, callbacks = self._encoded
+        for k, v in fields.items():
+            for mask in masks[k]:
+                if not v:
+                    break
+                if v & 1:
+                    value ^= mask
+                v >>= 1
+        data = value.to_bytes(self._length, "big")
+        self._pinproxy._send_encoded(data, callbacks)
+
+    def _compile(self):
+        zeros = dict.fromkeys(self._widths, 0)
+        base_ops = self._pinproxy._record(self._fn, zeros)
+        base = self._encode(base_ops)
+        if base is None:
+            return
+        self._length = len(base)
+        callbacks = op_callbacks(base_ops)
+
+        base_value = int.from_bytes(base, "big")
+        masks = {}
+        expected_all = base_value
+        for k, width in self._widths.items():
+            masks[k] = []
+            for bit in range(width):
+                ops = self._pinproxy._record(self._fn, {**zeros, k: 1 << bit})
+                encoded = self._encode(ops, base_ops)
+                if encoded is None:
+                    return
+                mask = int.from_bytes(encoded, "big") ^ base_value
+                masks[k].append(mask)
+                expected_all ^= mask
+
+        all_ones = {k: (1 << w) - 1 for k, w in self._widths.items()}
+        ops = self._pinproxy._record(self._fn, all_ones)
+        encoded = self._encode(ops, base_ops)
+        if encoded is None or int.from_bytes(encoded, "big") != expected_all:
+            return  # not linear in the fields
+        self._encoded = (base_value, masks, callbacks)
+
+    def _encode(self, ops, base_ops=None):
+        if base_ops is not None and not _same_structure(ops, base_ops):
+            return None
+        encoded = self._pinproxy._loader.encode_batch(ops)
+        if base_ops is not None and encoded is not None \
+                and len(encoded) != self._length:
+            return None
+        return encoded
+
+
+def _same_structure(ops, base_ops):
+    "Ops only differ in the pin states."
+    if len(ops) != len(base_ops):
+        return False
+    for op, base_op in zip(ops, base_ops):
+        if op[0] != base_op[0]:
+            return False
+        if op[0] == OP_SET_PIN:
+            same = op[1] == base_op[1]
+        elif op[0] == OP_SET_PINS:
+            same = [p for p, _ in op[1]] == [p for p, _ in base_op[1]]
+        elif op[0] == OP_SHIFT:
+            same = op[:4] + op[5:] == base_op[:4] + base_op[5:] \
+                and len(op[4]) == len(base_op[4])
+        else:
+            same = op == base_op
+        if not same:
+            return False
+    return True
+
+
+def _gang_shift_ops(clocks, data_outs, data_ins, bits, sample, half_period,
+                    sample_late):
+    """shift_ops() driving several clock/data pins at once and sampling
+    every (lpin, callback) of data_ins in the same clock cycle"""
+    clock_high = tuple((clock, True) for clock in clocks)
+    clock_low = tuple((clock, False) for clock in clocks)
+    fetches = [(OP_FETCH_PIN, lpin, callback) for lpin, callback in data_ins]
+    for i, bit in enumerate(bits):
+        if data_outs:
+            yield (OP_SET_PINS, tuple((pin, bit) for pin in data_outs))
+        if half_period:
+            yield (OP_WAIT, half_period)
+        yield (OP_SET_PINS, clock_high)
+        if half_period:
+            yield (OP_WAIT, half_period)
+        sampled = i in sample
+        if sampled and not sample_late:
+            yield from fetches
+        yield (OP_SET_PINS, clock_low)
+        if sampled and sample_late:
+            yield from fetches
+
+
+def _lpins(lpin):
+    "Loader pins of a plain or ganged pin"
+    if lpin is IGNORED or lpin is None:
+        return ()
+    return lpin if isinstance(lpin, tuple) else (lpin,)
+
+
 class ThePinProxy(PinProxy):
     def __init__(self, loader, pinmap):
         self._loader = loader
         self._check_pinmap(pinmap)
         self._pinmap = pinmap  # target_pin: loader_pin
-        self._tdirs = {}  # target_pin: direction
-        self._input_buffer = defaultdict(deque)  # tpin: incoming_bits
+        self._outputs = {}  # target_pin: OutputPin
+        self._inputs = {}  # target_pin: InputPin
+        self._input_buffer = defaultdict(BitBuffer)  # tpin: incoming_bits
+        self._sink = loader  # receives the pin ops: loader or Batch
+        self._batch_depth = 0
+        self._recording = False
+
+    def pop_fetched(self, tpin, n_bits=8, n_values=-1, lsb=False,
+                    as_bytes=False):
+        results = self.pop_fetched_gang(tpin, n_bits, n_values, lsb, as_bytes)
+        if len(results) > 1:
+            reference, _ = Counter(map(tuple, results)).most_common(1)[0]
+            if chips := [i for i, result in enumerate(results)
+                         if tuple(result) != reference]:
+                raise GangMismatchError(tpin, chips)
+        return results[0]
+
+    def pop_fetched_gang(self, tpin, n_bits=8, n_values=-1, lsb=False,
+                         as_bytes=False):
+        """
+        pop_fetched() of every ganged chip separately, a plain pin counts
+        as a single chip.
 
-    def pop_fetched(self, tpin, n_bits=8, n_values=-1, lsb=False):
+        :return: the fetched values in chip order
+        :rtype: list
+        """
         self.flush()
-        self._get_lpin(tpin)
-        bq = self._input_buffer[tpin]
-        coeffs = [2 ** x for x in range(n_bits)]
-        if not lsb:
-            coeffs.reverse()
-        result = []
-        while len(bq) >= n_bits and n_values != 0:
-            value = sum(bool(bq.popleft()) * c for c in coeffs)
-            result.append(value)
-            n_values -= 1
-        return result
+        if as_bytes and n_bits != 8:
+            raise ValueError("as_bytes requires n_bits=8")
+        lpin = self._get_lpin(tpin)
+        if isinstance(lpin, tuple):
+            buffers = [self._input_buffer[(tpin, i)]
+                       for i in range(len(lpin))]
+        else:
+            buffers = [self._input_buffer[tpin]]
+        if as_bytes:
+            return [buffer.pop_bytes(n_values, lsb) for buffer in buffers]
+        return [buffer.pop(n_bits, n_values, lsb) for buffer in buffers]
 
     def set_as_input(self, *tpins):
         for tpin in tpins:
@@ -59,24 +372,84 @@ class ThePinProxy(PinProxy):
         for tpin in tpins:
             self._set_direction(tpin, Direction.OUT)
 
+    def pin(self, tpin):
+        try:
+            return self._outputs.get(tpin) or self._inputs[tpin]
+        except KeyError:
+            raise ValueError(f"direction of '{tpin}' is not set") from None
+
     def set_pin(self, tpin, new_state=True):
-        self._check_tpin_direction(tpin, Direction.OUT)
-        lpin = self._get_lpin(tpin)
-        if lpin != IGNORED:
-            self._loader.set_pin(lpin, new_state)
+        self._get_handle(tpin, Direction.OUT).set(new_state)
+
+    def set_pins(self, new_states):
+        lpin_states = []
+        for tpin, new_state in new_states.items():
+            lpin = self._get_handle(tpin, Direction.OUT).lpin
+            for lpin in _lpins(lpin):
+                lpin_states.append((lpin, new_state))
+        if lpin_states:
+            self._sink.set_pins(lpin_states)
 
     def fetch_pin(self, tpin):
-        self._check_tpin_direction(tpin, Direction.IN)
-        lpin = self._get_lpin(tpin)
-        if lpin != IGNORED:
-            self._loader.fetch_pin(lpin, self._input_buffer[tpin].append)
+        self._get_handle(tpin, Direction.IN).fetch()
+
+    def shift(self, clock, bits, data_out=None, data_in=None, sample=(),
+              half_period=0.0, sample_late=False):
+        clock = self._get_handle(clock, Direction.OUT)
+        if clock.lpin is IGNORED:
+            raise ValueError(f"clock '{clock.tpin}' cannot be ignored")
+        dout_lpin = din_lpin = callback = None
+        if data_out is not None:
+            dout_lpin = self._get_handle(data_out, Direction.OUT).lpin
+            if dout_lpin is IGNORED:
+                dout_lpin = None
+        if data_in is not None:
+            din = self._get_handle(data_in, Direction.IN)
+            if isinstance(din, GangInputPin):
+                din_lpin, callback = din.lpin, din._callbacks
+            elif din.lpin is not IGNORED:
+                din_lpin, callback = din.lpin, din._callback
+        if not bits:
+            return
+        lpins = (clock.lpin, dout_lpin, din_lpin)
+        if any(isinstance(lpin, tuple) for lpin in lpins):
+            # ganged pins: the loader's shift() drives a single pin each
+            if isinstance(din_lpin, tuple):
+                data_ins = list(zip(din_lpin, callback))
+            elif din_lpin is not None:
+                data_ins = [(din_lpin, callback)]
+            else:
+                data_ins = []
+            self._sink.run_batch(list(_gang_shift_ops(
+                _lpins(clock.lpin), _lpins(dout_lpin), data_ins, bits,
+                sample, half_period, sample_late)))
+            return
+        self._sink.shift(clock.lpin, dout_lpin, din_lpin, tuple(bits), sample,
+                         callback, half_period, sample_late)
 
     def wait(self, seconds):
-        self._loader.wait(seconds)
+        self._sink.wait(seconds)
 
     def flush(self):
+        self._submit_batch()
         self._loader.flush()
 
+    def begin(self):
+        if not self._batch_depth:
+            self._set_sink(Batch())
+        self._batch_depth += 1
+
+    def commit(self):
+        if not self._batch_depth:
+            raise RuntimeError("commit() without begin()")
+        if self._batch_depth == 1:
+            self._submit_batch()
+            self._set_sink(self._loader)
+        self._batch_depth -= 1
+
+    def compile(self, fn, **widths):
+        return Template(self, fn, widths)
+
     def __enter__(self):
         self._loader.open()
         return self
@@ -84,6 +457,40 @@ class ThePinProxy(PinProxy):
     def __exit__(self, *_):
         self._loader.close()
 
+    def _set_sink(self, sink):
+        self._sink = sink
+        for handle in self._outputs.values():
+            handle._bind(sink)
+        for handle in self._inputs.values():
+            handle._bind(sink)
+
+    def _submit_batch(self):
+        "Hands over the ops queued so far, keeps the transaction open."
+        if self._recording:
+            raise RuntimeError("cannot submit ops while compiling a template")
+        if not self._batch_depth or not self._sink.ops:
+            return
+        ops, self._sink.ops = self._sink.ops, []
+        self._loader.run_batch(ops)
+
+    def _record(self, fn, fields):
+        "Calls fn with fields and returns the ops it issued."
+        saved_sink, saved_depth = self._sink, self._batch_depth
+        self._set_sink(Batch())
+        self._batch_depth = 1
+        self._recording = True
+        try:
+            fn(**fields)
+            return self._sink.ops
+        finally:
+            self._set_sink(saved_sink)
+            self._batch_depth = saved_depth
+            self._recording = False
+
+    def _send_encoded(self, data, callbacks):
+        self._submit_batch()
+        self._loader.send_encoded(data, callbacks)
+
     def _get_lpins_by_direction(self, direction: Direction):
         if direction == Direction.OUT:
             return self._loader.get_output_pins()
@@ -92,12 +499,17 @@ class ThePinProxy(PinProxy):
     def _check_pinmap(self, pinmap):
         lpins = self._get_lpins_by_direction(Direction.OUT) \
             | self._get_lpins_by_direction(Direction.IN)
-        if missing := set(pinmap.values()) - lpins - {IGNORED}:
+        used = {lpin for v in pinmap.values() for lpin in _lpins(v)}
+        if missing := used - lpins:
             raise KeyError(f"loader pins '{missing}' are not provided")
 
-    def _check_tpin_direction(self, tpin, direction):
-        if self._tdirs.get(tpin) != direction:
-            raise ValueError(f"'{tpin}' is not set as '{direction.name}'")
+    def _get_handle(self, tpin, direction):
+        handles = self._outputs if direction == Direction.OUT else self._inputs
+        try:
+            return handles[tpin]
+        except KeyError:
+            raise ValueError(
+                f"'{tpin}' is not set as '{direction.name}'") from None
 
     def _get_lpin(self, tpin):
         try:
@@ -107,12 +519,37 @@ class ThePinProxy(PinProxy):
 
     def _set_direction(self, tpin, direction):
         lpin = self._get_lpin(tpin)
-        if lpin != IGNORED and self._tdirs.get(tpin) != direction:
-            if lpin not in self._get_lpins_by_direction(direction):
-                raise ValueError(f"'{tpin}->{lpin}' cannot be set up "
-                                 f"as '{direction.name}'")
-            if direction == Direction.OUT:
-                self._loader.set_as_output(lpin)
+        if direction == Direction.OUT:
+            handles, others = self._outputs, self._inputs
+        else:
+            handles, others = self._inputs, self._outputs
+        if tpin in handles:
+            return
+        if lpin is IGNORED:
+            handles[tpin] = IgnoredPin(tpin)
+            return
+
+        if not set(_lpins(lpin)) <= self._get_lpins_by_direction(direction):
+            raise ValueError(f"'{tpin}->{lpin}' cannot be set up "
+                             f"as '{direction.name}'")
+        self._submit_batch()
+        if direction == Direction.OUT:
+            for gang_lpin in _lpins(lpin):
+                self._loader.set_as_output(gang_lpin)
+            if isinstance(lpin, tuple):
+                handles[tpin] = GangOutputPin(tpin, lpin, self._sink)
+            else:
+                handles[tpin] = OutputPin(tpin, lpin, self._sink)
+        else:
+            for gang_lpin in _lpins(lpin):
+                self._loader.set_as_input(gang_lpin)
+            if isinstance(lpin, tuple):
+                callbacks = [self._input_buffer[(tpin, i)]
+                             for i in range(len(lpin))]
+                handles[tpin] = GangInputPin(tpin, lpin, self._sink,
+                                             callbacks)
             else:
-                self._loader.set_as_input(lpin)
-        self._tdirs[tpin] = direction
+                handles[tpin] = InputPin(tpin, lpin, self._sink,
+                                         self._input_buffer[tpin])
+        if handle := others.pop(tpin, None):
+            handle._invalidate()
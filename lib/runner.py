@@ -0,0 +1,244 @@
+import importlib
+import json
+import logging
+import multiprocessing
+import queue
+import sys
+import time
+from types import MappingProxyType
+from typing import (Any, Callable, Dict, List, Mapping, NamedTuple, Optional,
+                    TextIO)
+
+from lib.interfaces import BaseLoader, Mem, ProgressIndicator
+from lib.opcache import run_cached
+from lib.optimizer import OpOptimizer
+from lib.pinproxy import parse_pinmap, ThePinProxy
+from lib.progressbar import ProgressBar
+import lib.targetop
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FILE_FORMAT = "hexd"
+PROGRESS_PERIOD = 0.1
+NO_ARGS: Mapping[str, Any] = MappingProxyType({})  # read-only, shared
+
+
+class Job(NamedTuple):
+    "One nops run, the fields mirror the nops command line options"
+    loader: str
+    target: str
+    loader_args: Mapping[str, Any] = NO_ARGS
+    target_args: Mapping[str, Any] = NO_ARGS
+    pinmap: Mapping[str, Any] = NO_ARGS
+    in_file: Optional[str] = None
+    out_file: Optional[str] = None
+    file_format: str = DEFAULT_FILE_FORMAT
+    cache_dir: Optional[str] = None  # recordings of the write ops
+
+    @property
+    def loader_key(self):
+        "Identifies the physical loader, its jobs run one after another"
+        return (self.loader,
+                json.dumps(dict(self.loader_args), sort_keys=True))
+
+
+class JobResult(NamedTuple):
+    index: int
+    ok: bool
+    seconds: float
+    message: str = ""
+
+
+def load_jobs(reader: TextIO) -> List[Job]:
+    """
+    Reads a JSON list of jobs. The pinmap may also be given in the nops
+    command line syntax ("CS=D3 CLK=D5 ...").
+
+    :param reader: the jobs file
+    :type reader: TextIO
+
+    :return: the jobs in file order
+    :rtype: [Job]
+    """
+    jobs = []
+    for fields in json.load(reader):
+        if isinstance(fields.get("pinmap"), str):
+            fields["pinmap"] = parse_pinmap([fields["pinmap"]])
+        jobs.append(Job(**fields))
+    return jobs
+
+
+def group_by_loader(jobs: List[Job]) -> List[List[int]]:
+    "Job indices per physical loader, in order of first appearance"
+    groups = {}
+    for index, job in enumerate(jobs):
+        groups.setdefault(job.loader_key, []).append(index)
+    return list(groups.values())
+
+
+def load_images(jobs: List[Job]) -> Dict[tuple, Mem]:
+    "Parses every input image needed by the jobs once"
+    images = {}
+    for index, job in enumerate(jobs):
+        key = (job.in_file, job.file_format)
+        if key in images or not _load_target(job).does_need_input():
+            continue
+        if job.in_file is None:
+            raise ValueError(f"job {index} ({job.target}) needs an in_file")
+        fmtobj = load_attribute(
+            f"lib.file_format.{job.file_format}.FileFormat")()
+        with open(job.in_file) as reader:
+            images[key] = fmtobj.deserialize(reader)
+    return images
+
+
+def run_jobs(jobs: List[Job], muted=False,
+             output_stream=sys.stderr) -> List[JobResult]:
+    """
+    Runs the jobs in a process pool with one worker per physical loader.
+    The input images are parsed here once and handed to every worker.
+
+    :param jobs: the jobs to run
+    :type jobs: [Job]
+    :param muted: hide the aggregated progress bar, defaults to False
+    :type muted: bool
+
+    :return: result of every job, in job order
+    :rtype: [JobResult]
+    """
+    if not jobs:
+        return []
+    images = load_images(jobs)
+    groups = group_by_loader(jobs)
+    ctx = multiprocessing.get_context()
+    progress_queue = ctx.Queue()
+    ratios = [0.0] * len(jobs)
+    progressbar = ProgressBar(muted=muted, output_stream=output_stream)
+
+    with ctx.Pool(len(groups), initializer=_init_worker,
+                  initargs=(jobs, images, progress_queue)) as pool:
+        pending = [pool.apply_async(_run_group, (group,)) for group in groups]
+        while not all(p.ready() for p in pending):
+            try:
+                index, ratio = progress_queue.get(timeout=PROGRESS_PERIOD)
+            except queue.Empty:
+                continue
+            ratios[index] = ratio
+            progressbar.update(min(sum(ratios) / len(ratios), 0.999))
+        results = [result for p in pending for result in p.get()]
+    progressbar.update(1)
+    return sorted(results)
+
+
+def format_results(jobs: List[Job], results: List[JobResult]) -> str:
+    "Per-job result table"
+    rows = [("#", "loader", "target", "result", "time")]
+    for result in results:
+        job = jobs[result.index]
+        loader = job.loader
+        if job.loader_args:
+            loader += " " + " ".join(
+                f"{k}={v}" for k, v in job.loader_args.items())
+        status = "ok" if result.ok else f"FAILED: {result.message}"
+        rows.append((str(result.index), loader, job.target, status,
+                     f"{result.seconds:.3f}s"))
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    return "".join(
+        "  ".join(cell.ljust(w) for cell, w in zip(row, widths)) + "  "
+        + row[4] + "\n"
+        for row in rows)
+
+
+def run_job(job: Job, progressbar: ProgressIndicator,
+            mem_in: Optional[Mem] = None,
+            wrap_loader: Optional[Callable[[BaseLoader], BaseLoader]] = None
+            ) -> Optional[Mem]:
+    """
+    Does what a single nops run does.
+
+    :param job: the job to run
+    :type job: Job
+    :param progressbar: progress of the target op
+    :type progressbar: ProgressIndicator
+    :param mem_in: input image of the target op, defaults to None
+    :type mem_in: Optional[Mem]
+    :param wrap_loader: wraps the loader (e.g. PinTracer), defaults to None
+    :type wrap_loader: Optional[Callable[[BaseLoader], BaseLoader]]
+
+    :return: output image of the target op
+    :rtype: Optional[Mem]
+    """
+    target = _load_target(job)
+    loader_class = load_attribute(f"lib.loader.{job.loader}.Loader")
+    loader = loader_class(**job.loader_args)
+    if wrap_loader:
+        loader = wrap_loader(loader)
+    if job.cache_dir and target.does_need_input():
+        mem_out = run_cached(job, target, loader, progressbar, mem_in)
+    else:
+        with ThePinProxy(OpOptimizer(loader), job.pinmap) as pinproxy:
+            mem_out = target(pinproxy, progressbar, mem_in,
+                             **job.target_args)
+    if mem_out and job.out_file:
+        fmtobj = load_attribute(
+            f"lib.file_format.{job.file_format}.FileFormat")()
+        with open(job.out_file, "x") as writer:
+            writer.writelines(fmtobj.serialize(mem_out))
+    return mem_out
+
+
+def load_attribute(path):
+    modpath, attrib = path.rsplit(".", 1)
+    mod = importlib.import_module(modpath)
+    return getattr(mod, attrib)
+
+
+def _load_target(job):
+    target = load_attribute(f"lib.target.{job.target}")
+    if not isinstance(target, lib.targetop.TargetOp):
+        raise TypeError("target must be decorated with @TargetOp")
+    return target
+
+
+class _QueueProgress(ProgressIndicator):
+    "Forwards the progress of a job to the runner, rate limited"
+
+    def __init__(self, index, progress_queue):
+        self._index = index
+        self._queue = progress_queue
+        self._next_ts = 0
+
+    def update(self, numerator, denominator=1):
+        ratio = numerator / denominator
+        ts = time.monotonic()
+        if ratio < 1 and ts < self._next_ts:
+            return
+        self._next_ts = ts + PROGRESS_PERIOD
+        self._queue.put((self._index, ratio))
+
+
+_worker = {}  # state shared by the jobs of a worker process
+
+
+def _init_worker(jobs, images, progress_queue):
+    _worker.update(jobs=jobs, images=images, queue=progress_queue)
+
+
+def _run_group(indices):
+    results = []
+    for index in indices:
+        job = _worker["jobs"][index]
+        progress = _QueueProgress(index, _worker["queue"])
+        start_ts = time.monotonic()
+        try:
+            mem_in = _worker["images"].get((job.in_file, job.file_format))
+            run_job(job, progress, mem_in)
+        except Exception as e:
+            logger.debug(f"job {index} failed", exc_info=True)
+            results.append(
+                JobResult(index, False, time.monotonic() - start_ts, str(e)))
+        else:
+            results.append(JobResult(index, True, time.monotonic() - start_ts))
+        progress.update(1)
+    return results
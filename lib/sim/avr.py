@@ -0,0 +1,289 @@
+import dataclasses
+from typing import Optional, Tuple
+
+from lib.sim.device import SimDevice
+
+
+@dataclasses.dataclass
+class Chip:
+    signature: Tuple[int, int, int]
+    flash_size: int
+    page_size: int
+    jtag_partno: Optional[int] = None
+    jtag_version: int = 0
+
+
+CHIPS = {
+    "attiny2313": Chip((0x1e, 0x91, 0x0a), 2**11, 32),
+    "atmega16a": Chip((0x1e, 0x94, 0x03), 2**14, 128, 0x9403),
+    "atmega32a": Chip((0x1e, 0x95, 0x02), 2**15, 128, 0x9502),
+}
+
+SPI_PROGRAMMING_ENABLE = (0xac, 0x53)
+SPI_CHIP_ERASE = (0xac, 0x80)
+SPI_READ_PROGRAM_MEMORY = 0x20  # | h << 3
+SPI_LOAD_PROGRAM_MEMORY_PAGE = 0x40  # | h << 3
+SPI_WRITE_PROGRAM_MEMORY_PAGE = 0x4c
+SPI_READ_SIGNATURE_BYTE = 0x30
+SPI_POLL_RDY_BSY = 0xf0
+# busy after a page write and a chip erase, sooner than the datasheet limits
+PAGE_WRITE_TIME = 3e-3
+CHIP_ERASE_TIME = 7e-3
+
+
+class AvrSpi(SimDevice):
+    """AVR serial programming interface, active while RESET is low. Every
+    byte echoes the previous one unless the command answers in byte 3.
+    After a page write or chip erase RDY/BSY reports busy for a while, the
+    page being programmed reads 0xff meanwhile."""
+
+    inputs = ("RESET", "SCK", "MOSI")
+    outputs = ("MISO",)
+
+    def __init__(self, memory, chip):
+        super().__init__(memory)
+        self.chip = chip
+        self._page = bytearray(b"\xff" * chip.page_size)
+        self._busy_until = 0.0
+        self._busy_page = None  # start address
+        self._reset()
+
+    def on_edge(self, pin, rising):
+        if pin == "RESET":
+            self._reset()
+        elif pin == "SCK" and not self.level("RESET"):
+            if rising:
+                self._clock(self.level("MOSI"))
+            else:
+                self.drive("MISO", self._out >> 7 & 1)
+                self._out = self._out << 1 & 0xff
+
+    def _reset(self):
+        self.enabled = False
+        self._command = []
+        self._byte = self._n_bits = self._out = 0
+        self.drive("MISO", 0)
+
+    def _clock(self, mosi):
+        self._byte = (self._byte << 1 | mosi) & 0xff
+        self._n_bits += 1
+        if self._n_bits < 8:
+            return
+        command = self._command
+        command.append(self._byte)
+        self._out = self._byte
+        self._byte = self._n_bits = 0
+        if tuple(command) == SPI_PROGRAMMING_ENABLE:
+            self.enabled = True
+        if len(command) == 3 and self.enabled:
+            self._out = self._answer(command)
+        elif len(command) == 4:
+            if self.enabled:
+                self._execute(command)
+            command.clear()
+
+    def _answer(self, command):
+        "Byte 3 output of the read commands"
+        op, high, low = command
+        if op & ~0x08 == SPI_READ_PROGRAM_MEMORY:
+            address = (high << 8 | low) << 1 | op >> 3 & 1
+            address %= len(self.memory)
+            page_size = self.chip.page_size
+            if self._busy() \
+                    and address // page_size * page_size == self._busy_page:
+                return 0xff
+            return self.memory[address]
+        if op == SPI_READ_SIGNATURE_BYTE:
+            return self.chip.signature[low & 3] if low & 3 < 3 else 0
+        if op == SPI_POLL_RDY_BSY:
+            return int(self._busy())
+        return low
+
+    def _busy(self):
+        return self.now < self._busy_until
+
+    def _execute(self, command):
+        op, high, low, value = command
+        page_size = self.chip.page_size
+        if op & ~0x08 == SPI_LOAD_PROGRAM_MEMORY_PAGE:
+            offset = (low << 1 | op >> 3 & 1) % page_size
+            self._page[offset] = value
+        elif op == SPI_WRITE_PROGRAM_MEMORY_PAGE:
+            address = ((high << 8 | low) << 1) % len(self.memory)
+            self._busy_page = address // page_size * page_size
+            program_page(self.memory, self._busy_page, self._page)
+            self._page[:] = b"\xff" * page_size
+            self._busy_until = self.now + PAGE_WRITE_TIME
+        elif (op, high) == SPI_CHIP_ERASE:
+            self.memory[:] = b"\xff" * len(self.memory)
+            self._busy_page = None
+            self._busy_until = self.now + CHIP_ERASE_TIME
+
+
+def program_page(memory, address, data):
+    "Programming only clears bits, like the flash does"
+    for i, value in enumerate(data):
+        memory[address + i] &= value
+
+
+# TAP controller states
+(TEST_LOGIC_RESET, RUN_TEST_IDLE, SELECT_DR, CAPTURE_DR, SHIFT_DR, EXIT1_DR,
+ PAUSE_DR, EXIT2_DR, UPDATE_DR, SELECT_IR, CAPTURE_IR, SHIFT_IR, EXIT1_IR,
+ PAUSE_IR, EXIT2_IR, UPDATE_IR) = range(16)
+
+# state: (next state on TMS=0, next state on TMS=1)
+TAP_TRANSITIONS = {
+    TEST_LOGIC_RESET: (RUN_TEST_IDLE, TEST_LOGIC_RESET),
+    RUN_TEST_IDLE: (RUN_TEST_IDLE, SELECT_DR),
+    SELECT_DR: (CAPTURE_DR, SELECT_IR),
+    CAPTURE_DR: (SHIFT_DR, EXIT1_DR),
+    SHIFT_DR: (SHIFT_DR, EXIT1_DR),
+    EXIT1_DR: (PAUSE_DR, UPDATE_DR),
+    PAUSE_DR: (PAUSE_DR, EXIT2_DR),
+    EXIT2_DR: (SHIFT_DR, UPDATE_DR),
+    UPDATE_DR: (RUN_TEST_IDLE, SELECT_DR),
+    SELECT_IR: (CAPTURE_IR, TEST_LOGIC_RESET),
+    CAPTURE_IR: (SHIFT_IR, EXIT1_IR),
+    SHIFT_IR: (SHIFT_IR, EXIT1_IR),
+    EXIT1_IR: (PAUSE_IR, UPDATE_IR),
+    PAUSE_IR: (PAUSE_IR, EXIT2_IR),
+    EXIT2_IR: (SHIFT_IR, UPDATE_IR),
+    UPDATE_IR: (RUN_TEST_IDLE, SELECT_DR),
+}
+
+IR_LENGTH = 4
+IR_CAPTURE = 0b0001
+IDCODE = 1
+BYPASS = 0xf
+AVR_RESET = 0xc
+PROG_ENABLE = 4
+PROG_COMMANDS = 5
+PROG_PAGELOAD = 6
+PROG_PAGEREAD = 7
+PROG_ENABLE_SIGNATURE = 0xa370
+
+# 7 bit JTAG programming instructions, followed by a data byte
+CMD_ENTER = 0b0100011
+CMD_ADDRESS_HIGH = 0b0000111
+CMD_ADDRESS_LOW = 0b0000011
+CMD_DATA_LOW = 0b0010011
+CMD_DATA_HIGH = 0b0010111
+CMD_LATCH_DATA = 0b1110111
+CMD_WRITE_PAGE = 0b0110101
+CMD_ERASE = 0b0110001
+CMD_READ = 0b0110010
+CMD_READ_LOW = 0b0110110
+ENTER_ERASE = 0x80
+ENTER_FLASH_WRITE = 0x10
+ENTER_FLASH_READ = 0x02
+ENTER_SIGNATURE_READ = 0x08
+
+
+class AvrJtag(SimDevice):
+    """AVR JTAG TAP with the programming interface instructions. TDI is
+    sampled on the rising, TDO changes on the falling TCK edge."""
+
+    inputs = ("RESET", "TCK", "TMS", "TDI")
+    outputs = ("TDO",)
+
+    def __init__(self, memory, chip):
+        super().__init__(memory)
+        self.chip = chip
+        self.state = TEST_LOGIC_RESET
+        self.instruction = IDCODE
+        self.enabled = False
+        self._register = 0
+        self._mode = None
+        self._address = 0
+        self._data = 0
+        self._output = 0
+        self._page = bytearray(b"\xff" * chip.page_size)
+
+    @property
+    def idcode(self):
+        return (self.chip.jtag_version << 28 | self.chip.jtag_partno << 12
+                | 0x1f << 1 | 1)
+
+    def on_edge(self, pin, rising):
+        if pin != "TCK":
+            return
+        if not rising:
+            if self.state in (SHIFT_DR, SHIFT_IR):
+                self.drive("TDO", self._register & 1)
+            return
+
+        state = self.state
+        if state == CAPTURE_IR:
+            self._register = IR_CAPTURE
+        elif state == CAPTURE_DR:
+            self._register = self._capture_dr()
+        elif state in (SHIFT_DR, SHIFT_IR):
+            length = IR_LENGTH if state == SHIFT_IR else self._dr_length()
+            self._register = \
+                self._register >> 1 | self.level("TDI") << (length - 1)
+        self.state = TAP_TRANSITIONS[state][self.level("TMS")]
+
+        if self.state == TEST_LOGIC_RESET:
+            self.instruction = IDCODE
+        elif self.state == UPDATE_IR:
+            self.instruction = self._register & ((1 << IR_LENGTH) - 1)
+        elif self.state == UPDATE_DR:
+            self._update_dr(self._register & ((1 << self._dr_length()) - 1))
+
+    def _dr_length(self):
+        page_bits = self.chip.page_size * 8
+        return {IDCODE: 32, PROG_ENABLE: 16, PROG_COMMANDS: 15,
+                PROG_PAGELOAD: page_bits,
+                PROG_PAGEREAD: page_bits + 8}.get(self.instruction, 1)
+
+    def _capture_dr(self):
+        if self.instruction == IDCODE:
+            return self.idcode
+        if self.instruction == PROG_COMMANDS:
+            return self._output
+        if self.instruction == PROG_PAGEREAD and self.enabled:
+            start = self._page_address()
+            page = self.memory[start:start + self.chip.page_size]
+            return int.from_bytes(page, "little") << 8
+        return 0
+
+    def _update_dr(self, value):
+        if self.instruction == PROG_ENABLE:
+            self.enabled = value == PROG_ENABLE_SIGNATURE
+        elif self.instruction == PROG_PAGELOAD and self.enabled:
+            self._page[:] = value.to_bytes(self.chip.page_size, "little")
+        elif self.instruction == PROG_COMMANDS and self.enabled:
+            self._command(value >> 8, value & 0xff)
+
+    def _command(self, command, data):
+        if command == CMD_ENTER:
+            self._mode = data
+        elif command == CMD_ADDRESS_HIGH:
+            self._address = data << 8 | self._address & 0xff
+        elif command == CMD_ADDRESS_LOW:
+            self._address = self._address & 0xff00 | data
+        elif command == CMD_DATA_LOW:
+            self._data = self._data & 0xff00 | data
+        elif command == CMD_DATA_HIGH:
+            self._data = data << 8 | self._data & 0xff
+        elif command == CMD_LATCH_DATA and self._mode == ENTER_FLASH_WRITE:
+            offset = self._address * 2 % self.chip.page_size
+            self._page[offset:offset + 2] = self._data.to_bytes(2, "little")
+        elif command == CMD_WRITE_PAGE and self._mode == ENTER_FLASH_WRITE:
+            program_page(self.memory, self._page_address(), self._page)
+            self._page[:] = b"\xff" * self.chip.page_size
+        elif command == CMD_ERASE and self._mode == ENTER_ERASE:
+            self.memory[:] = b"\xff" * len(self.memory)
+        elif command == CMD_READ and self._mode == ENTER_SIGNATURE_READ:
+            index = self._address & 0xff
+            self._output = self.chip.signature[index] if index < 3 else 0
+        elif command == CMD_READ and self._mode == ENTER_FLASH_READ:
+            self._output = self.memory[self._address * 2 % len(self.memory)]
+        elif command == CMD_READ_LOW and self._mode == ENTER_FLASH_READ:
+            address = (self._address * 2 + 1) % len(self.memory)
+            self._output = self.memory[address]
+            self._address += 1
+
+    def _page_address(self):
+        page_size = self.chip.page_size
+        return self._address * 2 % len(self.memory) // page_size * page_size
@@ -0,0 +1,44 @@
+from typing import Dict, Tuple
+
+
+class SimDevice:
+    """Behavioral model of a target device driven by pin levels. Subclasses
+    list their pins and react to the edges in on_edge(), now is the virtual
+    clock of the loader."""
+
+    inputs: Tuple[str, ...] = ()  # pins driven by the loader
+    outputs: Tuple[str, ...] = ()  # pins read by the loader
+
+    def __init__(self, memory: bytearray):
+        self.memory = memory
+        self._levels: Dict[str, bool] = {}
+        self._outputs = dict.fromkeys(self.outputs, 0)
+        self.now = 0.0
+
+    def set_pin(self, pin: str, state: bool) -> None:
+        state = bool(state)
+        if self._levels.get(pin, False) != state:
+            self._levels[pin] = state
+            self.on_edge(pin, state)
+
+    def get_pin(self, pin: str) -> int:
+        return self._outputs[pin]
+
+    def level(self, pin: str) -> int:
+        return int(self._levels.get(pin, False))
+
+    def drive(self, pin: str, state: int) -> None:
+        self._outputs[pin] = int(state)
+
+    def on_edge(self, pin: str, rising: bool) -> None:
+        pass
+
+
+def byte_bits(data, start=0):
+    "Endless msb first bits of data from start on, wrapping around"
+    while True:
+        for address in range(start, len(data)):
+            value = data[address]
+            for i in reversed(range(8)):
+                yield value >> i & 1
+        start = 0
@@ -0,0 +1,83 @@
+from lib.sim.device import byte_bits, SimDevice
+
+
+SIZE = 512
+PAGE_SIZE = 16
+
+READ = 0b011
+WRITE = 0b010
+WRDI = 0b100
+WREN = 0b110
+RDSR = 0b101
+A8_BIT = 0b1000
+
+WEL = 0b10
+
+
+class Ee25lc040(SimDevice):
+    "25LC040 SPI EEPROM, mode 0, writes are instant"
+
+    inputs = ("CS", "SCK", "SI", "HOLD", "WP")
+    outputs = ("SO",)
+
+    def __init__(self, memory):
+        super().__init__(memory)
+        self.status = 0
+        self._reset()
+
+    def on_edge(self, pin, rising):
+        if pin == "CS":
+            if rising:
+                self._execute()
+            self._reset()
+        elif pin == "SCK" and not self.level("CS") and self.level("HOLD"):
+            if rising:
+                self._clock(self.level("SI"))
+            elif self._out:
+                self.drive("SO", next(self._out))
+
+    def _reset(self):
+        self._bits = 0
+        self._n_bits = 0
+        self._instruction = None
+        self._address = None
+        self._page = None
+        self._out = None
+        self.drive("SO", 0)
+
+    def _clock(self, si):
+        self._bits = self._bits << 1 | si
+        self._n_bits += 1
+        if self._n_bits % 8:
+            return
+        byte = self._bits & 0xff
+        if self._n_bits == 8:
+            self._instruction = byte & ~A8_BIT
+            self._address = (byte & A8_BIT) << 5
+            if self._instruction == RDSR:
+                self._out = byte_bits(bytes([self.status]))
+        elif self._n_bits == 16:
+            self._address |= byte
+            if self._instruction == READ:
+                self._out = byte_bits(self.memory, self._address)
+            elif self._instruction == WRITE:
+                self._page = []
+        elif self._page is not None:
+            self._page.append(byte)
+
+    def _execute(self):
+        "Instructions taking effect when CS goes high"
+        if self._n_bits != 8 and self._instruction in (WREN, WRDI):
+            return
+        if self._instruction == WREN:
+            self.status |= WEL
+        elif self._instruction == WRDI:
+            self.status &= ~WEL
+        elif (self._page and not self._n_bits % 8
+              and self.status & WEL and self.level("WP")):
+            # the address wraps around within the page
+            page = self._address // PAGE_SIZE * PAGE_SIZE
+            for i, value in enumerate(self._page):
+                offset = (self._address + i) % PAGE_SIZE
+                self.memory[page + offset] = value
+            self.status &= ~WEL
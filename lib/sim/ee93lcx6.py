@@ -0,0 +1,97 @@
+import logging
+
+from lib.sim.device import byte_bits, SimDevice
+
+
+logger = logging.getLogger(__name__)
+
+MODEL_TO_SIZE = {46: 128, 56: 256, 66: 512}
+MODEL_TO_ADDRESS_BITS = {46: 7, 56: 9, 66: 9}  # x8 organization
+
+OP_EXTENDED = 0b00
+OP_WRITE = 0b01
+OP_READ = 0b10
+OP_ERASE = 0b11
+EXT_EWDS = 0b00
+EXT_WRAL = 0b01
+EXT_ERAL = 0b10
+EXT_EWEN = 0b11
+
+
+class Ee93lcx6(SimDevice):
+    "93LC46/56/66 MicroWire EEPROM in x8 organization"
+
+    inputs = ("CS", "CLK", "DI", "ORG")
+    outputs = ("DO",)
+
+    def __init__(self, memory, model=66):
+        super().__init__(memory)
+        self.address_bits = MODEL_TO_ADDRESS_BITS[model]
+        self.write_enabled = False
+        self._reset()
+
+    def on_edge(self, pin, rising):
+        if pin == "CS":
+            if not rising:
+                self._execute()
+            self._reset()
+        elif pin == "CLK" and rising and self.level("CS"):
+            self._clock(self.level("DI"))
+        elif pin == "ORG" and rising:
+            logger.warning("x16 organization is not simulated")
+
+    def _reset(self):
+        self._started = False
+        self._bits = []
+        self._read = None
+        self._pending = None
+        self.drive("DO", 1)  # ready
+
+    def _clock(self, di):
+        if self._read:
+            self.drive("DO", next(self._read))
+            return
+        if not self._started:
+            self._started = bool(di)
+            return
+        self._bits.append(di)
+        n_bits = len(self._bits)
+        header = 2 + self.address_bits
+        if n_bits < header:
+            return
+
+        value = 0
+        for bit in self._bits:
+            value = value << 1 | bit
+        opcode = value >> (n_bits - 2)
+        address = value >> (n_bits - header) & ((1 << self.address_bits) - 1)
+        ext = address >> (self.address_bits - 2)
+        address %= len(self.memory)  # the unused high bits are don't care
+        if n_bits == header:
+            if opcode == OP_READ:
+                self._read = byte_bits(self.memory, address)
+                self.drive("DO", 0)  # dummy bit
+            elif opcode == OP_ERASE:
+                self._pending = (address, 0xff)
+            elif opcode == OP_EXTENDED and ext == EXT_EWEN:
+                self.write_enabled = True
+            elif opcode == OP_EXTENDED and ext == EXT_EWDS:
+                self.write_enabled = False
+            elif opcode == OP_EXTENDED and ext == EXT_ERAL:
+                self._pending = (None, 0xff)
+        elif n_bits == header + 8:
+            data = value & 0xff
+            if opcode == OP_WRITE:
+                self._pending = (address, data)
+            elif opcode == OP_EXTENDED and ext == EXT_WRAL:
+                self._pending = (None, data)
+
+    def _execute(self):
+        "Self-timed write cycle, started by CS going low"
+        if not self._pending or not self.write_enabled:
+            return
+        address, value = self._pending
+        if address is None:
+            self.memory[:] = bytes([value]) * len(self.memory)
+        else:
+            self.memory[address] = value
@@ -48,40 +48,37 @@ class Jtag:
         self.pinproxy = pinproxy
 
     def shift_ir(self, tdi_seq, read_bits=()):
-        self._change_state((1, 1, 0))  # Capture-IR
-        self._shift_register(tdi_seq, read_bits)  # Exit1-xR
-        self._change_state((1, 0))  # Idle
+        with self.pinproxy.transaction():
+            self._change_state((1, 1, 0))  # Capture-IR
+            self._shift_register(tdi_seq, read_bits)  # Exit1-xR
+            self._change_state((1, 0))  # Idle
 
     def shift_dr(self, tdi_seq, read_bits=()):
-        self._change_state((1, 0))  # Capture-DR
-        self._shift_register(tdi_seq, read_bits)
-        self._change_state((1, 0))  # Idle
+        with self.pinproxy.transaction():
+            self._change_state((1, 0))  # Capture-DR
+            self._shift_register(tdi_seq, read_bits)
+            self._change_state((1, 0))  # Idle
 
     def reset_to_idle(self):
-        self._change_state([1] * 5 + [0])
+        with self.pinproxy.transaction():
+            self._change_state([1] * 5 + [0])
 
     def pop_fetched(self, *args, **kwargs):
         return self.pinproxy.pop_fetched(*args, **kwargs)
 
     def _change_state(self, tms_seq):
-        p = self.pinproxy
-        for b in tms_seq:
-            p.set_pin(TMS, b)
-            p.set_pin(TCK)
-            p.reset_pin(TCK)
+        self.pinproxy.shift(TCK, tms_seq, TMS)
 
     # TDI on loop/leave rising edge, TDO on enter/loop falling edge
     def _shift_register(self, tdi_seq, read_bits=()):
         p = self.pinproxy
-        tms_seq = [0] * len(tdi_seq) + [1]  # ->Exit1 with last bit
-        tdi_seq = list(tdi_seq) + [0]
-        for i, tms in enumerate(tms_seq):
-            p.set_pin(TDI, tdi_seq.pop())
-            p.set_pin(TMS, tms)
-            p.set_pin(TCK)
-            p.reset_pin(TCK)
-            if i in read_bits:
-                p.fetch_pin(TDO)
+        n = len(tdi_seq)
+        tdi_seq = [0] + list(reversed(tdi_seq))
+        p.reset_pin(TMS)
+        p.shift(TCK, tdi_seq[:-1], TDI, TDO, read_bits, sample_late=True)
+        p.set_pin(TMS)  # ->Exit1 with last bit
+        last_read = range(1) if n in read_bits else ()
+        p.shift(TCK, tdi_seq[-1:], TDI, TDO, last_read, sample_late=True)
 
 
 class AvrJtag:
@@ -163,6 +160,12 @@ class AvrJtag:
     def read_page(self):
         self.jtag.shift_dr([0] * 1032, range(8, 1032))
 
+    def read_page_at(self, address):  # 3b 3c 3d
+        self.prog_commands()
+        self.load_address(address)
+        self.prog_pageread()
+        self.read_page()
+
     def write_page(self, tdi_seq):
         self.jtag.shift_dr(tdi_seq)
 
@@ -203,18 +206,16 @@ def read_flash(pinproxy, progressbar):
     aj, model = open_device(pinproxy)
     aj.enter_flash_read()
 
+    read_page_at = pinproxy.compile(aj.read_page_at, address=16)
     for address in range(0, model.flash_size // 2, model.page_size // 2):
-        aj.prog_commands()
-        aj.load_address(address)
-        aj.prog_pageread()
-        aj.read_page()
+        read_page_at(address=address)
         progressbar.update(address, model.flash_size // 2)
 
     aj.prog_commands()
     aj.prog_enable(False)
     aj.avr_reset(0)
 
-    return dict(enumerate(aj.pop_fetched(TDO, lsb=True)))
+    return dict(enumerate(aj.pop_fetched(TDO, lsb=True, as_bytes=True)))
 
 
 @TargetOp
@@ -223,13 +224,51 @@ def chip_erase(pinproxy):
     aj.chip_erase()
 
 
+def changed_pages(aj, model, pinproxy, progressbar, mem, erase):
+    """Reads the pages of mem back, erases if needed and allowed, returns
+    the ones to write"""
+    page_size = model.page_size
+    mem = {a: v for a, v in mem.items() if a < model.flash_size}
+    starts = sorted({address // page_size * page_size for address in mem})
+    aj.enter_flash_read()
+    read_page_at = pinproxy.compile(aj.read_page_at, address=16)
+    for address in starts:
+        read_page_at(address=address // 2)
+        progressbar.update(address, model.flash_size)
+    aj.prog_commands()
+    values = aj.pop_fetched(TDO, lsb=True, as_bytes=True)
+    current = {start + i: values[n * page_size + i]
+               for n, start in enumerate(starts) for i in range(page_size)}
+
+    if util.needs_erase(mem, current):
+        if not erase:
+            raise Exception("A bit must go from 0 to 1, it takes a chip "
+                            "erase (pass erase=1)!")
+        logger.warning("Chip erase: the flash outside the image is lost, "
+                       "so is the EEPROM unless EESAVE is programmed")
+        aj.chip_erase()
+        current = {}
+    pages = util.changed_pages(mem, current, page_size)
+    logger.info(f"{len(starts) - len(pages)} of {len(starts)} pages "
+                f"unchanged, skipped")
+    return [min(page) // page_size * page_size for page in pages]
+
+
 @TargetOp
-def write_flash(pinproxy, progressbar, mem):
+def write_flash(pinproxy, progressbar, mem, incremental=False, erase=False):
     aj, model = open_device(pinproxy)
 
+    if incremental:
+        addresses = changed_pages(aj, model, pinproxy, progressbar, mem,
+                                  erase)
+    else:  # programming only clears bits, a blank page changes nothing
+        addresses = [min(page) // model.page_size * model.page_size
+                     for page in util.changed_pages(mem, {}, model.page_size)
+                     if min(page) < model.flash_size]
     aj.enter_flash_write()
+    load_address = pinproxy.compile(aj.load_address, address=16)
 
-    for address in range(0, model.flash_size, model.page_size):
+    for address in addresses:
         bits = []
         for i in range(address, address + model.page_size):
             v = mem.get(i, 0xff)
@@ -237,7 +276,7 @@ def write_flash(pinproxy, progressbar, mem):
             bits += util.cmd("dddddddd", d=rv)
         bits.reverse()
 
-        aj.load_address(address // 2)  # 2bc
+        load_address(address=address // 2)  # 2bc
         aj.prog_pageload()
         aj.write_page(bits)
         aj.prog_commands()
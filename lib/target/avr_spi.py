@@ -1,5 +1,6 @@
 import dataclasses
 import logging
+from time import monotonic
 
 from lib.targetop import TargetOp
 from lib import util
@@ -30,6 +31,8 @@ TWD_FLASH = 4.5e-3
 TWD_FUSE = 4.5e-3
 TWD_EEPROM = 9e-3
 TWD_ERASE = 9e-3
+TSCK_HALF = 1e-6  # SCK phase
+POLL_TIMEOUT = 0.1  # host time, the link latency included
 
 PROGRAMMING_ENABLED = 0x53
 SPI_PROGRAMMING_ENABLE =        "1010 1100 0101 0011 ____ ____ ____ ____"
@@ -38,26 +41,23 @@ SPI_READ_PROGRAM_MEMORY =       "0010 h000 aaaa aaaa aaaa aaaa 0000 0000"
 SPI_LOAD_PROGRAM_MEMORY_PAGE =  "0100 h000 00__ ____ __aa aaaa iiii iiii"
 SPI_WRITE_PROGRAM_MEMORY_PAGE = "0100 1100 00aa aaaa aaaa aaaa ____ ____"
 SPI_READ_SIGNATURE_BYTE =       "0011 0000 0000 0000 0000 00aa 0000 0000"
+SPI_POLL_RDY_BSY =              "1111 0000 0000 0000 xxxx xxxx xxxx xxxx"
 
 
 class Avr:
-    def __init__(self, pinproxy, progressbar):
+    def __init__(self, pinproxy, progressbar, poll=True):
         self.pinproxy = pinproxy
         self.progressbar = progressbar
+        self.poll = poll
         self.device = None
+        self._read_program_memory = None  # template, compiled at open
+        self.write_times = []  # polled page writes, link latency included
 
     def read_flash(self):
         self._open()
-        for address in range(self.device.flash_size):
-            self.progressbar.update(address, self.device.flash_size)
-            spi_command = util.cmd(
-                SPI_READ_PROGRAM_MEMORY,
-                h=address & 1,
-                a=address >> 1)
-            self._spi(spi_command, range(24, 32))
-        return dict(enumerate(self.pinproxy.pop_fetched(MISO)))
-
-    def write_flash(self, mem):
+        return self._read(range(self.device.flash_size))
+
+    def write_flash(self, mem, incremental=False, erase=False):
         self._open()
         if max(mem) >= self.device.flash_size:
             logger.warning(f"device flash size ({self.device.flash_size}) < "
@@ -65,25 +65,77 @@ class Avr:
             mem = {a: v for a, v in mem.items() if a < self.device.flash_size}
 
         page_size = self.device.page_size
-        for page in util.split_to_pages(mem, page_size):
+        if incremental:
+            pages = self._changed_pages(mem, erase)
+        else:  # programming only clears bits, a blank page changes nothing
+            pages = util.changed_pages(mem, {}, page_size)
+        load_program_memory_page = self.pinproxy.compile(
+            lambda h, a, i: self._spi(
+                util.cmd(SPI_LOAD_PROGRAM_MEMORY_PAGE, h=h, a=a, i=i)),
+            h=1, a=6, i=8)
+        for page in pages:
             for byte_address, value in page.items():
                 offset = byte_address % page_size
-                spi_command = util.cmd(
-                    SPI_LOAD_PROGRAM_MEMORY_PAGE,
-                    h=offset & 1,
-                    a=offset >> 1,
-                    i=value)
-                self._spi(spi_command)
+                load_program_memory_page(h=offset & 1, a=offset >> 1, i=value)
                 self.progressbar.update(byte_address, self.device.flash_size)
             wpage = byte_address // page_size * page_size // 2
             self._spi(util.cmd(SPI_WRITE_PROGRAM_MEMORY_PAGE, a=wpage))
-            self.pinproxy.wait(TWD_FLASH)
+            if (elapsed := self._wait_ready(TWD_FLASH)) is not None:
+                self.write_times.append(elapsed)
+        if self.write_times:
+            times = self.write_times
+            logger.info(f"page write {min(times) * 1e3:.2f}ms min "
+                        f"{sum(times) / len(times) * 1e3:.2f}ms mean "
+                        f"{max(times) * 1e3:.2f}ms max, "
+                        f"{len(times)} pages polled")
 
     def chip_erase(self):
         self._open()
         self._spi(util.cmd(SPI_CHIP_ERASE))
         self.progressbar.update(1, 2)
-        self.pinproxy.wait(TWD_ERASE)
+        self._wait_ready(TWD_ERASE)
+
+    def _wait_ready(self, twd):
+        """Polls RDY/BSY until the device is ready, waits twd if not polling.
+        Returns the polled time, None if waited."""
+        if not self.poll:
+            self.pinproxy.wait(twd)
+            return None
+        start = monotonic()
+        while True:
+            self._spi(util.cmd(SPI_POLL_RDY_BSY), range(31, 32))
+            ready = not self.pinproxy.pop_fetched(MISO, n_bits=1)[0]
+            elapsed = monotonic() - start
+            if ready:
+                break
+            if elapsed > POLL_TIMEOUT:
+                raise Exception(f"Device busy for {elapsed * 1e3:.1f}ms!")
+        return elapsed
+
+    def _changed_pages(self, mem, erase):
+        """Reads mem back, erases if needed and allowed, returns the pages
+        to write"""
+        current = self._read(sorted(mem))
+        n_pages = len(list(util.split_to_pages(mem, self.device.page_size)))
+        if util.needs_erase(mem, current):
+            if not erase:
+                raise Exception("A bit must go from 0 to 1, it takes a chip "
+                                "erase (pass erase=1)!")
+            logger.warning("Chip erase: the flash outside the image is lost, "
+                           "so is the EEPROM unless EESAVE is programmed")
+            self.chip_erase()
+            current = {}
+        pages = util.changed_pages(mem, current, self.device.page_size)
+        logger.info(f"{n_pages - len(pages)} of {n_pages} pages unchanged, "
+                    f"skipped")
+        return pages
+
+    def _read(self, addresses):
+        for address in addresses:
+            self.progressbar.update(address, self.device.flash_size)
+            self._read_program_memory(h=address & 1, a=address >> 1)
+        return dict(zip(addresses,
+                        self.pinproxy.pop_fetched(MISO, as_bytes=True)))
 
     def _open(self):
         if self.device:
@@ -111,23 +163,14 @@ class Avr:
         sigbytes = self.pinproxy.pop_fetched(MISO)
         self.device = DEVICE_SIGNATURES[tuple(sigbytes)]
         logger.info(f"Detected: {self.device}")
+        self._read_program_memory = self.pinproxy.compile(
+            lambda h, a: self._spi(
+                util.cmd(SPI_READ_PROGRAM_MEMORY, h=h, a=a), range(24, 32)),
+            h=1, a=16)
 
     def _spi(self, command, read_range=()):
         assert len(command) == 32
-        set_pin = self.pinproxy.set_pin
-        fetch_pin = self.pinproxy.fetch_pin
-        wait = self.pinproxy.wait
-
-        for i, bit in enumerate(command):
-            wait(500e-9)
-            set_pin(MOSI, bit)
-            wait(500e-9)
-            set_pin(SCK, True)
-            wait(500e-9)
-            if i in read_range:
-                fetch_pin(MISO)
-            wait(500e-9)
-            set_pin(SCK, False)
+        self.pinproxy.shift(SCK, command, MOSI, MISO, read_range, TSCK_HALF)
 
 
 @TargetOp
@@ -136,10 +179,12 @@ def read_flash(pinproxy, progressbar):
 
 
 @TargetOp
-def write_flash(pinproxy, progressbar, mem):
-    return Avr(pinproxy, progressbar).write_flash(mem)
+def write_flash(pinproxy, progressbar, mem, incremental=False, erase=False,
+                poll=True):
+    return Avr(pinproxy, progressbar, poll).write_flash(
+        mem, incremental, erase)
 
 
 @TargetOp
-def chip_erase(pinproxy, progressbar):
-    return Avr(pinproxy, progressbar).chip_erase()
+def chip_erase(pinproxy, progressbar, poll=True):
+    return Avr(pinproxy, progressbar, poll).chip_erase()
@@ -1,6 +1,10 @@
+import logging
+
 from lib import util
 from lib.targetop import TargetOp
 
+logger = logging.getLogger(__name__)
+
 
 CS = "CS"
 SCK = "SCK"
@@ -11,6 +15,7 @@ WP = "WP"
 
 SIZE = 512
 CHUNK = 64
+PAGE = 16
 
 Tcss = Tcsd = 500e-9
 Tsu = 50e-9
@@ -18,6 +23,7 @@ Thd = 100e-9
 Ths = 200e-9
 Thi = Tlo = 475e-9
 Twc = 5e-3
+Thalf = max(Tsu + Tlo, Thi + Thd)  # SCK phase
 
 READ = "0000a011 aaaaaaaa"  # iiiiiiii*[0,512]
 WRITE = "0000a010 aaaaaaaa"  # dddddddd*[1,16]
@@ -46,20 +52,27 @@ class Ee25lc040:
 
     def read(self):
         self._open()
-        for addr in range(0, SIZE, CHUNK):
-            self.progressbar.update(addr, SIZE)
-            cmd = util.cmd(READ, a=addr) + [0] * 8 * CHUNK
-            self._pump(cmd, 16)
-        return dict(enumerate(self.pinproxy.pop_fetched(SO)))
+        return self._read()
 
     def erase(self):
         self._open()
         self.write({})
 
-    def write(self, mem):
+    def write(self, mem, incremental=False, sparse=False):
+        """incremental: reads back and writes the changed pages only,
+        sparse: the chip is erased, writes the non-blank pages only"""
         self._open()
-        for page in range(0, SIZE, 16):
-            data = [mem.get(page + address, 0xff) for address in range(16)]
+        pages = range(0, SIZE, PAGE)
+        if incremental or sparse:
+            image = {address: mem.get(address, 0xff)
+                     for address in range(SIZE)}
+            current = self._read() if incremental else {}
+            changed = util.changed_pages(image, current, PAGE)
+            logger.info(f"{len(pages) - len(changed)} of {len(pages)} pages "
+                        f"{'unchanged' if incremental else 'blank'}, skipped")
+            pages = [min(page) for page in changed]
+        for page in pages:
+            data = [mem.get(page + address, 0xff) for address in range(PAGE)]
             self.progressbar.update(page, SIZE)
             self._wren()
             self.rdsr()
@@ -69,8 +82,15 @@ class Ee25lc040:
         if not all(map(lambda sr: sr & 2, sr_stats)):
             raise Exception("Write failed.")
 
+    def _read(self):
+        for addr in range(0, SIZE, CHUNK):
+            self.progressbar.update(addr, SIZE)
+            cmd = util.cmd(READ, a=addr) + [0] * 8 * CHUNK
+            self._pump(cmd, 16)
+        return dict(enumerate(self.pinproxy.pop_fetched(SO, as_bytes=True)))
+
     def _write_page(self, address, data):
-        assert 1 <= len(data) <= 16
+        assert 1 <= len(data) <= PAGE
         cmd = util.cmd(WRITE, a=address)
         for byte in data:
             cmd += util.cmd(DATA_BYTE, d=byte)
@@ -91,22 +111,14 @@ class Ee25lc040:
 
     def _pump(self, sequence, read_after=None):
         p = self.pinproxy
-        p.reset_pin(CS)
-        p.wait(Tcss)
-
-        for i, bit in enumerate(sequence):
-            p.set_pin(SI, bit)
-            p.wait(Tsu)
-            p.set_pin(SCK)
-            p.wait(Thi)
-            if read_after and i >= read_after:
-                p.fetch_pin(SO)
-            p.wait(Thd)
-            p.reset_pin(SCK)
+        sample = range(read_after, len(sequence)) if read_after else ()
+        with p.transaction():
+            p.reset_pin(CS)
+            p.wait(Tcss)
+            p.shift(SCK, sequence, SI, SO, sample, Thalf)
             p.wait(Tlo)
-
-        p.wait(Tcsd)
-        p.set_pin(CS)
+            p.wait(Tcsd)
+            p.set_pin(CS)
 
 
 @TargetOp
@@ -115,8 +127,8 @@ def read(pinproxy, progressbar):
 
 
 @TargetOp
-def write(pinproxy, progressbar, mem):
-    return Ee25lc040(pinproxy, progressbar).write(mem)
+def write(pinproxy, progressbar, mem, incremental=False, sparse=False):
+    return Ee25lc040(pinproxy, progressbar).write(mem, incremental, sparse)
 
 
 @TargetOp
@@ -1,5 +1,6 @@
 import logging
 
+from lib import util
 from lib.targetop import TargetOp
 
 logger = logging.getLogger(__name__)
@@ -17,6 +18,8 @@ Tdis = Tdih = 100e-9
 Tpd = 400e-9
 Tcz = 100e-9
 Tsv = 500e-9
+Thalf = max(Tdis + Tckl, Tckh)  # CLK phase while writing DI
+Thalf_read = max(Tckl, Tckh, Tpd)  # CLK phase while reading DO
 
 CS = "CS"
 CLK = "CLK"
@@ -42,24 +45,30 @@ class Ee93lcx6:
 
     def read(self):
         self._open()
-        for addr in range(self.size):
-            self.progressbar.update(addr, self.size)
-            self.cmd_read(addr)
-        return dict(enumerate(self.pinproxy.pop_fetched(DO)))
+        return self._read(range(self.size))
 
-    def write(self, mem):
+    def write(self, mem, incremental=False, sparse=False):
+        """incremental: reads back and writes the changed bytes only,
+        sparse: the chip is erased, writes the non-0xff bytes only"""
         self._open()
-        self.ewen()  # enable write
         if max(mem) >= self.size:
             logger.warning(f"device flash size ({self.size}) < "
                             f"input data max address ({max(mem)})")
             mem = {a: v for a, v in mem.items() if a < self.size}
+        if incremental or sparse:
+            current = self._read(sorted(mem)) if incremental else {}
+            changed = util.changed_pages(mem, current, 1)
+            logger.info(f"{len(mem) - len(changed)} of {len(mem)} bytes "
+                        f"{'unchanged' if incremental else 'blank'}, skipped")
+            mem = {a: v for page in changed for a, v in page.items()}
+        self.ewen()  # enable write
 
         length = len(mem)
+        cmd_write = self.pinproxy.compile(self.cmd_write, address=9, value=8)
         for i, (addr, byte) in enumerate(mem.items()):
             self.progressbar.update(i, length)
             if addr < self.size:
-                self.cmd_write(addr, byte)
+                cmd_write(address=addr, value=byte)
         self.ewds()  # disable write
 
     def erase(self):
@@ -72,6 +81,14 @@ class Ee93lcx6:
         self.ewds()
         self.progressbar.update(3, 4)
 
+    def _read(self, addresses):
+        cmd_read = self.pinproxy.compile(self.cmd_read, address=9)
+        for addr in addresses:
+            self.progressbar.update(addr, self.size)
+            cmd_read(address=addr)
+        return dict(zip(addresses,
+                        self.pinproxy.pop_fetched(DO, as_bytes=True)))
+
     def _open(self):
         self.pinproxy.set_as_input(DO)
         # 8 bit ORG
@@ -114,31 +131,23 @@ class Ee93lcx6:
 
     def _pump(self, command, wait_after_time=0.0, need_to_read=False):
         p = self.pinproxy
-        cmdbitmask = 2 ** (command.bit_length() - 1)  # highest bit
-
-        p.set_pin(CS)
-        p.wait(Tcss)
-
-        while cmdbitmask:
-            p.set_pin(DI, command & cmdbitmask)
-            cmdbitmask >>= 1
-            p.wait(Tdis)
-            p.set_pin(CLK)
-            p.wait(Tckh)
-            p.reset_pin(CLK)
+        bits = [command >> i & 1
+                for i in reversed(range(command.bit_length()))]
+
+        with p.transaction():
+            p.set_pin(CS)
+            p.wait(Tcss)
+            p.shift(CLK, bits, DI, half_period=Thalf)
             p.wait(Tckl)
 
-        if need_to_read:
-            for _ in range(8):
-                p.set_pin(CLK)
-                p.wait(max(Tckh, Tpd))
-                p.fetch_pin(DO)
-                p.reset_pin(CLK)
+            if need_to_read:
+                p.shift(CLK, [0] * 8, data_in=DO, sample=range(8),
+                        half_period=Thalf_read)
                 p.wait(Tckl)
 
-        p.wait(Tcsh)
-        p.reset_pin(CS)
-        p.wait(wait_after_time)
+            p.wait(Tcsh)
+            p.reset_pin(CS)
+            p.wait(wait_after_time)
 
 
 @TargetOp
@@ -147,8 +156,10 @@ def read(pinproxy, progressbar, model=66):
 
 
 @TargetOp
-def write(pinproxy, progressbar, mem, model=66):
-    return Ee93lcx6(pinproxy, progressbar, model).write(mem)
+def write(pinproxy, progressbar, mem, model=66, incremental=False,
+          sparse=False):
+    return Ee93lcx6(pinproxy, progressbar, model).write(
+        mem, incremental, sparse)
 
 
 @TargetOp
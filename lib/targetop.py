@@ -18,6 +18,10 @@ class TargetOp:
     def does_need_input(self):
         return "mem" in self._fn_params
 
+    def args(self, **kwargs):
+        "The arguments the op would run with, the defaults filled in"
+        return _fill_params(self._fn_params, kwargs)
+
 
 def _fill_params(params, kwargs):
     result = {}
@@ -0,0 +1,271 @@
+import collections
+import logging
+import shutil
+import tempfile
+from time import monotonic
+from typing import Dict, TextIO
+
+from lib.interfaces import (BaseLoader, OP_FETCH_PIN, OP_SET_PIN, OP_SET_PINS,
+                            OP_SHIFT, OP_WAIT)
+
+
+logger = logging.getLogger(__name__)
+
+TIMESCALE = 1e-9
+WAIT_VAR = "wait"
+ID_CHARS = [chr(c) for c in range(ord("!"), ord("~") + 1)]
+
+
+class PinStats:
+    "Activity of a pin: toggles and the periods between rising edges"
+
+    def __init__(self):
+        self.toggles = 0
+        self.samples = 0
+        self.periods = 0
+        self.total = 0.0
+        self.shortest = float("inf")
+        self.longest = 0.0
+        self._rising_ts = None
+
+    def change(self, ts, rising):
+        self.toggles += 1
+        if not rising:
+            return
+        if self._rising_ts is not None:
+            period = ts - self._rising_ts
+            self.periods += 1
+            self.total += period
+            self.shortest = min(self.shortest, period)
+            self.longest = max(self.longest, period)
+        self._rising_ts = ts
+
+    def __str__(self):
+        result = f"{self.toggles} toggles"
+        if self.samples:
+            result += f", {self.samples} samples"
+        if self.periods:
+            result += (f", period min {self.shortest * 1e6:.2f}us "
+                       f"mean {self.total / self.periods * 1e6:.2f}us "
+                       f"max {self.longest * 1e6:.2f}us")
+        return result
+
+
+class PinTracer(BaseLoader):
+    """Passes the ops through to the loader and writes every pin change,
+    wait and sample to a Value Change Dump (VCD), the pins named after the
+    target pins. The timestamps are the virtual clock of the loader if it
+    has one (sim, bench), the reconstructed device time for loaders
+    buffering an encoded op stream (each op costs the reported loop time)
+    and the host time otherwise. A summary per pin is logged at close().
+    Templates are not encoded while tracing, their ops are traced one by
+    one."""
+
+    def __init__(self, loader, writer: TextIO, pinmap: Dict):
+        self._loader = loader
+        self._writer = writer  # closed at close()
+        self._names = {}  # lpin: var name
+        for tpin, lpin in pinmap.items():
+            if isinstance(lpin, tuple):
+                for i, gang_lpin in enumerate(lpin):
+                    self._names[gang_lpin] = f"{tpin}_{i}"
+            else:
+                self._names[lpin] = tpin
+        self._ids = {}  # var name: VCD identifier
+        self.stats = collections.defaultdict(PinStats)  # var name: stats
+        self._levels = {}  # var name: last written value
+        self._body = tempfile.TemporaryFile("w+")
+        self._events = collections.deque()  # [ts, var, value], value None
+        self._samples = collections.deque()  # events waiting for the value
+        self._written_ts = None
+        self._ts = 0.0  # end of the last op
+        self._overhead = 0.0  # per op, reconstructed device time only
+        self._clock = None
+        self.wait_time = 0.0
+
+    @property
+    def elapsed(self):
+        "End of the last op"
+        return self._ts
+
+    @property
+    def capabilities(self):
+        return self._loader.capabilities
+
+    def open(self):
+        self._loader.open()
+        if hasattr(self._loader, "virtual_time"):
+            self._clock = lambda: self._loader.virtual_time
+        elif self._loader.encode_batch([]) is not None:
+            if caps := self._loader.capabilities:
+                self._overhead = caps.loop_time
+        else:
+            start_ts = monotonic()
+            self._clock = lambda: monotonic() - start_ts
+
+    def close(self):
+        try:
+            self._loader.close()
+        finally:
+            self._drain(final=True)
+            self._write_vcd()
+            total = max(self._ts, 1e-12)
+            logger.info(f"trace: {total * 1e3:.3f}ms, "
+                        f"{self.wait_time * 1e3:.3f}ms in explicit waits "
+                        f"({self.wait_time / total:.0%}), "
+                        f"{(total - self.wait_time) * 1e3:.3f}ms in the "
+                        f"other ops and the shift clocking")
+            for name, stats in sorted(self.stats.items()):
+                logger.info(f"trace: {name}: {stats}")
+
+    def get_output_pins(self):
+        return self._loader.get_output_pins()
+
+    def get_input_pins(self):
+        return self._loader.get_input_pins()
+
+    def set_as_output(self, pin):
+        self._loader.set_as_output(pin)
+
+    def set_as_input(self, pin):
+        self._loader.set_as_input(pin)
+
+    def set_pin(self, pin, new_state):
+        _, end = self._run(self._loader.set_pin, pin, new_state)
+        self._change(end, pin, new_state)
+
+    def set_pins(self, new_states):
+        _, end = self._run(self._loader.set_pins, new_states)
+        for pin, new_state in new_states:
+            self._change(end, pin, new_state)
+
+    def fetch_pin(self, pin, callback):
+        event = self._sample(pin)
+        _, end = self._run(self._loader.fetch_pin, pin,
+                           self._sampled(callback))
+        self._append_sample(end, event)
+
+    def wait(self, seconds):
+        start, end = self._run(self._loader.wait, seconds, duration=seconds)
+        self.wait_time += end - start
+        self._append(start, WAIT_VAR, 1)
+        self._append(end, WAIT_VAR, 0)
+
+    def shift(self, clock, data_out, data_in, bits, sample, callback,
+              half_period, sample_late):
+        sampled = [i for i in range(len(bits))
+                   if data_in is not None and i in sample]
+        # queued before the loader may call back, timed after it returns
+        slots = collections.deque(self._sample(data_in) for _ in sampled)
+        start, end = self._run(
+            self._loader.shift, clock, data_out, data_in, bits, sample,
+            self._sampled(callback) if sampled else callback,
+            half_period, sample_late, duration=2 * half_period * len(bits))
+        period = (end - start) / len(bits) if bits else 0
+        sampled = set(sampled)
+        for i, bit in enumerate(bits):
+            ts = start + i * period
+            if data_out is not None:
+                self._change(ts, data_out, bit)
+            self._change(ts + period / 2, clock, True)
+            if i in sampled and not sample_late:
+                self._append_sample(ts + period / 2, slots.popleft())
+            self._change(ts + period, clock, False)
+            if i in sampled and sample_late:
+                self._append_sample(ts + period, slots.popleft())
+
+    def run_batch(self, ops):
+        dispatch = {
+            OP_SET_PIN: self.set_pin,
+            OP_SET_PINS: self.set_pins,
+            OP_FETCH_PIN: self.fetch_pin,
+            OP_WAIT: self.wait,
+            OP_SHIFT: self.shift,
+        }
+        for kind, *args in ops:
+            dispatch[kind](*args)
+
+    def flush(self):
+        self._loader.flush()
+        self._drain()
+
+    def _run(self, method, *args, duration=0.0):
+        "Calls the loader, returns the start and end time of the op"
+        if self._clock:
+            start = self._clock()
+            method(*args)
+            end = self._clock()
+        else:
+            method(*args)
+            start = self._ts
+            end = start + self._overhead + duration
+        self._ts = max(end, self._ts)
+        return start, end
+
+    def _change(self, ts, pin, new_state):
+        name = self._names.get(pin, str(pin))
+        value = int(bool(new_state))
+        if self._levels.get(name) != value:
+            if name in self._levels:
+                self.stats[name].change(ts, value)
+            self._levels[name] = value
+            self._append(ts, name, value)
+
+    def _sample(self, pin):
+        "Event of a sample, its value is filled in by the callback"
+        name = self._names.get(pin, str(pin))
+        self.stats[name].samples += 1
+        event = [None, name, None]
+        self._samples.append(event)
+        return event
+
+    def _append_sample(self, ts, event):
+        event[0] = ts
+        self._events.append(event)
+        self._drain()
+
+    def _sampled(self, callback):
+        "The callback filling in the sampled values in fetch order"
+        def sampled(bit):
+            self._samples.popleft()[2] = int(bool(bit))
+            callback(bit)
+        return sampled
+
+    def _append(self, ts, name, value):
+        self._events.append([ts, name, value])
+        self._drain()
+
+    def _drain(self, final=False):
+        "Writes the events up to the first one waiting for its value"
+        events, body = self._events, self._body
+        while events and (final or events[0][2] is not None):
+            ts, name, value = events.popleft()
+            if value is None:
+                continue
+            if (var_id := self._ids.get(name)) is None:
+                var_id = self._ids[name] = _var_id(len(self._ids))
+            ts = round(ts / TIMESCALE)
+            if ts != self._written_ts:
+                body.write(f"#{ts}\n")
+                self._written_ts = ts
+            body.write(f"{value}{var_id}\n")
+
+    def _write_vcd(self):
+        with self._writer as writer:
+            writer.write(f"$timescale {round(TIMESCALE * 1e9)}ns $end\n"
+                         "$scope module nops $end\n")
+            for name, var_id in self._ids.items():
+                writer.write(f"$var wire 1 {var_id} {name} $end\n")
+            writer.write("$upscope $end\n$enddefinitions $end\n")
+            self._body.seek(0)
+            shutil.copyfileobj(self._body, writer)
+            self._body.close()
+
+
+def _var_id(index):
+    result = ""
+    while True:
+        index, digit = divmod(index, len(ID_CHARS))
+        result += ID_CHARS[digit]
+        if not index:
+            return result
@@ -26,6 +26,43 @@ def split_to_pages(mem: Mem, page_size: int) -> Iterator[Mem]:
         yield dict(items)
 
 
+def changed_pages(mem: Mem, current: Mem, page_size: int) -> List[Mem]:
+    """
+    Pages of mem holding a value other than the one in current, the
+    addresses missing from current are taken as erased (0xff).
+
+    :param mem: dict holding (address: value) pairs to be written
+    :type mem: Mem
+    :param current: dict holding (address: value) pairs read back
+    :type current: Mem
+    :param page_size: size of the address space for one page
+    :type page_size: int
+
+    :return: the differing pages as split_to_pages() yields them
+    :rtype: List[Mem]
+    """
+    return [page for page in split_to_pages(mem, page_size)
+            if any(current.get(address, 0xff) != value
+                   for address, value in page.items())]
+
+
+def needs_erase(mem: Mem, current: Mem) -> bool:
+    """
+    Tells whether writing mem over current turns a 0 bit into 1, which
+    flash programming can not do without an erase.
+
+    :param mem: dict holding (address: value) pairs to be written
+    :type mem: Mem
+    :param current: dict holding (address: value) pairs read back
+    :type current: Mem
+
+    :return: True if a bit must go from 0 to 1
+    :rtype: bool
+    """
+    return any(value & ~current.get(address, 0xff)
+               for address, value in mem.items())
+
+
 def split_on_gaps(mem: Mem) -> Iterator[Mem]:
     """
     Yields subdictionaries of contiguous keys.
@@ -1,4 +1,5 @@
 #define BAUD 921600
+#define RX_BUFFER_SIZE 1024  // the send window of the loader
 #define LOOP_TIME_US 15
 
 #define SET 0x00
@@ -7,13 +8,43 @@
 #define READ 0x60
 #define SET_AS_OUTPUT 0x80
 #define SET_AS_INPUT 0xa0
+#define EXT 0xe0
+
+#define EXT_SHIFT 0x01
+#define EXT_HELLO 0x02
+#define EXT_WAIT_US 0x10
+#define EXT_PORT_SET 0x18
+#define EXT_PORT_CLEAR 0x19
+#define EXT_PORT_WRITE 0x1a
+#define EXT_REPEAT 0x1b
+#define NO_PIN 0xff
+#define SHIFT_SAMPLE_LATE 0x01
+#define SHIFT_MAX_BYTES 31
 
 #define PROGRESS_CHUNKSIZE 32
 #define PROGRESS_MARK 0x11
+#define HISTORY_SIZE 256
+#define HELLO_REPLY 0x33
+#define PROTOCOL_VERSION 2
+// the EXT_* codes implemented, reported by EXT_HELLO
+#define EXT_OPS ((1UL << EXT_SHIFT) | (1UL << EXT_HELLO) | \
+                 (1UL << EXT_WAIT_US) | (1UL << EXT_PORT_SET) | \
+                 (1UL << EXT_PORT_CLEAR) | (1UL << EXT_PORT_WRITE) | \
+                 (1UL << EXT_REPEAT))
 
 
 unsigned long waitUntil;
 int opCounter;
+int received;  // serial bytes read by the current op
+uint8_t extArgs[6 + 2 * SHIFT_MAX_BYTES];
+// the last bytes received, EXT_REPEAT replays a block of them
+uint8_t history[HISTORY_SIZE];
+uint8_t historyPos;
+uint8_t replay[HISTORY_SIZE];
+int replayLength, replayPos;
+long replayLeft;
+// bit order of the port masks
+const uint8_t portPins[] = {D0, D1, D2, D3, D5, D6, D7, D8};
 
 void setup() {
   pinMode(D0, INPUT);
@@ -26,10 +57,152 @@ void setup() {
   pinMode(D8, INPUT);
   waitUntil = 0;
   opCounter = 0;
+  replayLeft = 0;
+  Serial.setRxBufferSize(RX_BUFFER_SIZE);
   Serial.begin(BAUD);
   while (!Serial);
 }
 
+// the next op stream byte: replayed first, then received, -1 if none
+int readByte() {
+  if (replayLeft) {
+    uint8_t b = replay[replayPos];
+    replayPos = (replayPos + 1) % replayLength;
+    replayLeft--;
+    return b;
+  }
+  int b = Serial.read();
+  if (b != -1) {
+    history[historyPos++] = b;
+    received++;
+  }
+  return b;
+}
+
+void readArgs(uint8_t *args, int n) {
+  for (int i = 0; i < n; i++) {
+    int b;
+    while ((b = readByte()) == -1);
+    args[i] = b;
+  }
+}
+
+// clock, dataOut, dataIn, flags, halfPeriodUs, nBits, data[], sampleMask[]
+int shift() {
+  readArgs(extArgs, 6);
+  uint8_t clock = extArgs[0], dataOut = extArgs[1], dataIn = extArgs[2];
+  uint8_t flags = extArgs[3], halfUs = extArgs[4], nBits = extArgs[5];
+  int nBytes = (nBits + 7) / 8;
+  uint8_t *data = extArgs + 6;
+  uint8_t *mask = data + nBytes;
+  readArgs(data, 2 * nBytes);
+
+  for (int i = 0; i < nBits; i++) {
+    uint8_t bit = 0x80 >> (i & 7);
+    bool sampled = dataIn != NO_PIN && (mask[i >> 3] & bit);
+    if (dataOut != NO_PIN)
+      digitalWrite(dataOut, (data[i >> 3] & bit) ? HIGH : LOW);
+    delayMicroseconds(halfUs);
+    digitalWrite(clock, HIGH);
+    delayMicroseconds(halfUs);
+    if (sampled && !(flags & SHIFT_SAMPLE_LATE))
+      Serial.write(digitalRead(dataIn));
+    digitalWrite(clock, LOW);
+    if (sampled && (flags & SHIFT_SAMPLE_LATE))
+      Serial.write(digitalRead(dataIn));
+  }
+  return 6 + 2 * nBytes;
+}
+
+// delayUs(16 bit, msb first)
+int waitUs() {
+  readArgs(extArgs, 2);
+  waitUntil = micros() + ((extArgs[0] << 8) | extArgs[1]) + LOOP_TIME_US;
+  return 2;
+}
+
+// changes the masked pins at once through the GPIO set/clear registers,
+// GPIO16 (D0) is outside of them
+void portWrite(uint8_t setMask, uint8_t clearMask) {
+  uint32_t setBits = 0, clearBits = 0;
+  for (int i = 1; i < 8; i++) {
+    if (setMask & (1 << i))
+      setBits |= 1 << portPins[i];
+    if (clearMask & (1 << i))
+      clearBits |= 1 << portPins[i];
+  }
+  GPOS = setBits;
+  GPOC = clearBits;
+  if (setMask & 1)
+    GP16O |= 1;
+  if (clearMask & 1)
+    GP16O &= ~1;
+}
+
+// mask, or setMask, clearMask for EXT_PORT_WRITE
+int port(int code) {
+  int length = code == EXT_PORT_WRITE ? 2 : 1;
+  readArgs(extArgs, length);
+  if (code == EXT_PORT_SET)
+    portWrite(extArgs[0], 0);
+  else if (code == EXT_PORT_CLEAR)
+    portWrite(0, extArgs[0]);
+  else
+    portWrite(extArgs[0], extArgs[1]);
+  return length;
+}
+
+// distance, block, count: replays the block bytes received distance bytes
+// before this op count times
+int repeat() {
+  readArgs(extArgs, 3);
+  uint8_t block = extArgs[1];
+  uint8_t start = historyPos - 4 - extArgs[0];
+  for (int i = 0; i < block; i++)
+    replay[i] = history[(uint8_t)(start + i)];
+  replayLength = block;
+  replayPos = 0;
+  replayLeft = (long)block * extArgs[2];
+  return 3;
+}
+
+// replies HELLO_REPLY, length, version, rx buffer size (16 bit), mark
+// chunksize, EXT_OPS (32 bit), LOOP_TIME_US, msb first, the loader tunes
+// itself to them
+int hello() {
+  const uint8_t caps[] = {
+    PROTOCOL_VERSION,
+    RX_BUFFER_SIZE >> 8, RX_BUFFER_SIZE & 0xff,
+    PROGRESS_CHUNKSIZE,
+    (EXT_OPS >> 24) & 0xff, (EXT_OPS >> 16) & 0xff,
+    (EXT_OPS >> 8) & 0xff, EXT_OPS & 0xff,
+    LOOP_TIME_US,
+  };
+  Serial.write(HELLO_REPLY);
+  Serial.write((uint8_t)sizeof(caps));
+  Serial.write(caps, sizeof(caps));
+  return 0;
+}
+
+// returns the number of argument bytes consumed
+int ext(int code) {
+  switch (code) {
+    case EXT_SHIFT:
+      return shift();
+    case EXT_HELLO:
+      return hello();
+    case EXT_WAIT_US:
+      return waitUs();
+    case EXT_PORT_SET:
+    case EXT_PORT_CLEAR:
+    case EXT_PORT_WRITE:
+      return port(code);
+    case EXT_REPEAT:
+      return repeat();
+  }
+  return 0;
+}
+
 void loop() {
   unsigned long now = micros();
   if (waitUntil > now) {
@@ -37,7 +210,8 @@ void loop() {
   }
   waitUntil = 0;
 
-  int op = Serial.read();
+  received = 0;
+  int op = readByte();
   if (op == -1)
     return;
 
@@ -61,11 +235,15 @@ void loop() {
     case SET_AS_INPUT:
       pinMode(arg, INPUT);
       break;
+    case EXT:
+      ext(arg);
+      break;
   }
 
-  opCounter++;
-  if (opCounter == PROGRESS_CHUNKSIZE) {
-    opCounter = 0;
+  // one mark per PROGRESS_CHUNKSIZE bytes received, replays are free
+  opCounter += received;
+  while (opCounter >= PROGRESS_CHUNKSIZE) {
+    opCounter -= PROGRESS_CHUNKSIZE;
     Serial.write(PROGRESS_MARK);
   }
 }
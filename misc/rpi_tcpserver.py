@@ -1,12 +1,16 @@
 #!/usr/bin/python3
 
 import argparse
-from itertools import zip_longest
 import logging
 import socket
 import sys
 from time import monotonic
 
+try:
+    from waiter import parse_cpus, realtime, Waiter
+except ModuleNotFoundError:  # imported from the repository
+    from misc.waiter import parse_cpus, realtime, Waiter
+
 # enum.Enum would be too slow
 OP_SETPIN_LOW = 0
 OP_SETPIN_HIGH = 0x20
@@ -15,53 +19,216 @@ OP_READPIN = 0x60
 OP_SET_AS_OUTPUT = 0x80
 OP_SET_AS_INPUT = 0xA0
 OP_FLUSH = 0xC0
+OP_EXT = 0xE0  # low 5 bits: ext code, followed by payload length and payload
+
+EXT_SHIFT = 0x01
+# the client sends its version, replies CAPS_REPLY
+EXT_HELLO = 0x02
+# 16 bit distance, block and count: executes the block bytes received
+# distance bytes before it count times, the replayed ops count as received
+EXT_REPEAT = 0x03
+EXT_WAIT_100NS = 0x10  # 32 bit delay, msb first
+
+NO_PIN = 0xff
+SHIFT_SAMPLE_LATE = 0x01
+SHIFT_MAX_BITS = 960  # the payload length must fit in a byte
 
+# responses, each starts with its type byte
 FLUSH_DONE = b'\xff'
 PROGRESS_CHUNKSIZE = 2 ** 10
 PROGRESS_MARK = b'\x11'
+READ_BITS = b'\x22'  # 32 bit bit count, the read bits packed msb first
+# length, version, 16 bit credit window and mark chunksize, 32 bit mask of
+# the EXT_* codes, 16 bit per op overhead in 100ns
+CAPS_REPLY = b'\x44'
+PROTOCOL_VERSION = 2
+WINDOW_OPS = 8 * PROGRESS_CHUNKSIZE  # unacknowledged ops a client may send
+BIT_CHARS = bytes.maketrans(b'\x00\x01', b'01')
+# per op overhead reported to the clients, the same on every start so the
+# op caches recorded against it stay usable, see --op-time-ns
+OP_TIME = 1e-6
+
+RECV_BUFFER_SIZE = 2 ** 16
+MAX_OP_LENGTH = 2 + 255
+MAX_REPEAT_DISTANCE = 2 ** 12  # kept before the unparsed ops
 
 logger = logging.getLogger(__name__)
 
 
-def handle_client(client):
-    buffer = bytearray()
-    wakeup_ts = 0
-    op_count = 0
-    while data := client.recv(1024):
-        buffer += data
-
-        for op, arg in zip_longest(buffer[::2], buffer[1::2], fillvalue=None):
-            while wakeup_ts > monotonic():
-                pass
-            wakeup_ts = 0
-
-            if arg is None:  # last odd pair
-                buffer = buffer[-1]
-                break
-
-            if op == OP_SETPIN_LOW:
-                output(arg, LOW)
-            elif op == OP_SETPIN_HIGH:
-                output(arg, HIGH)
-            elif op & 0xe0 == OP_WAIT_100NS:
-                wakeup_ts = monotonic() + (arg + ((op & 0x1f) << 8) + 1) / 1e7
-            elif op == OP_READPIN:
-                client.send(input(arg).to_bytes(1, 'big'))
-            elif op == OP_FLUSH:
-                client.send(FLUSH_DONE)
-            elif op == OP_SET_AS_OUTPUT:
-                GPIO.setup(arg, GPIO.OUT)
-            elif op == OP_SET_AS_INPUT:
-                GPIO.setup(arg, GPIO.IN)
+class Engine:
+    """Executes the op stream of a client. Ops are parsed in place from a
+    preallocated receive buffer and dispatched through a table indexed by
+    the op type. Marks, flush and hello replies are sent as soon as they
+    arise, the client's credit does not wait for the rest of the received
+    ops. Read results are collected and sent packed before them."""
+
+    def __init__(self, client, gpio, waiter=None, op_time=0.0):
+        self._client = client
+        self._op_time = op_time  # reported to the client
+        self._gpio = gpio
+        self._wait_until = (waiter or Waiter()).wait_until
+        self._output = gpio.output
+        self._input = gpio.input
+        self._high, self._low = gpio.HIGH, gpio.LOW
+        self._buffer = bytearray(RECV_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._rpos = self._wpos = 0
+        self._responses = bytearray()
+        self._read_bits = bytearray()  # one 0/1 byte per read
+        self._wakeup_ts = 0
+        self._op_count = 0
+        self._op_pos = 0  # of the ext op being executed
+        self._handlers = [
+            self._setpin_low, self._setpin_high, self._wait, self._readpin,
+            self._set_as_output, self._set_as_input, self._flush, self._ext,
+        ]
+        self._ext_handlers = {
+            EXT_SHIFT: self._shift,
+            EXT_HELLO: self._hello,
+            EXT_WAIT_100NS: self._wait_long,
+            EXT_REPEAT: self._repeat,
+        }
+
+    def run(self):
+        "Serves the client until it disconnects"
+        while self._receive():
+            self.execute()
+
+    def execute(self):
+        "Executes the complete ops received so far"
+        self._rpos = self._run(self._rpos, self._wpos)
+
+    def _run(self, pos, end):
+        "Executes the complete ops in the buffer from pos, returns the rest"
+        view, handlers = self._view, self._handlers
+        while pos + 2 <= end:
+            op, arg = view[pos], view[pos + 1]
+            if op >= OP_EXT:
+                if pos + 2 + arg > end:  # incomplete payload
+                    break
+                self._op_pos = pos
+                payload = view[pos + 2:pos + 2 + arg]
+                pos += 2 + arg
             else:
-                logger.warning(f"Invalid opcode received: {op}")
-            op_count += 1
-            if op_count % PROGRESS_CHUNKSIZE == 0:
-                client.send(PROGRESS_MARK)
-        buffer.clear()
+                payload = None
+                pos += 2
+
+            if self._wakeup_ts:
+                self._wait_until(self._wakeup_ts)
+                self._wakeup_ts = 0
+            handlers[op >> 5](op, arg, payload)
+
+            self._op_count += 1
+            if self._op_count == PROGRESS_CHUNKSIZE:
+                self._op_count = 0
+                self._respond(PROGRESS_MARK)
+        return pos
+
+    def _receive(self):
+        """Moves the unparsed tail and the history EXT_REPEAT may replay to
+        the front if needed, then receives"""
+        if RECV_BUFFER_SIZE - self._wpos < MAX_OP_LENGTH:
+            start = max(self._rpos - MAX_REPEAT_DISTANCE, 0)
+            tail = self._wpos - start
+            self._buffer[:tail] = self._buffer[start:self._wpos]
+            self._rpos, self._wpos = self._rpos - start, tail
+        n = self._client.recv_into(self._view[self._wpos:])
+        self._wpos += n
+        return n
+
+    def _respond(self, response):
+        "Sends a response after the pending read bits"
+        if bits := self._read_bits:
+            pad = -len(bits) % 8
+            value = int((bits + bytes(pad)).translate(BIT_CHARS), 2)
+            self._responses += READ_BITS + len(bits).to_bytes(4, 'big')
+            self._responses += value.to_bytes((len(bits) + pad) // 8, 'big')
+            bits.clear()
+        self._responses += response
+        self._client.sendall(self._responses)
+        self._responses.clear()
+
+    def _setpin_low(self, op, arg, payload):
+        self._output(arg, self._low)
+
+    def _setpin_high(self, op, arg, payload):
+        self._output(arg, self._high)
+
+    def _wait(self, op, arg, payload):
+        self._wakeup_ts = monotonic() + (arg + ((op & 0x1f) << 8) + 1) / 1e7
+
+    def _readpin(self, op, arg, payload):
+        self._read_bits.append(self._input(arg))
+
+    def _set_as_output(self, op, arg, payload):
+        self._gpio.setup(arg, self._gpio.OUT)
+
+    def _set_as_input(self, op, arg, payload):
+        self._gpio.setup(arg, self._gpio.IN)
+
+    def _flush(self, op, arg, payload):
+        self._respond(FLUSH_DONE)
+
+    def _ext(self, op, arg, payload):
+        if handler := self._ext_handlers.get(op & 0x1f):
+            handler(payload)
+        else:
+            logger.warning(f"Invalid opcode received: {op}")
+
+    def _hello(self, payload):
+        ext_ops = sum(1 << code for code in self._ext_handlers)
+        op_time = min(round(self._op_time * 1e7), 0xffff)
+        caps = bytes([PROTOCOL_VERSION]) \
+            + WINDOW_OPS.to_bytes(2, 'big') \
+            + PROGRESS_CHUNKSIZE.to_bytes(2, 'big') \
+            + ext_ops.to_bytes(4, 'big') + op_time.to_bytes(2, 'big')
+        self._respond(CAPS_REPLY + bytes([len(caps)]) + caps)
+
+    def _wait_long(self, payload):
+        self._wakeup_ts = monotonic() + int.from_bytes(payload, 'big') / 1e7
 
+    def _repeat(self, payload):
+        distance, block, count = (int.from_bytes(payload[i:i + 2], 'big')
+                                  for i in range(0, 6, 2))
+        start = self._op_pos - distance
+        self._op_count -= 1  # only the replayed ops count
+        for _ in range(count):
+            self._run(start, start + block)
 
-def serve_forever(address, port):
+    def _shift(self, payload):
+        "Clocks out the bits of an EXT_SHIFT payload, reads the samples"
+        output, input, high, low = \
+            self._output, self._input, self._high, self._low
+        read_bits, wait_until = self._read_bits, self._wait_until
+        clock, dout, din, flags = payload[:4]
+        half = int.from_bytes(payload[4:6], 'big') / 1e7
+        n_bits = int.from_bytes(payload[6:8], 'big')
+        n_bytes = (n_bits + 7) // 8
+        data = payload[8:8 + n_bytes]
+        mask = payload[8 + n_bytes:8 + 2 * n_bytes]
+        sample_late = flags & SHIFT_SAMPLE_LATE
+        for i in range(n_bits):
+            bit = 0x80 >> (i & 7)
+            sample = din != NO_PIN and mask[i >> 3] & bit
+            if dout != NO_PIN:
+                output(dout, high if data[i >> 3] & bit else low)
+            wakeup_ts = monotonic() + half
+            wait_until(wakeup_ts)
+            output(clock, high)
+            wait_until(wakeup_ts + half)
+            if sample and not sample_late:
+                read_bits.append(input(din))
+            output(clock, low)
+            if sample and sample_late:
+                read_bits.append(input(din))
+
+
+def handle_client(client, gpio, waiter=None, op_time=0.0):
+    Engine(client, gpio, waiter, op_time).run()
+
+
+def serve_forever(address, port, gpio, waiter=None, op_time=OP_TIME):
+    waiter = waiter or Waiter()
     s = socket.socket()
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
@@ -71,28 +238,100 @@ def serve_forever(address, port):
     while True:
         logger.info(f"Waiting for client on {s.getsockname()}...")
         client, raddr = s.accept()
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
         logger.info(f"Accepted connection: {raddr}")
 
-        GPIO.setmode(GPIO.BOARD)
+        gpio.setmode(gpio.BOARD)
         try:
-            handle_client(client)
+            handle_client(client, gpio, waiter, op_time)
         except (BrokenPipeError, ConnectionError) as e:
             logger.warning(f"{e}")
         logger.info("Connection closed.")
-        GPIO.cleanup()
+        if waiter.stats is not None:
+            logger.info(f"waits: {waiter.stats}")
+        gpio.cleanup()
+
+
+class StubGPIO:
+    "Stands in for RPi.GPIO in the benchmark, inputs read as low"
+    BOARD = 10
+    IN, OUT = 1, 0
+    HIGH, LOW = 1, 0
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction):
+        pass
+
+    def output(self, pin, state):
+        pass
+
+    def input(self, pin):
+        return self.LOW
+
+    def cleanup(self):
+        pass
+
+
+class _ReplayClient:
+    "Feeds a recorded op stream to the Engine, drops the responses"
+
+    def __init__(self, data, chunksize):
+        self._data = memoryview(data)
+        self._chunksize = chunksize
+        self._pos = 0
+        self.received = 0
+
+    def recv_into(self, buffer):
+        n = min(len(buffer), self._chunksize, len(self._data) - self._pos)
+        buffer[:n] = self._data[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def sendall(self, data):
+        self.received += len(data)
+
+
+def benchmark(n_ops, chunksize=4096):
+    "Runs a pin toggling and reading op stream against StubGPIO"
+    pattern = bytes([OP_SETPIN_HIGH, 3, OP_SETPIN_LOW, 3, OP_READPIN, 5,
+                     OP_SETPIN_HIGH, 5, OP_SETPIN_LOW, 5, OP_WAIT_100NS, 0])
+    data = pattern * (n_ops // 6) + bytes(2)
+    client = _ReplayClient(data, chunksize + 1)  # odd, splits the ops
+    start_ts = monotonic()
+    handle_client(client, StubGPIO())
+    elapsed = monotonic() - start_ts
+    ops = len(data) // 2
+    logger.info(f"{ops} ops in {elapsed:.3f}s: {ops / elapsed:.0f} ops/s "
+                f"({elapsed / ops * 1e9:.0f}ns per op), "
+                f"{client.received} response bytes")
+    return ops / elapsed
 
 
 def parse_args(argv):
     p = argparse.ArgumentParser()
     p.add_argument("-b", "--bind", default="0.0.0.0")
     p.add_argument("-p", "--port", type=int, default=30456)
+    p.add_argument("--benchmark", type=int, metavar="N_OPS",
+                   help="measure the op rate with a stub GPIO and exit")
+    p.add_argument("--priority", type=int,
+                   help="run with this SCHED_FIFO priority (1-99)")
+    p.add_argument("--cpus", help="pin to these cpus, eg. 3 or 2+3")
+    p.add_argument("--mlock", action="store_true",
+                   help="lock the memory against page faults")
+    p.add_argument("--spin-us", type=int,
+                   help="spin the last microseconds of the waits only, "
+                        "calibrated by default")
+    p.add_argument("--jitter", action="store_true",
+                   help="log the lateness of the waits per connection")
+    p.add_argument("--op-time-ns", type=int, default=round(OP_TIME * 1e9),
+                   help="per op overhead reported to the clients, their "
+                        "waits are shortened by it (default: %(default)s)")
     return p.parse_args(argv)
 
 
 if __name__ == "__main__":
-    import RPi.GPIO as GPIO
-    from RPi.GPIO import output, input, HIGH, LOW
-
     args = parse_args(sys.argv[1:])
 
     logging.basicConfig(
@@ -101,4 +340,12 @@ if __name__ == "__main__":
         format="[%(asctime)s.%(msecs)0.3d] %(message)s")
     logger.info(f"args: {sys.argv}")
 
-    serve_forever(args.bind, args.port)
+    if args.benchmark:
+        benchmark(args.benchmark)
+        sys.exit(0)
+
+    import RPi.GPIO as GPIO
+    spin_time = None if args.spin_us is None else args.spin_us / 1e6
+    with realtime(args.priority, parse_cpus(args.cpus), args.mlock):
+        serve_forever(args.bind, args.port, GPIO,
+                      Waiter(spin_time, args.jitter), args.op_time_ns / 1e9)
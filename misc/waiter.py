@@ -0,0 +1,133 @@
+import contextlib
+import ctypes
+import ctypes.util
+import logging
+import os
+from time import monotonic, sleep
+
+
+logger = logging.getLogger(__name__)
+
+# standard library only, deployed next to rpi_tcpserver.py
+
+MIN_SPIN_TIME = 50e-6
+MAX_SPIN_TIME = 5e-3
+CALIBRATION_SAMPLES = 20
+CALIBRATION_SLEEP = 1e-4
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+
+def calibrate_spin_time(samples=CALIBRATION_SAMPLES):
+    "Worst sleep() overshoot seen, with a margin, in seconds"
+    overshoot = 0.0
+    for _ in range(samples):
+        start_ts = monotonic()
+        sleep(CALIBRATION_SLEEP)
+        overshoot = max(overshoot,
+                        monotonic() - start_ts - CALIBRATION_SLEEP)
+    return min(max(2 * overshoot, MIN_SPIN_TIME), MAX_SPIN_TIME)
+
+
+class JitterStats:
+    "Lateness of the waits, how long after the deadline they returned"
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+
+    def add(self, late):
+        self.count += 1
+        self.total += late
+        if late > self.worst:
+            self.worst = late
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __str__(self):
+        return (f"{self.count} waits, late {self.mean * 1e6:.1f}us on "
+                f"average, {self.worst * 1e6:.1f}us at worst")
+
+
+class Waiter:
+    """Sleeps for the bulk of a delay and spins on monotonic() for the final
+    spin_time seconds only, sleep() alone wakes up too late. Short delays are
+    spun entirely. spin_time is calibrated when not given."""
+
+    def __init__(self, spin_time=None, record_jitter=False):
+        self.spin_time = \
+            calibrate_spin_time() if spin_time is None else spin_time
+        self.stats = JitterStats() if record_jitter else None
+
+    def wait(self, seconds):
+        self.wait_until(monotonic() + seconds)
+
+    def wait_until(self, wakeup_ts):
+        remaining = wakeup_ts - monotonic()
+        if remaining > self.spin_time:
+            sleep(remaining - self.spin_time)
+        while wakeup_ts > monotonic():
+            pass
+        if self.stats is not None:
+            self.stats.add(monotonic() - wakeup_ts)
+
+
+@contextlib.contextmanager
+def realtime(priority=None, cpus=None, lock_memory=False):
+    """
+    Runs the block with SCHED_FIFO priority, pinned to the cpus and with the
+    memory locked, each one opt-in. Settings the process is not allowed to
+    change are warned about and skipped, the previous ones are restored.
+
+    :param priority: SCHED_FIFO priority (1-99), defaults to None (keep)
+    :type priority: int
+    :param cpus: cpu numbers to run on, defaults to None (keep)
+    :type cpus: {int}
+    :param lock_memory: mlockall() against page faults, defaults to False
+    :type lock_memory: bool
+    """
+    with contextlib.ExitStack() as stack:
+        if priority is not None:
+            _apply(stack, "SCHED_FIFO", _set_fifo, int(priority))
+        if cpus is not None:
+            _apply(stack, "cpu affinity", _set_affinity, set(cpus))
+        if lock_memory:
+            _apply(stack, "mlockall", _lock_memory)
+        yield
+
+
+def parse_cpus(cpus):
+    "3 or '2+3' to {2, 3}"
+    if cpus is None:
+        return None
+    return {int(cpu) for cpu in str(cpus).split("+")}
+
+
+def _apply(stack, name, setter, *args):
+    try:
+        stack.callback(setter(*args))
+    except (OSError, AttributeError) as e:
+        logger.warning(f"{name} not applied: {e}")
+
+
+def _set_fifo(priority):
+    policy, param = os.sched_getscheduler(0), os.sched_getparam(0)
+    os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    return lambda: os.sched_setscheduler(0, policy, param)
+
+
+def _set_affinity(cpus):
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    return lambda: os.sched_setaffinity(0, previous)
+
+
+def _lock_memory():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return libc.munlockall
@@ -0,0 +1,23 @@
+from lib.loader.bench import Loader
+from lib.optimizer import OpOptimizer
+from lib.pinproxy import ThePinProxy
+from lib.progressbar import ProgressBar
+from lib.target import ee25lc040
+
+
+def test_counts_ops_and_device_time():
+    loader = Loader()
+    pinmap = {"CS": 1, "SCK": 2, "SI": 3, "SO": 4, "HOLD": 5, "WP": 6}
+    with ThePinProxy(OpOptimizer(loader), pinmap) as pinproxy:
+        ee25lc040.write(pinproxy, ProgressBar(muted=True), {0: 0x12})
+    pages = ee25lc040.SIZE // 16
+    assert loader.counts["fetch_pin"] == pages * 8  # RDSR per page
+    assert loader.ops == sum(loader.counts.values())
+    assert loader.virtual_time > pages * ee25lc040.Twc
+
+
+def test_fetch_level():
+    fetched = []
+    Loader(level=0).fetch_pin(1, fetched.append)
+    Loader().fetch_pin(1, fetched.append)
+    assert fetched == [0, 1]
@@ -0,0 +1,75 @@
+import random
+
+from lib.bitbuffer import BitBuffer
+
+
+def make_buffer(bits):
+    buffer = BitBuffer()
+    buffer.extend(bits)
+    return buffer
+
+
+def test_append_and_len():
+    buffer = make_buffer([1, 0, 1])
+    assert len(buffer) == 3
+    buffer.append(1)
+    assert len(buffer) == 4
+    assert buffer.pop(4) == [0b1011]
+    assert len(buffer) == 0
+
+
+def test_pop_octets():
+    buffer = make_buffer([1, 0] * 4 + [0, 1] * 4 + [1])
+    assert buffer.pop() == [0xaa, 0x55]
+    assert len(buffer) == 1
+
+
+def test_pop_lsb():
+    buffer = make_buffer([1, 1, 0, 0, 0, 0, 0, 0] * 2)
+    assert buffer.pop(lsb=True) == [0x03, 0x03]
+    buffer.extend([1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0])
+    assert buffer.pop(16, lsb=True) == [0x0201]
+
+
+def test_pop_unaligned():
+    buffer = make_buffer([1, 1, 1])
+    assert buffer.pop(3, n_values=1) == [7]
+    buffer.extend([1, 0, 1, 0, 0, 1, 0, 1, 0, 1, 1])
+    assert buffer.pop(5) == [0b10100, 0b10101]
+    assert buffer.pop(1) == [1]
+
+
+def test_pop_bytes():
+    buffer = make_buffer([0, 1] * 12)
+    assert buffer.pop_bytes(n_values=2) == b"\x55\x55"
+    assert buffer.pop_bytes(lsb=True) == b"\xaa"
+    assert buffer.pop_bytes() == b""
+
+
+def test_extend_packed():
+    buffer = make_buffer([1])
+    buffer.extend_packed(b"\xff\x00", 12)
+    buffer.extend_packed(b"\x80", 1)
+    assert len(buffer) == 14
+    assert buffer.pop(14) == [0b1_11111111_0000_1]
+
+
+def test_random_roundtrip():
+    r = random.Random(0)
+    bits = [r.getrandbits(1) for _ in range(1000)]
+    buffer = BitBuffer()
+    pos = 0
+    while pos < len(bits):
+        n = r.randrange(1, 20)
+        chunk = bits[pos:pos + n]
+        packed = int("".join(map(str, chunk)), 2) << (-len(chunk) % 8)
+        buffer.extend_packed(packed.to_bytes((len(chunk) + 7) // 8, "big"),
+                             len(chunk))
+        pos += n
+
+    result = []
+    while len(buffer):
+        n = min(r.randrange(1, 40), len(buffer))
+        value = buffer.pop(n, n_values=1)[0]
+        result += [int(b) for b in f"{value:0{n}b}"]
+    assert result == bits
@@ -0,0 +1,26 @@
+from lib.compress import find_repeats
+
+
+def matches(ops, *limits):
+    data = b"".join(ops)
+    starts = [sum(map(len, ops[:i])) for i in range(len(ops))]
+    return list(find_repeats(data, starts, *limits))
+
+
+def test_runs_and_dictionary_matches():
+    ops = [b"a", b"bc", b"a", b"bc", b"a", b"bc", b"d", b"ee", b"x", b"y",
+           b"d", b"ee", b"f"]
+    assert matches(ops, 255, 255, 255, 2) == [
+        (3, 3, 3, 2),  # abc twice more
+        (14, 5, 3, 1),  # dee again, behind xy
+    ]
+
+
+def test_limits():
+    ops = [b"ab"] * 10
+    # the block of a match starts after the previous match
+    assert matches(ops, 255, 255, 3, 1) == [
+        (2, 2, 2, 3), (10, 2, 2, 3), (18, 2, 2, 1)]
+    assert matches(ops, 1, 255, 255, 1) == []
+    assert matches(ops, 255, 1, 255, 1) == []
+    assert matches(ops, 255, 255, 255, 18) == []
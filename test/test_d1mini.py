@@ -0,0 +1,301 @@
+import collections
+
+import pytest
+
+pytest.importorskip("serial")
+
+import lib.loader.d1mini as D
+
+
+BUFFER_SIZE = 256
+MARK_CHUNKSIZE = 16
+LOOP_TIME_US = 15
+ALL_EXT_OPS = frozenset([D.EXT_SHIFT, D.EXT_HELLO, D.EXT_WAIT_US,
+                         D.EXT_PORT_SET, D.EXT_PORT_CLEAR, D.EXT_PORT_WRITE,
+                         D.EXT_REPEAT])
+GPIO_NAMES = {gpio: name for name, gpio in D.PINS.items()}
+
+
+class FakePort:
+    """Runs the op stream like fw_d1mini does. The ops are executed when
+    the loader blocks on a read, the bytes written meanwhile fill the rx
+    buffer."""
+
+    def __init__(self, ext_ops=ALL_EXT_OPS, levels=None):
+        self.ext_ops = ext_ops  # empty: a firmware without EXT_HELLO
+        self.buffer_size = BUFFER_SIZE if ext_ops else D.RX_BUFFER_SIZE
+        self.mark_chunksize = \
+            MARK_CHUNKSIZE if ext_ops else D.PROGRESS_CHUNKSIZE
+        self.levels = levels or {}  # pin: input level
+        self.log = []  # (pin, state)
+        self.waits = []  # us
+        self.link_bytes = 0
+        self.max_buffered = 0
+        self.timeout = None
+        self._rx = collections.deque()
+        self._tx = collections.deque()
+        self._history = bytearray()
+        self._replay = collections.deque()
+        self._received = 0  # by the current op
+        self._count = 0
+
+    def setDTR(self, _):
+        pass
+
+    def setRTS(self, _):
+        pass
+
+    def reset_input_buffer(self):
+        self._tx.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        assert len(self._rx) + len(data) <= self.buffer_size, \
+            "rx buffer overrun"
+        self._rx.extend(data)
+        self.link_bytes += len(data)
+        self.max_buffered = max(self.max_buffered, len(self._rx))
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        return len(self._tx)
+
+    def read(self, n):
+        self._run()
+        if self.timeout is not None:
+            n = min(n, len(self._tx))
+        assert len(self._tx) >= n, "the loader would wait forever"
+        return bytes(self._tx.popleft() for _ in range(n))
+
+    def _byte(self):
+        if self._replay:
+            return self._replay.popleft()
+        b = self._rx.popleft()
+        self._history.append(b)
+        self._received += 1
+        return b
+
+    def _args(self, n):
+        return [self._byte() for _ in range(n)]
+
+    def _output(self, gpio, state):
+        self.log.append((GPIO_NAMES[gpio], state))
+
+    def _run(self):
+        while self._rx or self._replay:
+            self._received = 0
+            op = self._byte()
+            kind, arg = op & 0xe0, op & 0x1f
+            if kind == D.OP_SETPIN_HIGH:
+                self._output(arg, 1)
+            elif kind == D.OP_SETPIN_LOW:
+                self._output(arg, 0)
+            elif kind == D.OP_WAIT_US:
+                self.waits.append(arg)
+            elif kind == D.OP_READ:
+                self._tx.append(self.levels.get(GPIO_NAMES[arg], 0))
+            elif kind == D.OP_EXT:
+                self._ext(arg)
+            self._count += self._received
+            while self._count >= self.mark_chunksize:
+                self._count -= self.mark_chunksize
+                self._tx.append(D.PROGRESS_MARK)
+
+    def _ext(self, code):
+        if code == D.EXT_HELLO and not self.ext_ops:
+            return  # not implemented, skipped
+        assert code in self.ext_ops, f"unknown ext op {code:#x}"
+        if code == D.EXT_HELLO:
+            mask = sum(1 << c for c in self.ext_ops)
+            caps = bytes([2]) + BUFFER_SIZE.to_bytes(2, "big") \
+                + bytes([MARK_CHUNKSIZE]) + mask.to_bytes(4, "big") \
+                + bytes([LOOP_TIME_US])
+            self._tx.extend(bytes([D.HELLO_REPLY, len(caps)]) + caps)
+        elif code == D.EXT_WAIT_US:
+            high, low = self._args(2)
+            self.waits.append(high << 8 | low)
+        elif code in (D.EXT_PORT_SET, D.EXT_PORT_CLEAR, D.EXT_PORT_WRITE):
+            if code == D.EXT_PORT_WRITE:
+                set_mask, clear_mask = self._args(2)
+            elif code == D.EXT_PORT_SET:
+                set_mask, clear_mask = self._args(1)[0], 0
+            else:
+                set_mask, clear_mask = 0, self._args(1)[0]
+            for i, name in enumerate(D.PORT_PINS):
+                if set_mask >> i & 1:
+                    self.log.append((name, 1))
+                if clear_mask >> i & 1:
+                    self.log.append((name, 0))
+        elif code == D.EXT_REPEAT:
+            distance, block, count = self._args(3)
+            start = len(self._history) - D.REPEAT_LENGTH - distance
+            self._replay.extend(
+                bytes(self._history[start:start + block]) * count)
+        elif code == D.EXT_SHIFT:
+            clock, dout, din, flags, _, n_bits = self._args(6)
+            n_bytes = (n_bits + 7) // 8
+            data = self._args(2 * n_bytes)
+            for i in range(n_bits):
+                bit = 0x80 >> (i & 7)
+                if dout != D.NO_PIN:
+                    self._output(dout, int(bool(data[i >> 3] & bit)))
+                self._output(clock, 1)
+                self._output(clock, 0)
+                if din != D.NO_PIN and data[n_bytes + (i >> 3)] & bit:
+                    self._tx.append(self.levels.get(GPIO_NAMES[din], 0))
+
+
+def open_loader(monkeypatch, port, **kwargs):
+    monkeypatch.setattr(D.serial, "Serial", lambda *_: port)
+    monkeypatch.setattr(D.time, "sleep", lambda _: None)
+    loader = D.Loader(**kwargs)
+    loader.open()
+    return loader
+
+
+def test_hello_tunes_the_loader(monkeypatch):
+    loader = open_loader(monkeypatch, FakePort())
+    caps = loader.capabilities
+    assert caps.version == 2
+    assert caps.buffer_size == BUFFER_SIZE
+    assert caps.mark_chunksize == MARK_CHUNKSIZE
+    assert caps.ext_ops == ALL_EXT_OPS
+    assert caps.loop_time == LOOP_TIME_US / 1e6
+    assert loader._write_chunksize == BUFFER_SIZE // D.WRITE_CHUNKSIZES
+    assert loader._compress
+
+
+def test_without_hello_only_plain_ops_are_sent(monkeypatch):
+    port = FakePort(ext_ops=frozenset(), levels={"D6": 1})
+    loader = open_loader(monkeypatch, port)
+    assert loader.capabilities is None
+    assert not loader._compress
+    bits = []
+    loader.set_pins([("D1", 1), ("D2", 0)])
+    loader.wait(0.01)  # beyond the short wait op
+    loader.shift("D5", "D7", "D6", (1, 0), range(2), bits.append, 1e-6,
+                 False)
+    for _ in range(20):
+        loader.set_pin("D1", 0)
+        loader.set_pin("D1", 1)
+    loader.flush()
+    assert port.log[:2] == [("D1", 1), ("D2", 0)]
+    assert sum(port.waits) + LOOP_TIME_US * len(port.waits) >= 10000 - 15
+    assert bits == [1, 1]
+
+
+def test_late_hello_reply_is_dropped(monkeypatch):
+    class LatePort(FakePort):
+        "Answers EXT_HELLO only after the loader stopped waiting"
+
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.late = b""
+
+        def read(self, n):
+            if self.timeout is None:
+                self.arrive()
+                return super().read(n)
+            self._run()
+            self.late, self._tx = bytes(self._tx), collections.deque()
+            return b""
+
+        def arrive(self):
+            self._tx.extend(self.late)
+            self.late = b""
+
+    port = LatePort(levels={"D6": 1})
+    monkeypatch.setattr(D.serial, "Serial", lambda *_: port)
+    monkeypatch.setattr(D.time, "sleep", lambda _: port.arrive())
+    loader = D.Loader()
+    loader.open()
+    assert loader.capabilities is None
+    bits = []
+    for pin in ("D6", "D2", "D6"):
+        loader.fetch_pin(pin, bits.append)
+    loader.flush()
+    assert bits == [1, 0, 1]
+
+
+def test_parse_caps():
+    caps = D._parse_caps(bytes([2, 0x04, 0x00, 32, 0, 1, 0, 0x06, 15]))
+    assert caps.version == 2
+    assert caps.buffer_size == 1024
+    assert caps.mark_chunksize == 32
+    assert caps.ext_ops == {D.EXT_SHIFT, D.EXT_HELLO, D.EXT_WAIT_US}
+    assert caps.loop_time == 15e-6
+
+
+def test_send_window_and_marks(monkeypatch):
+    port = FakePort(levels={"D6": 1})
+    loader = open_loader(monkeypatch, port, compress=0)
+    bits = []
+    for i in range(1000):
+        loader.set_pin("D1", i & 1)
+        loader.fetch_pin("D6" if i % 3 else "D2", bits.append)
+    loader.flush()
+    assert bits == [1 if i % 3 else 0 for i in range(1000)]
+    assert port.max_buffered >= BUFFER_SIZE - loader._write_chunksize
+    assert 0 <= loader._unprocessed < MARK_CHUNKSIZE
+    assert not loader._read_callbacks
+
+
+def test_encode_wait():
+    assert D._encode_wait(10e-6, 15) == b""
+    assert D._encode_wait(40e-6, 15) == bytes([D.OP_WAIT_US | 25])
+    assert D._encode_wait(100e-6, 15) == bytes([D.OP_EXT | D.EXT_WAIT_US,
+                                               0, 85])
+    assert D._encode_wait(100e-6, 15, long_wait=False) == \
+        bytes([D.OP_WAIT_US | 31]) * 2
+    waits = D._encode_wait(1.0, 15)
+    assert waits[::3] == bytes([D.OP_EXT | D.EXT_WAIT_US]) * 16
+    device_time = sum(int.from_bytes(waits[i + 1:i + 3], "big") + 15
+                      for i in range(0, len(waits), 3))
+    assert 1e6 - 15 <= device_time <= 1e6
+
+
+def test_port_masks():
+    assert D._encode_set_pins([("D1", 1)]) == \
+        bytes([D.OP_SETPIN_HIGH | D.PINS["D1"]])
+    assert D._encode_set_pins([("D0", 1), ("D8", 1)]) == \
+        bytes([D.OP_EXT | D.EXT_PORT_SET, 0x81])
+    assert D._encode_set_pins([("D0", 0), ("D3", 0)]) == \
+        bytes([D.OP_EXT | D.EXT_PORT_CLEAR, 0x09])
+    # the last state of a pin wins
+    assert D._encode_set_pins([("D0", 1), ("D5", 0), ("D0", 0)]) == \
+        bytes([D.OP_EXT | D.EXT_PORT_CLEAR, 0x11])
+    assert D._encode_set_pins([("D0", 1), ("D7", 0)]) == \
+        bytes([D.OP_EXT | D.EXT_PORT_WRITE, 0x01, 0x40])
+
+
+def test_port_write_reaches_d0(monkeypatch):
+    port = FakePort()
+    loader = open_loader(monkeypatch, port)
+    loader.set_pins([("D0", 1), ("D2", 1), ("D7", 0)])
+    loader.flush()
+    assert port.log == [("D0", 1), ("D2", 1), ("D7", 0)]
+
+
+def test_repeats_are_replayed(monkeypatch):
+    logs = {}
+    for compress in (0, 1):
+        port = FakePort(levels={"D6": 1})
+        loader = open_loader(monkeypatch, port, compress=compress)
+        bits = []
+        for i in range(200):
+            loader.shift("D5", "D7", "D6", (1, 0, i & 1), range(2, 3),
+                         bits.append, 1e-6, False)
+            loader.set_pin("D1", 1)
+            loader.set_pin("D1", 0)
+        loader.flush()
+        assert bits == [1] * 200
+        assert port.link_bytes == loader.link_bytes + 1  # EXT_HELLO
+        logs[compress] = port.log, loader.link_bytes
+    assert logs[1][0] == logs[0][0]
+    assert logs[1][1] < logs[0][1] / 2
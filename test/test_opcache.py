@@ -0,0 +1,105 @@
+import socket
+import threading
+
+import pytest
+
+from lib.opcache import CacheMismatchError
+from lib.progressbar import ProgressBar
+from lib.runner import Job, run_job
+from lib.sim.avr import AvrSpi, CHIPS
+import misc.rpi_tcpserver as RT
+from misc.waiter import Waiter
+from test_rpi_tcpserver import RecordingGPIO
+
+
+def serve_once(gpio):
+    "Port of a server thread handling a single client"
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    s.listen(1)
+
+    def serve():
+        client, _ = s.accept()
+        with client, s:
+            RT.handle_client(client, gpio, Waiter(spin_time=0))
+    threading.Thread(target=serve, daemon=True).start()
+    return s.getsockname()[1]
+
+
+class SimGPIO(RT.StubGPIO):
+    "An AVR serial programming interface on the board pins of AVR_PINMAP"
+
+    def __init__(self, chip):
+        self.avr = AvrSpi(bytearray(b"\xff" * CHIPS[chip].flash_size),
+                          CHIPS[chip])
+        self.commands = []  # the executed ones
+        execute = self.avr._execute
+        self.avr._execute = lambda command: (
+            self.commands.append(bytes(command)), execute(command))
+
+    def output(self, pin, state):
+        self.avr.set_pin(AVR_NAMES[pin], state)
+
+    def input(self, pin):
+        return self.avr.get_pin(AVR_NAMES[pin])
+
+
+AVR_PINMAP = {"RESET": 3, "SCK": 5, "MISO": 7, "MOSI": 8}
+AVR_NAMES = {pin: name for name, pin in AVR_PINMAP.items()}
+
+
+def write(tmp_path, gpio, **target_args):
+    job = Job("rpi_remote", "ee25lc040.write",
+              {"port": serve_once(gpio)}, target_args,
+              pinmap={"CS": 3, "SCK": 5, "SI": 7, "SO": 8, "HOLD": 10,
+                      "WP": 11},
+              cache_dir=str(tmp_path))
+    run_job(job, ProgressBar(muted=True), {0: 0x12, 100: 0x34})
+
+
+def test_recorded_then_replayed(tmp_path):
+    recorded, replayed = RecordingGPIO(1), RecordingGPIO(1)
+    write(tmp_path, recorded)
+    assert len(list(tmp_path.iterdir())) == 1
+    write(tmp_path, replayed)
+    assert replayed.log == recorded.log
+
+
+def test_replay_checks_the_fetched_bits(tmp_path):
+    write(tmp_path, RecordingGPIO(1))
+    with pytest.raises(CacheMismatchError):
+        write(tmp_path, RecordingGPIO(0))
+
+
+def test_replay_stops_at_the_first_mismatch(tmp_path):
+    recorded, replayed = RecordingGPIO(1), RecordingGPIO(0)
+    write(tmp_path, recorded)
+    with pytest.raises(CacheMismatchError, match="8 of 8"):
+        write(tmp_path, replayed)
+    # the status read before the first page write differs
+    assert len(replayed.log) < len(recorded.log) / 16
+
+
+def test_replay_stops_at_another_signature(tmp_path):
+    mem = {address: address & 0xff for address in range(100)}
+
+    def write_flash(gpio):
+        job = Job("rpi_remote", "avr_spi.write_flash",
+                  {"port": serve_once(gpio)}, {"poll": 0}, AVR_PINMAP,
+                  cache_dir=str(tmp_path))
+        run_job(job, ProgressBar(muted=True), mem)
+    recorded = SimGPIO("attiny2313")
+    write_flash(recorded)
+    assert recorded.avr.memory[:100] == bytes(mem.values())
+    replayed = SimGPIO("atmega16a")
+    with pytest.raises(CacheMismatchError):
+        write_flash(replayed)
+    assert bytes([0x4c]) in {command[:1] for command in recorded.commands}
+    # stopped at the signature byte differing, nothing programmed
+    assert {command[0] for command in replayed.commands} == {0xac, 0x30}
+    assert replayed.avr.memory == b"\xff" * len(replayed.avr.memory)
+
+
+def test_read_dependent_ops_are_not_cached(tmp_path):
+    write(tmp_path, RecordingGPIO(1), incremental=True)
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,83 @@
+import unittest.mock
+
+import pytest
+
+from lib.interfaces import (BaseLoader, OP_FETCH_PIN, OP_SET_PIN, OP_SET_PINS,
+                            OP_WAIT)
+from lib.optimizer import OpOptimizer
+
+
+@pytest.fixture
+def optimizer():
+    yield OpOptimizer(unittest.mock.create_autospec(BaseLoader))
+
+
+def test_drops_redundant_writes(optimizer):
+    optimizer.set_pin(1, True)
+    optimizer.set_pin(1, 1)
+    optimizer.set_pin(1, False)
+    optimizer.set_pin(2, 0)
+    assert [c.args for c in optimizer._loader.set_pin.call_args_list] == [
+        (1, True), (1, False), (2, False)]
+    assert optimizer.removed_writes == 1
+
+
+def test_direction_change_forgets_state(optimizer):
+    optimizer.set_pin(1, True)
+    optimizer.set_as_input(1)
+    optimizer.set_as_output(1)
+    optimizer.set_pin(1, True)
+    assert optimizer._loader.set_pin.call_count == 2
+
+
+def test_merges_waits_across_dropped_writes(optimizer):
+    optimizer.set_pin(1, True)
+    optimizer.wait(1e-6)
+    optimizer.set_pin(1, True)
+    optimizer.wait(2e-6)
+    optimizer.wait(0)
+    optimizer._loader.wait.assert_not_called()
+    optimizer.set_pin(1, False)
+    optimizer._loader.wait.assert_called_once_with(pytest.approx(3e-6))
+    assert optimizer.merged_waits == 2
+    assert optimizer.removed_ops == 3
+
+
+def test_flush_emits_pending_wait(optimizer):
+    optimizer.wait(1e-3)
+    optimizer.flush()
+    optimizer._loader.wait.assert_called_once_with(1e-3)
+    optimizer._loader.flush.assert_called_once()
+
+
+def test_run_batch(optimizer):
+    callback = unittest.mock.Mock()
+    optimizer.set_pin(3, True)
+    optimizer.run_batch([
+        (OP_WAIT, 1e-6),
+        (OP_SET_PIN, 3, 1),
+        (OP_WAIT, 1e-6),
+        (OP_SET_PINS, ((3, True), (4, False))),
+        (OP_FETCH_PIN, 5, callback),
+        (OP_WAIT, 1e-6),
+    ])
+    optimizer._loader.run_batch.assert_called_once_with([
+        (OP_WAIT, pytest.approx(2e-6)),
+        (OP_SET_PINS, ((4, False),)),
+        (OP_FETCH_PIN, 5, callback),
+    ])
+    optimizer.flush()
+    optimizer._loader.wait.assert_called_once_with(1e-6)
+
+
+def test_encode_batch_keeps_writes(optimizer):
+    optimizer.set_pin(3, True)
+    optimizer.encode_batch([
+        (OP_SET_PIN, 3, True),
+        (OP_WAIT, 1e-6),
+        (OP_WAIT, 1e-6),
+    ])
+    optimizer._loader.encode_batch.assert_called_once_with([
+        (OP_SET_PIN, 3, True),
+        (OP_WAIT, 2e-6),
+    ])
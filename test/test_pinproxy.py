@@ -2,8 +2,10 @@ import unittest.mock
 
 import pytest
 
-from lib.interfaces import BaseLoader
-from lib.pinproxy import IGNORED, ThePinProxy
+from lib.interfaces import BaseLoader, OP_FETCH_PIN, OP_SET_PIN, OP_WAIT
+from lib.bitbuffer import BitBuffer
+from lib.pinproxy import (GangMismatchError, IGNORED, parse_pinmap,
+                          ThePinProxy)
 
 
 PINMAP = {"I1": 0, "I2": 1,
@@ -102,7 +104,7 @@ def test_flush(pinproxy):
 
 
 def test_pop_fetched_bits(pinproxy):
-    pinproxy._input_buffer["I1"] = []
+    pinproxy._input_buffer["I1"] = BitBuffer()
     assert pinproxy.pop_fetched("I1") == []
     pinproxy._loader.flush.assert_called_once()
 
@@ -128,3 +130,287 @@ def test_pop_fetched_max(pinproxy):
     pinproxy._input_buffer["I1"].extend([1, 0] * 4 + [0, 1] * 4 + [1, 1])
     assert pinproxy.pop_fetched("I1", 2, n_values=2) == [2, 2]
     assert pinproxy.pop_fetched("I1", 3, n_values=1) == [5]
+
+
+def test_pop_fetched_as_bytes(pinproxy):
+    pinproxy._input_buffer["I1"].extend([1, 0] * 4 + [0, 1] * 4 + [1])
+    assert pinproxy.pop_fetched("I1", as_bytes=True) == b"\xaa\x55"
+    with pytest.raises(ValueError):
+        pinproxy.pop_fetched("I1", 16, as_bytes=True)
+
+
+def test_set_pins(pinproxy):
+    pinproxy.set_as_output("O1", "O2", "X")
+    pinproxy.set_pins({"O1": True, "X": True, "O2": False})
+    pinproxy._loader.set_pins.assert_called_once_with([(2, True), (3, False)])
+
+
+def test_transaction_batches_ops(pinproxy):
+    pinproxy.set_as_output("O1")
+    pinproxy.set_as_input("I1")
+    with pinproxy.transaction():
+        pinproxy.set_pin("O1", True)
+        pinproxy.wait(1e-6)
+        pinproxy.fetch_pin("I1")
+        pinproxy._loader.run_batch.assert_not_called()
+    pinproxy._loader.set_pin.assert_not_called()
+    pinproxy._loader.run_batch.assert_called_once()
+    ops = pinproxy._loader.run_batch.call_args.args[0]
+    assert [op[:2] for op in ops] == [
+        (OP_SET_PIN, 2), (OP_WAIT, 1e-6), (OP_FETCH_PIN, 0)]
+
+
+def test_nested_transaction_commits_once(pinproxy):
+    pinproxy.set_as_output("O1")
+    pinproxy.begin()
+    with pinproxy.transaction():
+        pinproxy.set_pin("O1", True)
+    pinproxy._loader.run_batch.assert_not_called()
+    pinproxy.reset_pin("O1")
+    pinproxy.commit()
+    ops = pinproxy._loader.run_batch.call_args.args[0]
+    assert ops == [(OP_SET_PIN, 2, True), (OP_SET_PIN, 2, False)]
+    pinproxy.set_pin("O1", True)
+    pinproxy._loader.set_pin.assert_called_once_with(2, True)
+
+
+def test_flush_submits_open_transaction(pinproxy):
+    pinproxy.set_as_output("O1")
+    pinproxy.begin()
+    pinproxy.set_pin("O1", True)
+    pinproxy.flush()
+    pinproxy._loader.run_batch.assert_called_once_with(
+        [(OP_SET_PIN, 2, True)])
+    pinproxy._loader.flush.assert_called_once()
+    pinproxy.commit()
+    pinproxy._loader.run_batch.assert_called_once()
+
+
+def test_commit_without_begin_fails(pinproxy):
+    with pytest.raises(RuntimeError):
+        pinproxy.commit()
+
+
+def test_run_batch_fallback():
+    loader = unittest.mock.create_autospec(BaseLoader)
+    callback = unittest.mock.Mock()
+    BaseLoader.run_batch(loader, [
+        (OP_SET_PIN, 1, True),
+        (OP_WAIT, 0.5),
+        (OP_FETCH_PIN, 2, callback),
+    ])
+    loader.set_pin.assert_called_once_with(1, True)
+    loader.wait.assert_called_once_with(0.5)
+    loader.fetch_pin.assert_called_once_with(2, callback)
+
+
+def test_shift_emulation():
+    loader = unittest.mock.create_autospec(BaseLoader)
+    loader.run_batch.side_effect = \
+        lambda ops: BaseLoader.run_batch(loader, ops)
+    loader.fetch_pin.side_effect = lambda pin, callback: callback(1)
+    callback = unittest.mock.Mock()
+    BaseLoader.shift(loader, 2, 3, 0, (1, 0), range(1, 2), callback,
+                     0.0, False)
+    assert loader.set_pin.call_args_list == [
+        unittest.mock.call(3, 1), unittest.mock.call(2, True),
+        unittest.mock.call(2, False),
+        unittest.mock.call(3, 0), unittest.mock.call(2, True),
+        unittest.mock.call(2, False),
+    ]
+    loader.fetch_pin.assert_called_once_with(0, callback)
+    callback.assert_called_once_with(1)
+
+
+def test_shift(pinproxy):
+    pinproxy.set_as_output("O1")
+    pinproxy.set_as_output("O2")
+    pinproxy.set_as_input("I1")
+    pinproxy.shift("O1", [1, 0, 1], "O2", "I1", range(3), 1e-6)
+    args = pinproxy._loader.shift.call_args.args
+    assert args[:5] == (2, 3, 0, (1, 0, 1), range(3))
+    args[5](1)
+    args[5](0)
+    assert pinproxy.pop_fetched("I1", 2) == [2]
+
+
+def test_shift_ignored_data_pins(pinproxy):
+    pinproxy.set_as_output("O1")
+    pinproxy.set_as_output("X")
+    pinproxy.set_as_input("X")
+    pinproxy.shift("O1", [1, 1], "X", "X")
+    assert pinproxy._loader.shift.call_args.args[1:3] == (None, None)
+    with pytest.raises(ValueError):
+        pinproxy.shift("X", [1])
+
+
+class EncodingLoader(BaseLoader):
+    "Encodes set_pin as (pin << 1 | state), fetch as 0xf0 | pin, wait as 0xff"
+
+    def __init__(self):
+        self.sent = []
+
+    def get_output_pins(self):
+        return {2, 3, 6, 7}
+
+    def get_input_pins(self):
+        return {0, 1, 6, 7}
+
+    set_as_output = set_as_input = set_pin = fetch_pin = wait = flush = \
+        lambda *_: None
+
+    def encode_batch(self, ops):
+        data = bytearray()
+        for kind, *args in ops:
+            if kind == OP_SET_PIN:
+                data.append(args[0] << 1 | bool(args[1]))
+            elif kind == OP_FETCH_PIN:
+                data.append(0xf0 | args[0])
+            elif kind == OP_WAIT:
+                data.append(0xff)
+        return bytes(data)
+
+    def send_encoded(self, data, callbacks):
+        self.sent.append((data, callbacks))
+
+
+def emit_field(pinproxy, a):
+    for i in reversed(range(4)):
+        pinproxy.set_pin("O1", a >> i & 1)
+        pinproxy.wait(1e-6)
+    pinproxy.fetch_pin("I1")
+
+
+def test_compiled_template_replays_encoded_ops():
+    loader = EncodingLoader()
+    pinproxy = ThePinProxy(loader, PINMAP)
+    pinproxy.set_as_output("O1")
+    pinproxy.set_as_input("I1")
+    template = pinproxy.compile(lambda a: emit_field(pinproxy, a), a=4)
+    template(a=0b1010)
+    data, callbacks = loader.sent[-1]
+    assert data == bytes([5, 0xff, 4, 0xff, 5, 0xff, 4, 0xff, 0xf0])
+    assert callbacks == [pinproxy._input_buffer["I1"]]
+    with pytest.raises(ValueError):
+        template(a=16)
+    with pytest.raises(KeyError):
+        template(b=1)
+
+
+def test_compiled_template_falls_back_to_calls(pinproxy):
+    pinproxy._loader.encode_batch.return_value = None
+    pinproxy.set_as_output("O1")
+    pinproxy.set_as_input("I1")
+    template = pinproxy.compile(lambda a: emit_field(pinproxy, a), a=4)
+    pinproxy._loader.set_pin.assert_not_called()
+    template(a=0b0001)
+    assert [c.args for c in pinproxy._loader.set_pin.call_args_list] == [
+        (2, 0), (2, 0), (2, 0), (2, 1)]
+    pinproxy._loader.send_encoded.assert_not_called()
+
+
+def test_compile_rejects_value_dependent_structure():
+    loader = EncodingLoader()
+    pinproxy = ThePinProxy(loader, PINMAP)
+    pinproxy.set_as_output("O1")
+
+    def emit(a):
+        for _ in range(a):
+            pinproxy.set_pin("O1")
+
+    template = pinproxy.compile(emit, a=2)
+    assert template._encoded is None
+
+
+def test_pin_handles(pinproxy):
+    pinproxy.set_as_output("O1", "X")
+    pinproxy.set_as_input("I1")
+    o1, x, i1 = pinproxy.pin("O1"), pinproxy.pin("X"), pinproxy.pin("I1")
+    assert pinproxy.pin("O1") is o1
+    o1.set()
+    o1.reset()
+    assert [c.args for c in pinproxy._loader.set_pin.call_args_list] == [
+        (2, True), (2, False)]
+    x.set()
+    x.fetch()
+    i1.fetch()
+    pinproxy._loader.fetch_pin.assert_called_once()
+    with pytest.raises(ValueError):
+        pinproxy.pin("O2")
+
+
+def test_pin_handles_follow_transactions(pinproxy):
+    pinproxy.set_as_output("O1")
+    o1 = pinproxy.pin("O1")
+    with pinproxy.transaction():
+        o1.set()
+    pinproxy._loader.set_pin.assert_not_called()
+    pinproxy._loader.run_batch.assert_called_once_with([(OP_SET_PIN, 2, True)])
+    o1.reset()
+    pinproxy._loader.set_pin.assert_called_once_with(2, False)
+
+
+def test_pin_handle_invalidated_on_direction_change(pinproxy):
+    pinproxy.set_as_output("IO1")
+    io1 = pinproxy.pin("IO1")
+    pinproxy.set_as_input("IO1")
+    with pytest.raises(ValueError):
+        io1.set()
+    pinproxy.pin("IO1").fetch()
+    pinproxy._loader.fetch_pin.assert_called_once()
+
+
+def test_parse_gang_pinmap():
+    pinmap = parse_pinmap(["CS=D3+D6 SO=5+7", "SCK=D5"])
+    assert pinmap == {"CS": ("D3", "D6"), "SO": (5, 7), "SCK": "D5"}
+    with pytest.raises(ValueError):
+        parse_pinmap(["CS=D3+_"])
+
+
+@pytest.fixture
+def gang():
+    loader = unittest.mock.create_autospec(BaseLoader)
+    loader.get_output_pins.return_value = {2, 3, 4, 5}
+    loader.get_input_pins.return_value = {0, 1}
+    loader.run_batch.side_effect = \
+        lambda ops: BaseLoader.run_batch(loader, ops)
+    yield ThePinProxy(loader, {"CS": (2, 3), "CLK": 4, "DI": 5, "DO": (0, 1)})
+
+
+def test_gang_drives_all_chips(gang):
+    gang.set_as_output("CS", "CLK")
+    gang.set_as_input("DO")
+    assert gang._loader.set_as_output.call_count == 3
+    assert gang._loader.set_as_input.call_count == 2
+    gang.reset_pin("CS")
+    gang._loader.set_pins.assert_called_with(((2, False), (3, False)))
+    gang.set_pins({"CS": 1, "CLK": 0})
+    gang._loader.set_pins.assert_called_with([(2, 1), (3, 1), (4, 0)])
+
+
+def test_gang_readback_per_chip(gang):
+    chip_bits = {0: [1, 0, 1, 0, 1, 0, 1, 0], 1: [1, 0, 1, 0, 1, 0, 1, 1]}
+    gang._loader.fetch_pin.side_effect = \
+        lambda pin, callback: callback(chip_bits[pin].pop(0))
+    gang.set_as_output("CLK", "DI")
+    gang.set_as_input("DO")
+    gang.shift("CLK", [1] * 8, "DI", "DO", range(8))
+    assert gang._loader.fetch_pin.call_count == 16
+    assert gang.pop_fetched_gang("DO") == [[0xaa], [0xab]]
+
+    chip_bits[0] += [0, 1]
+    chip_bits[1] += [1, 0]
+    gang.fetch_pin("DO")
+    gang.fetch_pin("DO")
+    assert gang.pop_fetched_gang("DO", 1) == [[0, 1], [1, 0]]
+
+
+def test_gang_mismatch(gang):
+    gang._loader.fetch_pin.side_effect = \
+        lambda pin, callback: callback(pin == 1)
+    gang.set_as_input("DO")
+    for _ in range(8):
+        gang.fetch_pin("DO")
+    with pytest.raises(GangMismatchError) as e:
+        gang.pop_fetched("DO")
+    assert e.value.chips == [1]
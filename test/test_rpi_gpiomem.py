@@ -0,0 +1,81 @@
+import unittest.mock
+
+import pytest
+
+from lib.interfaces import OP_FETCH_PIN, OP_SET_PIN
+from lib.loader.rpi_gpiomem import (BLOCK_SIZE, GPCLR0, GPFSEL0, GPLEV0,
+                                    GPSET0, Loader)
+
+
+@pytest.fixture
+def loader(tmp_path):
+    registers = tmp_path / "gpiomem"
+    registers.write_bytes(bytes(BLOCK_SIZE))
+    loader = Loader(str(registers))
+    loader.open()
+    yield loader
+    loader.close()
+
+
+def test_function_select(loader):
+    loader.set_as_output(40)  # gpio21
+    loader.set_as_output(3)  # gpio2
+    assert loader._regs[GPFSEL0 + 2] == 0b001 << 3
+    assert loader._regs[GPFSEL0] == 0b001 << 6
+    loader.set_as_input(40)
+    assert loader._regs[GPFSEL0 + 2] == 0
+    assert loader._regs[GPFSEL0] == 0b001 << 6
+
+
+def test_cleanup_on_close(tmp_path):
+    registers = tmp_path / "gpiomem"
+    registers.write_bytes(bytes(BLOCK_SIZE))
+    loader = Loader(str(registers))
+    loader.open()
+    loader.set_as_output(3)
+    loader.close()
+    assert registers.read_bytes() == bytes(BLOCK_SIZE)
+
+
+def test_set_pins(loader):
+    loader.set_pin(7, True)  # gpio4
+    assert loader._regs[GPSET0] == 1 << 4
+    loader.set_pins([(7, False), (11, True), (12, True), (13, False)])
+    assert loader._regs[GPSET0] == 1 << 17 | 1 << 18
+    assert loader._regs[GPCLR0] == 1 << 4 | 1 << 27
+
+
+def test_fetch(loader):
+    loader._regs[GPLEV0] = 1 << 21
+    callback = unittest.mock.Mock()
+    loader.fetch_pin(40, callback)
+    loader.fetch_pin(38, callback)
+    assert callback.call_args_list == [unittest.mock.call(1),
+                                       unittest.mock.call(0)]
+
+
+def test_run_batch_reads_levels_once(loader):
+    levels = unittest.mock.MagicMock()
+    levels.__getitem__.side_effect = lambda i: 1 << 21 if i == GPLEV0 else 0
+    loader._regs, regs = levels, loader._regs
+    fetched = []
+    loader.run_batch([
+        (OP_SET_PIN, 3, True),
+        (OP_FETCH_PIN, 40, fetched.append),
+        (OP_FETCH_PIN, 38, fetched.append),
+        (OP_SET_PIN, 3, False),
+        (OP_FETCH_PIN, 40, fetched.append),
+    ])
+    assert fetched == [1, 0, 1]
+    assert levels.__getitem__.call_count == 2
+    levels.__setitem__.assert_any_call(GPSET0, 1 << 2)
+    loader._regs = regs
+
+
+def test_shift(loader):
+    loader._regs[GPLEV0] = 1 << 21
+    fetched = []
+    loader.shift(3, 5, 40, (1, 0), range(2), fetched.append, 0.0, False)
+    assert fetched == [1, 1]
+    assert loader._regs[GPCLR0] == 1 << 2  # clock low at the end
+    assert loader._regs[GPSET0] == 1 << 2
@@ -0,0 +1,151 @@
+import socket
+
+import pytest
+
+import lib.loader.rpi_remote as rpi_remote
+from lib.bitbuffer import BitBuffer
+from lib.interfaces import Capabilities
+from lib.loader.rpi_remote import _parse_caps
+import misc.rpi_tcpserver as RT
+
+
+class RecordingGPIO(RT.StubGPIO):
+    "Logs the outputs, inputs read level, or the lsb of the pin if None"
+
+    def __init__(self, level=None):
+        self.level = level
+        self.log = []
+
+    def output(self, pin, state):
+        self.log.append((pin, state))
+
+    def input(self, pin):
+        return pin & 1 if self.level is None else self.level
+
+
+class ChunkedClient:
+    "Delivers the stream in the given chunk sizes"
+
+    def __init__(self, data, chunksizes):
+        self.data = data
+        self.chunksizes = list(chunksizes)
+        self.sent = bytearray()
+
+    def recv_into(self, buffer):
+        n = self.chunksizes.pop(0) if self.chunksizes else len(self.data)
+        n = min(n, len(self.data), len(buffer))
+        buffer[:n], self.data = self.data[:n], self.data[n:]
+        return n
+
+    def sendall(self, data):
+        self.sent += data
+
+
+def run(data, chunksizes):
+    gpio = RecordingGPIO()
+    client = ChunkedClient(data, chunksizes)
+    RT.handle_client(client, gpio)
+    return gpio.log, bytes(client.sent)
+
+
+def test_ops_split_across_receives():
+    shift = bytes([3, 5, 7, 0, 0, 0, 0, 4, 0xa0, 0xf0])
+    data = bytes([RT.OP_SETPIN_HIGH, 3, RT.OP_READPIN, 7]) \
+        + bytes([RT.OP_EXT | RT.EXT_SHIFT, len(shift)]) + shift \
+        + bytes([RT.OP_SETPIN_LOW, 3, RT.OP_FLUSH, 0])
+    expected = run(data, [len(data)])
+    assert expected == (
+        [(3, 1), (5, 1), (3, 1), (3, 0), (5, 0), (3, 1), (3, 0),
+         (5, 1), (3, 1), (3, 0), (5, 0), (3, 1), (3, 0), (3, 0)],
+        RT.READ_BITS + bytes([0, 0, 0, 5, 0xf8]) + RT.FLUSH_DONE)
+    for chunksizes in ([1] * len(data), [3, 5, 1, 7], [len(data) - 1]):
+        assert run(data, chunksizes) == expected
+
+
+def test_progress_marks():
+    data = bytes([RT.OP_SETPIN_LOW, 3]) * (RT.PROGRESS_CHUNKSIZE * 2 + 1)
+    _, sent = run(data, [1001] * 10)
+    assert sent == RT.PROGRESS_MARK * 2
+
+
+def test_marks_sent_while_the_chunk_runs():
+    gpio = RecordingGPIO()
+    data = bytes([RT.OP_SETPIN_LOW, 3]) * (RT.PROGRESS_CHUNKSIZE * 3)
+    client = ChunkedClient(data, [len(data)])
+    sent_at = []  # ops done at each send
+    client.sendall = lambda response: sent_at.append(len(gpio.log))
+    RT.handle_client(client, gpio)
+    assert sent_at == [RT.PROGRESS_CHUNKSIZE * i for i in (1, 2, 3)]
+
+
+def test_unknown_ext_op_is_skipped():
+    data = bytes([RT.OP_EXT | 0x1e, 2, 0, 0, RT.OP_READPIN, 7,
+                  RT.OP_FLUSH, 0])
+    assert run(data, [3, 3]) == ([], RT.READ_BITS + bytes([0, 0, 0, 1, 0x80])
+                                 + RT.FLUSH_DONE)
+
+
+def test_read_bits_sent_packed_before_marks():
+    data = bytes([RT.OP_READPIN, 7, RT.OP_READPIN, 6]) * 5 \
+        + bytes([RT.OP_SETPIN_LOW, 3]) * (RT.PROGRESS_CHUNKSIZE - 10) \
+        + bytes([RT.OP_READPIN, 7])
+    _, sent = run(data, [len(data)])
+    assert sent == RT.READ_BITS + bytes([0, 0, 0, 10, 0xaa, 0x80]) \
+        + RT.PROGRESS_MARK
+
+
+def test_benchmark():
+    assert RT.benchmark(6000) > 0
+
+
+def test_repeat_replays_the_block():
+    toggle = bytes([RT.OP_SETPIN_HIGH, 3, RT.OP_SETPIN_LOW, 3])
+    repeat = bytes([RT.OP_EXT | RT.EXT_REPEAT, 6, 0, 4, 0, 4, 0, 2])
+    data = toggle + repeat + bytes([RT.OP_READPIN, 7]) \
+        + bytes([RT.OP_EXT | RT.EXT_REPEAT, 6, 0, 14, 0, 4, 0, 1]) \
+        + bytes([RT.OP_SETPIN_LOW, 3]) * (RT.PROGRESS_CHUNKSIZE - 9)
+    log, sent = run(data, [5, 7])
+    assert log[:6] == [(3, 1), (3, 0)] * 3
+    assert log[6:8] == [(3, 1), (3, 0)]
+    assert len(log) == 8 + RT.PROGRESS_CHUNKSIZE - 9
+    assert sent == RT.READ_BITS + bytes([0, 0, 0, 1, 0x80]) \
+        + RT.PROGRESS_MARK
+
+
+def test_hello_reports_capabilities():
+    data = bytes([RT.OP_EXT | RT.EXT_HELLO, 1, RT.PROTOCOL_VERSION])
+    _, sent = run(data, [len(data)])
+    end = 2 + sent[1]
+    assert sent[:1] == RT.CAPS_REPLY
+    caps = _parse_caps(sent[2:end])
+    assert caps.version == RT.PROTOCOL_VERSION
+    assert caps.buffer_size == RT.WINDOW_OPS
+    assert caps.mark_chunksize == RT.PROGRESS_CHUNKSIZE
+    assert {RT.EXT_SHIFT, RT.EXT_REPEAT} <= caps.ext_ops
+    assert sent[end:] == b""
+
+
+def test_silent_server_times_out(monkeypatch):
+    monkeypatch.setattr(rpi_remote, "HELLO_TIMEOUT", 0.1)
+    with socket.create_server(("localhost", 0)) as s:  # never answers
+        loader = rpi_remote.Loader(port=s.getsockname()[1])
+        with pytest.raises(Exception, match="no reply to EXT_HELLO"):
+            loader.open()
+
+
+def test_window_holds_a_mark_chunk():
+    loader = rpi_remote.Loader()
+    loader._apply_capabilities(Capabilities(
+        version=2, buffer_size=16, mark_chunksize=64, ext_ops=frozenset(),
+        loop_time=1e-6))
+    assert loader._window == 64
+
+
+def test_read_bits_handed_in_bulk():
+    loader = rpi_remote.Loader()
+    buffer, bits = BitBuffer(), []
+    loader._read_callbacks.extend([[buffer, 10], [bits.append, 3]])
+    loader._dispatch_bits(bytes([0xa5, 0x5a]), 13)
+    assert buffer.pop_bits(10) == bytes([0xa5, 0x40])
+    assert bits == [0, 1, 1]
+    assert not loader._read_callbacks
@@ -0,0 +1,90 @@
+import io
+import unittest.mock
+
+import pytest
+
+from lib import runner
+from lib.runner import (format_results, group_by_loader, Job, JobResult,
+                        load_jobs, run_jobs)
+
+
+EE25_PINMAP = "CS=1 SCK=2 SI=3 SO=4 HOLD=5 WP=6"
+
+
+def test_load_jobs():
+    jobs = load_jobs(io.StringIO(
+        '[{"loader": "dummy", "target": "ee25lc040.read",'
+        f' "pinmap": "{EE25_PINMAP}"}}]'))
+    assert jobs == [Job("dummy", "ee25lc040.read", pinmap={
+        "CS": 1, "SCK": 2, "SI": 3, "SO": 4, "HOLD": 5, "WP": 6})]
+
+
+def test_group_by_loader():
+    jobs = [
+        Job("d1mini", "a", {"device": "/dev/ttyUSB0"}),
+        Job("d1mini", "b", {"device": "/dev/ttyUSB1"}),
+        Job("d1mini", "c", {"device": "/dev/ttyUSB0"}),
+        Job("rpi_remote", "d"),
+    ]
+    assert group_by_loader(jobs) == [[0, 2], [1], [3]]
+
+
+def test_images_parsed_once(tmp_path):
+    image = tmp_path / "image.hexd"
+    image.write_text("00 01 02\n")
+    job = Job("dummy", "ee25lc040.write", in_file=str(image))
+    with unittest.mock.patch("lib.file_format.hexd.FileFormat.deserialize",
+                             autospec=True, return_value={0: 1}) as parse:
+        images = runner.load_images([job, job, job._replace(loader="rpi")])
+    parse.assert_called_once()
+    assert images == {(str(image), "hexd"): {0: 1}}
+
+
+def test_run_jobs(tmp_path):
+    pinmap = runner.parse_pinmap([EE25_PINMAP])
+    jobs = [
+        Job("dummy", "ee25lc040.read", pinmap=pinmap,
+            out_file=str(tmp_path / "out.hexd")),
+        Job("dummy", "ee25lc040.read", {"unknown": 1}, pinmap=pinmap),
+    ]
+    results = run_jobs(jobs, output_stream=io.StringIO())
+    assert [(r.index, r.ok) for r in results] == [(0, True), (1, False)]
+    assert (tmp_path / "out.hexd").read_text()
+
+
+def test_format_results():
+    jobs = [Job("dummy", "t1"), Job("d1mini", "t2", {"device": "x"})]
+    table = format_results(jobs, [
+        JobResult(0, True, 1.5), JobResult(1, False, 0.25, "Write failed.")])
+    assert table.splitlines() == [
+        "#  loader           target  result                 time",
+        "0  dummy            t1      ok                     1.500s",
+        "1  d1mini device=x  t2      FAILED: Write failed.  0.250s",
+    ]
+
+
+def test_run_job_wraps_the_loader():
+    wrapped = []
+
+    def wrap_loader(loader):
+        wrapped.append(loader)
+        return loader
+    job = Job("dummy", "ee25lc040.read",
+              pinmap=runner.parse_pinmap([EE25_PINMAP]))
+    assert runner.run_job(job, runner.ProgressBar(muted=True),
+                          wrap_loader=wrap_loader)
+    assert [type(loader).__module__ for loader in wrapped] == \
+        ["lib.loader.dummy"]
+
+
+def test_job_defaults_are_not_shared():
+    job = Job("dummy", "ee25lc040.read")
+    with pytest.raises(TypeError):
+        job.target_args["poll"] = 0
+    assert job.loader_key == ("dummy", "{}")
+
+
+def test_missing_in_file_names_the_job():
+    jobs = [Job("dummy", "ee25lc040.read"), Job("dummy", "ee25lc040.write")]
+    with pytest.raises(ValueError, match=r"job 1 \(ee25lc040.write\)"):
+        runner.load_images(jobs)
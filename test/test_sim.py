@@ -0,0 +1,187 @@
+import random
+
+import pytest
+
+from lib.loader.sim import Loader
+from lib.optimizer import OpOptimizer
+from lib.pinproxy import ThePinProxy
+from lib.progressbar import ProgressBar
+from lib.runner import Job, run_job
+import lib.sim.avr as sim_avr
+from lib.target import avr_spi
+
+
+EE25_PINMAP = {pin: pin for pin in ("CS", "SCK", "SI", "SO", "HOLD", "WP")}
+EE93_PINMAP = {pin: pin for pin in ("CS", "CLK", "DI", "DO", "ORG")}
+AVR_SPI_PINMAP = {pin: pin for pin in ("RESET", "SCK", "MISO", "MOSI")}
+AVR_JTAG_PINMAP = {pin: pin for pin in ("RESET", "TCK", "TMS", "TDI", "TDO")}
+
+
+def random_mem(size, seed=0):
+    r = random.Random(seed)
+    return {address: r.randrange(256) for address in range(size)}
+
+
+def run(job, mem_in=None):
+    return run_job(job, ProgressBar(muted=True), mem_in)
+
+
+@pytest.mark.parametrize("device, target, pinmap, target_args, size", [
+    ("ee25lc040", "ee25lc040", EE25_PINMAP, {}, 512),
+    ("ee93lc46", "ee93lcx6", EE93_PINMAP, {"model": 46}, 128),
+    ("ee93lc56", "ee93lcx6", EE93_PINMAP, {"model": 56}, 256),
+])
+def test_eeprom_roundtrip(tmp_path, device, target, pinmap, target_args,
+                          size):
+    loader_args = {"device": device, "image": str(tmp_path / "image.bin")}
+    mem = random_mem(size)
+    run(Job("sim", f"{target}.write", loader_args, target_args, pinmap), mem)
+    assert (tmp_path / "image.bin").read_bytes() == bytes(mem.values())
+    assert run(Job("sim", f"{target}.read", loader_args, target_args,
+                   pinmap)) == mem
+
+
+def test_avr_spi_roundtrip(tmp_path):
+    loader_args = {"device": "attiny2313",
+                   "image": str(tmp_path / "image.bin")}
+    mem = random_mem(100)
+    run(Job("sim", "avr_spi.write_flash", loader_args,
+            pinmap=AVR_SPI_PINMAP), mem)
+    flash = run(Job("sim", "avr_spi.read_flash", loader_args,
+                    pinmap=AVR_SPI_PINMAP))
+    assert len(flash) == 2048
+    assert {a: flash[a] for a in mem} == mem
+    assert set(flash[a] for a in range(100, 2048)) == {0xff}
+
+    run(Job("sim", "avr_spi.chip_erase", loader_args,
+            pinmap=AVR_SPI_PINMAP))
+    assert (tmp_path / "image.bin").read_bytes() == b"\xff" * 2048
+
+
+def test_avr_jtag_write(tmp_path):
+    image = tmp_path / "image.bin"
+    mem = random_mem(300)
+    run(Job("sim", "avr_jtag.write_flash",
+            {"device": "atmega16a", "image": str(image)},
+            pinmap=AVR_JTAG_PINMAP), mem)
+    assert image.read_bytes() == bytes(mem.values()) + b"\xff" * (2**14 - 300)
+
+
+@pytest.mark.parametrize("device, target, pinmap, target_args, size, unit", [
+    ("ee25lc040", "ee25lc040", EE25_PINMAP, {}, 512, "pages"),
+    ("ee93lc46", "ee93lcx6", EE93_PINMAP, {"model": 46}, 128, "bytes"),
+])
+def test_eeprom_incremental_write(tmp_path, caplog, device, target, pinmap,
+                                  target_args, size, unit):
+    loader_args = {"device": device, "image": str(tmp_path / "image.bin")}
+    mem = random_mem(size)
+    job = Job("sim", f"{target}.write", loader_args,
+              {**target_args, "incremental": True}, pinmap)
+    run(job, mem)
+    mem[5] ^= 0xff
+    caplog.set_level("INFO")
+    run(job, mem)
+    assert (tmp_path / "image.bin").read_bytes() == bytes(mem.values())
+    n = size // 16 if unit == "pages" else size
+    assert f"{n - 1} of {n} {unit} unchanged" in caplog.text
+
+
+@pytest.mark.parametrize("device, target, pinmap, target_args, unit", [
+    ("ee25lc040", "ee25lc040", EE25_PINMAP, {}, "pages"),
+    ("ee93lc56", "ee93lcx6", EE93_PINMAP, {"model": 56}, "bytes"),
+])
+def test_eeprom_sparse_write(tmp_path, caplog, device, target, pinmap,
+                             target_args, unit):
+    loader_args = {"device": device, "image": str(tmp_path / "image.bin")}
+    mem = {address: 0xff for address in range(40)}
+    mem.update({3: 0x12, 4: 0xff, 33: 0x34})
+    caplog.set_level("INFO")
+    run(Job("sim", f"{target}.write", loader_args,
+            {**target_args, "sparse": True}, pinmap), mem)
+    image = (tmp_path / "image.bin").read_bytes()
+    assert image[3] == 0x12 and image[33] == 0x34
+    assert set(image) == {0x12, 0x34, 0xff}
+    skipped = "30 of 32 pages" if unit == "pages" else "38 of 40 bytes"
+    assert f"{skipped} blank, skipped" in caplog.text
+
+
+@pytest.mark.parametrize("target, device, pinmap, skipped", [
+    ("avr_spi", "attiny2313", AVR_SPI_PINMAP, "9 of 10"),
+    ("avr_jtag", "atmega16a", AVR_JTAG_PINMAP, "2 of 3"),
+])
+def test_avr_incremental_write(tmp_path, caplog, target, device, pinmap,
+                               skipped):
+    image = tmp_path / "image.bin"
+    job = Job("sim", f"{target}.write_flash",
+              {"device": device, "image": str(image)},
+              {"incremental": True}, pinmap)
+    mem = random_mem(300)
+    run(job, mem)
+    caplog.set_level("INFO")
+
+    mem[200] &= 0x0f  # programmable, no erase
+    run(job, mem)
+    assert "Chip erase" not in caplog.text
+    assert f"{skipped} pages unchanged" in caplog.text
+    assert image.read_bytes()[:300] == bytes(mem.values())
+
+    caplog.clear()
+    mem[0] |= 0xf0  # needs an erase, refused unless asked for
+    with pytest.raises(Exception, match="erase=1"):
+        run(job, mem)
+    assert image.read_bytes()[0] != mem[0]
+
+    job.target_args["erase"] = True  # every page is written again
+    run(job, mem)
+    assert "Chip erase" in caplog.text
+    assert image.read_bytes()[:300] == bytes(mem.values())
+
+
+def test_avr_spi_polls_ready():
+    mem = random_mem(100)
+    device_times = {}
+    for poll in (False, True):
+        loader = Loader("attiny2313")
+        avr = avr_spi.Avr(ThePinProxy(OpOptimizer(loader), AVR_SPI_PINMAP),
+                          ProgressBar(muted=True), poll)
+        with avr.pinproxy:
+            avr.write_flash(mem)
+        assert loader._memory[:100] == bytes(mem.values())
+        device_times[poll] = loader.virtual_time
+    assert len(avr.write_times) == 4
+    # done after the busy time of the sim, not at the first poll
+    saved = device_times[False] - device_times[True]
+    assert 0 < saved <= 4 * (avr_spi.TWD_FLASH - sim_avr.PAGE_WRITE_TIME)
+
+
+def test_avr_spi_poll_timeout(monkeypatch):
+    monkeypatch.setattr(sim_avr, "PAGE_WRITE_TIME", 3600.0)
+    with pytest.raises(Exception, match="busy"):
+        with ThePinProxy(OpOptimizer(Loader("attiny2313")),
+                         AVR_SPI_PINMAP) as pinproxy:
+            avr_spi.write_flash(pinproxy, ProgressBar(muted=True), {0: 0})
+
+
+def test_write_needs_write_enable():
+    loader = Loader("ee25lc040")
+    for pin in ("CS", "HOLD", "WP"):
+        loader.set_pin(pin, True)
+    loader.set_pin("CS", False)
+    for bit in [0, 0, 0, 0, 0, 0, 1, 0] + [0] * 16:  # WRITE 0x00: 0x00
+        loader.set_pin("SI", bit)
+        loader.set_pin("SCK", True)
+        loader.set_pin("SCK", False)
+    loader.set_pin("CS", True)
+    assert loader._memory == b"\xff" * 512
+
+
+def test_waits_advance_virtual_time():
+    loader = Loader("ee93lc66")
+    loader.wait(0.25)
+    loader.wait(0.5)
+    assert loader.virtual_time == 0.75
+
+
+def test_unknown_device():
+    with pytest.raises(ValueError):
+        Loader("ee93lc99")
@@ -42,3 +42,8 @@ def test_on_late_function():
     t = TargetOp(t4)
     assert t("pp", "pb", conf3=987897) == 987897
     assert t("pp", "pb") == 88
+
+
+def test_args():
+    assert t1.args(conf1=1) == {"progressbar": None, "conf1": 1, "conf2": 123}
+    assert t1.args(conf2=5, other=6)["conf2"] == 5
@@ -0,0 +1,41 @@
+import io
+
+import pytest
+
+from lib.loader.bench import Loader
+from lib.optimizer import OpOptimizer
+from lib.pinproxy import ThePinProxy
+from lib.progressbar import ProgressBar
+from lib.target import ee25lc040
+from lib.trace import PinTracer
+
+
+PINMAP = {"CS": 1, "SCK": 2, "SI": 3, "SO": 4, "HOLD": 5, "WP": 6}
+
+
+class KeptStringIO(io.StringIO):
+    def close(self):
+        self.text = self.getvalue()
+        super().close()
+
+
+def test_vcd_and_summary():
+    writer = KeptStringIO()
+    tracer = PinTracer(Loader(), writer, PINMAP)
+    with ThePinProxy(OpOptimizer(tracer), PINMAP) as pinproxy:
+        ee25lc040.write(pinproxy, ProgressBar(muted=True), {0: 0x12})
+    header, body = writer.text.split("$enddefinitions $end\n")
+    names = {line.split()[3]: line.split()[4]
+             for line in header.splitlines() if line.startswith("$var")}
+    assert {"CS", "SCK", "SI", "SO", "wait"} <= set(names.values())
+    times = [int(line[1:]) for line in body.splitlines()
+             if line.startswith("#")]
+    assert times == sorted(times)
+
+    pages = ee25lc040.SIZE // 16
+    sck = tracer.stats["SCK"]
+    assert sck.shortest == pytest.approx(2 * ee25lc040.Thalf)
+    assert tracer.stats["SO"].samples == pages * 8
+    assert tracer.wait_time > pages * ee25lc040.Twc
+    # the shift clocking is no explicit wait
+    assert tracer.elapsed > tracer.wait_time
@@ -1,6 +1,7 @@
 import pytest
 
-from lib.util import split_to_pages, split_on_gaps, cmd, reverse
+from lib.util import (split_to_pages, split_on_gaps, changed_pages,
+                      needs_erase, cmd, reverse)
 
 
 d = {0: 0, 1: 1, 2: 2, 5: 5}
@@ -13,6 +14,20 @@ def test_split_to_pages():
     assert list(split_to_pages(d, 8)) == [{0: 0, 1: 1, 2: 2, 5: 5}]
 
 
+def test_changed_pages():
+    assert changed_pages(d, d, 2) == []
+    assert changed_pages(d, {0: 0, 1: 1, 2: 3, 5: 5}, 2) == [{2: 2}]
+    assert changed_pages(d, {}, 4) == [{0: 0, 1: 1, 2: 2}, {5: 5}]
+    assert changed_pages({0: 0xff}, {}, 4) == []
+
+
+def test_needs_erase():
+    assert not needs_erase(d, {})
+    assert not needs_erase({0: 0x0f}, {0: 0x3f})
+    assert needs_erase({0: 0x0f}, {0: 0xf0})
+    assert not needs_erase({}, {0: 0})
+
+
 def test_split_on_gaps():
     assert list(split_on_gaps({})) == []
     assert list(split_on_gaps(d)) == [{0: 0, 1: 1, 2: 2}, {5: 5}]
@@ -0,0 +1,44 @@
+import os
+import time
+import unittest.mock
+
+from misc.waiter import parse_cpus, realtime, Waiter
+
+
+def test_long_wait_sleeps():
+    waiter = Waiter(spin_time=1e-3, record_jitter=True)
+    start_ts, start_cpu = time.monotonic(), time.process_time()
+    waiter.wait(0.05)
+    assert time.monotonic() - start_ts >= 0.05
+    assert time.process_time() - start_cpu < 0.025
+    assert waiter.stats.count == 1
+    assert waiter.stats.worst >= 0
+
+
+def test_short_wait_spins():
+    waiter = Waiter(spin_time=1e-3)
+    with unittest.mock.patch("misc.waiter.sleep") as sleep:
+        waiter.wait(1e-4)
+    sleep.assert_not_called()
+    assert waiter.stats is None
+
+
+def test_parse_cpus():
+    assert parse_cpus(None) is None
+    assert parse_cpus(3) == {3}
+    assert parse_cpus("2+3") == {2, 3}
+
+
+def test_realtime_restores_affinity():
+    cpus = os.sched_getaffinity(0)
+    with realtime(cpus={min(cpus)}):
+        assert os.sched_getaffinity(0) == {min(cpus)}
+    assert os.sched_getaffinity(0) == cpus
+
+
+def test_realtime_skips_what_is_not_permitted(caplog):
+    with unittest.mock.patch("os.sched_setscheduler",
+                             side_effect=PermissionError("denied")):
+        with realtime(priority=50):
+            pass
+    assert "SCHED_FIFO not applied" in caplog.text